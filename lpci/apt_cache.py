@@ -0,0 +1,127 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""A cache of the packages that apt downloads in managed environments."""
+
+__all__ = [
+    "DEFAULT_APT_CACHE_SIZE",
+    "AptCache",
+    "get_apt_cache_path",
+]
+
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator, List, Optional
+
+from platformdirs import user_cache_path
+
+DEFAULT_APT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+
+def get_apt_cache_path() -> Path:
+    """Return the path used to cache packages downloaded by apt."""
+    return user_cache_path("lpci") / "apt"
+
+
+class AptCache:
+    """Packages downloaded by apt, kept on the host for reuse by jobs.
+
+    The `archives` directory is shared by all managed environments: the
+    name of each package file includes its version and architecture, and
+    apt checks each file against the package lists before using it.  If
+    `lists` is True, then the package lists are also kept, separately for
+    each series and architecture, so that `apt update` only needs to
+    fetch lists that have changed.
+
+    Managed environments using the cache share its directories, which apt's
+    own locks in each environment don't protect, so jobs should hold
+    `lock` while running apt.
+
+    Once the package files take up more than `max_size` bytes, those used
+    least recently are pruned.  Access times are only as accurate as the
+    host's file system records them (typically to within a day).
+
+    :param path: The directory holding the cache.
+    :param max_size: The maximum total size of the cached package files.
+    :param lists: Whether to keep package lists too.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int = DEFAULT_APT_CACHE_SIZE,
+        lists: bool = False,
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.lists = lists
+
+    def get_archives_path(self) -> Path:
+        """Return the directory to use as `/var/cache/apt/archives`."""
+        archives_path = self.path / "archives"
+        (archives_path / "partial").mkdir(parents=True, exist_ok=True)
+        return archives_path
+
+    def get_lists_path(self, series: str, architecture: str) -> Optional[Path]:
+        """Return the directory to use as `/var/lib/apt/lists`, if any."""
+        if not self.lists:
+            return None
+        lists_path = self.path / "lists" / f"{series}-{architecture}"
+        (lists_path / "partial").mkdir(parents=True, exist_ok=True)
+        return lists_path
+
+    @contextmanager
+    def lock(self) -> Generator[None, None, None]:
+        """Serialize use of the cache by concurrent jobs and processes."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / "lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def prune(self) -> List[str]:
+        """Prune the least recently used package files until the cache fits.
+
+        :return: The names of the pruned package files.
+        """
+        if not self.path.is_dir():
+            return []
+        with self.lock():
+            return self._prune()
+
+    def _prune(self) -> List[str]:
+        archives_path = self.path / "archives"
+        entries = []
+        try:
+            with os.scandir(archives_path) as it:
+                for entry in it:
+                    if not entry.name.endswith(".deb") or not entry.is_file(
+                        follow_symlinks=False
+                    ):
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    entries.append(
+                        (
+                            max(stat.st_atime, stat.st_mtime),
+                            entry.name,
+                            stat.st_size,
+                        )
+                    )
+        except FileNotFoundError:
+            return []
+        total = sum(size for _, _, size in entries)
+        pruned = []
+        for _, name, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(archives_path / name)
+            except FileNotFoundError:
+                pass
+            total -= size
+            pruned.append(name)
+        return pruned
@@ -0,0 +1,477 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""A cache of the results of jobs, keyed by their inputs."""
+
+__all__ = [
+    "DEFAULT_CACHE_SIZE",
+    "CacheBackend",
+    "CacheBackendError",
+    "DirectoryCacheBackend",
+    "HTTPCacheBackend",
+    "JobCache",
+    "get_cache_backend",
+    "get_job_cache_path",
+    "get_project_digest",
+    "get_tree_digest",
+]
+
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlparse
+
+import requests
+from craft_cli import emit
+from platformdirs import user_cache_path
+
+from lpci.git import get_tracked_files
+from lpci.providers._sync import IgnoreRules, get_host_entries
+from lpci.store import get_file_digest
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def get_job_cache_path() -> Path:
+    """Return the path used to cache the results of jobs."""
+    return user_cache_path("lpci") / "jobs"
+
+
+def get_tree_digest(path: Path) -> str:
+    """Return a digest of the names and contents of the files in a tree."""
+    digest = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = Path(dirpath) / filename
+            digest.update(os.fsencode(file_path.relative_to(path)) + b"\0")
+            digest.update(get_file_digest(file_path).encode() + b"\0")
+    return digest.hexdigest()
+
+
+def get_project_digest(
+    project_path: Path,
+    ignore_file_names: Sequence[str] = (),
+    exclude: Sequence[Path] = (),
+) -> str:
+    """Return a digest of the files in a project that are copied to jobs.
+
+    If the project is in a Git working tree, then only the content of the
+    files tracked by Git is considered, which is cheap to find from Git's
+    index and is unaffected by Git operations or by untracked build output.
+    Otherwise, every file that would be copied into a managed environment
+    is read.
+
+    :param ignore_file_names: Names of files listing paths that are not
+        copied into managed environments, in the syntax of `.gitignore`.
+    :param exclude: Directories within the project to leave out, such as
+        the output directory.
+    """
+    excluded = []
+    for path in exclude:
+        try:
+            relative_path = path.resolve().relative_to(project_path.resolve())
+        except ValueError:
+            continue
+        excluded.append(relative_path.as_posix())
+    digest = hashlib.sha256()
+
+    tracked_files = get_tracked_files(project_path)
+    if tracked_files is not None:
+        digest.update(b"git\0")
+        for name, (mode, object_id) in sorted(tracked_files.items()):
+            if any(
+                name == prefix or name.startswith(f"{prefix}/")
+                for prefix in excluded
+            ):
+                continue
+            digest.update(f"{name}\0{mode}\0{object_id}\0".encode())
+        return digest.hexdigest()
+
+    ignore_rules = IgnoreRules()
+    for relative_name in excluded:
+        ignore_rules.add([f"/{relative_name}/"])
+    entries = get_host_entries(
+        project_path,
+        ignore_rules=ignore_rules,
+        ignore_file_names=ignore_file_names,
+    )
+    for name, entry in sorted(entries.items()):
+        digest.update(
+            f"{name}\0{entry.kind}\0{entry.mode:o}\0{entry.target}\0".encode()
+        )
+        if entry.kind == "f":
+            digest.update(get_file_digest(project_path / name).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _replace_file(source: str, destination: str) -> None:
+    # Output files may be hard links to blobs in an artifact store, which
+    # must not be overwritten in place.
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    shutil.copy2(source, destination)
+
+
+def _get_size(path: Path) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+class CacheBackendError(Exception):
+    """A shared cache backend could not be used."""
+
+
+class CacheBackend(ABC):
+    """A store of job cache entries that can be shared between hosts.
+
+    Each entry is stored as a gzip-compressed tar archive of its `files`
+    and `properties`, which is written once and never modified.
+    """
+
+    @abstractmethod
+    def get(self, key: str, destination: Path) -> bool:
+        """Fetch the archive of an entry into `destination`.
+
+        :return: True if the entry exists.
+        :raises CacheBackendError: if the entry could not be fetched.
+        """
+
+    @abstractmethod
+    def put(self, key: str, source: Path) -> None:
+        """Store the archive of an entry from `source`.
+
+        :raises CacheBackendError: if the entry could not be stored.
+        """
+
+
+class DirectoryCacheBackend(CacheBackend):
+    """Cache entries in a directory, such as one mounted over NFS.
+
+    :param path: The directory holding the entries.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"<DirectoryCacheBackend {str(self.path)!r}>"
+
+    def _get_archive_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.tar.gz"
+
+    def get(self, key: str, destination: Path) -> bool:
+        try:
+            shutil.copyfile(self._get_archive_path(key), destination)
+        except FileNotFoundError:
+            return False
+        except OSError as error:
+            raise CacheBackendError(str(error)) from error
+        return True
+
+    def put(self, key: str, source: Path) -> None:
+        archive_path = self._get_archive_path(key)
+        if archive_path.exists():
+            return
+        try:
+            archive_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first, so that other hosts never
+            # see a partial entry.
+            fd, temporary_name = tempfile.mkstemp(
+                prefix=".tmp-", dir=archive_path.parent
+            )
+            try:
+                with open(fd, "wb") as f, open(source, "rb") as g:
+                    shutil.copyfileobj(g, f)
+                os.replace(temporary_name, archive_path)
+            finally:
+                if os.path.exists(temporary_name):
+                    os.unlink(temporary_name)
+        except OSError as error:
+            raise CacheBackendError(str(error)) from error
+
+
+class HTTPCacheBackend(CacheBackend):
+    """Cache entries on an HTTP server that supports `GET` and `PUT`.
+
+    Entries are stored at `<url>/<key>.tar.gz`.
+
+    :param url: The base URL of the cache.
+    :param timeout: The number of seconds to wait for the server.
+    """
+
+    def __init__(self, url: str, timeout: float = 60) -> None:
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def __repr__(self) -> str:
+        return f"<HTTPCacheBackend {self.url!r}>"
+
+    def _get_archive_url(self, key: str) -> str:
+        return f"{self.url}/{key}.tar.gz"
+
+    def get(self, key: str, destination: Path) -> bool:
+        try:
+            with requests.get(
+                self._get_archive_url(key), stream=True, timeout=self.timeout
+            ) as response:
+                if response.status_code == 404:
+                    return False
+                response.raise_for_status()
+                with open(destination, "wb") as f:
+                    for chunk in response.iter_content(1024 * 1024):
+                        f.write(chunk)
+        except (OSError, requests.RequestException) as error:
+            raise CacheBackendError(str(error)) from error
+        return True
+
+    def put(self, key: str, source: Path) -> None:
+        try:
+            with open(source, "rb") as f:
+                response = requests.put(
+                    self._get_archive_url(key),
+                    data=f,
+                    headers={"Content-Type": "application/gzip"},
+                    timeout=self.timeout,
+                )
+            response.raise_for_status()
+        except (OSError, requests.RequestException) as error:
+            raise CacheBackendError(str(error)) from error
+
+
+def get_cache_backend(location: str) -> CacheBackend:
+    """Return the shared cache backend for a URL or a directory path."""
+    if urlparse(location).scheme in ("http", "https"):
+        return HTTPCacheBackend(location)
+    else:
+        return DirectoryCacheBackend(Path(location))
+
+
+def _pack_entry(entry_path: Path, archive_path: Path) -> None:
+    with tarfile.open(archive_path, "w:gz") as tar:
+        for name in ("files", "properties"):
+            if (entry_path / name).exists():
+                tar.add(entry_path / name, arcname=name)
+
+
+def _unpack_entry(archive_path: Path, entry_path: Path) -> None:
+    entry_path.mkdir()
+    with tarfile.open(archive_path, "r:gz") as tar:
+        for member in tar:
+            # Archives may come from other hosts, so only accept what
+            # `_pack_entry` would have written.
+            parts = PurePosixPath(member.name).parts
+            if (
+                not parts
+                or parts[0] not in ("files", "properties")
+                or ".." in parts
+                or not (member.isfile() or member.isdir())
+            ):
+                raise CacheBackendError(
+                    f"Unexpected member in cache entry: {member.name!r}"
+                )
+            member.mode &= 0o777
+            tar.extract(member, entry_path)
+
+
+class JobCache:
+    """Results of jobs that have succeeded, keyed by everything they used.
+
+    Each entry holds the `files` and `properties` that a job left in its
+    output directory.  Once the entries take up more than `max_size` bytes,
+    those used least recently are evicted.
+
+    If a shared `backend` is given, then entries missing from this cache
+    are fetched from it, and new entries are stored in it, so that hosts
+    sharing the backend can reuse each other's results.  Problems with the
+    backend are reported, but otherwise treated as cache misses.
+
+    :param path: The directory holding the cache.
+    :param max_size: The maximum total size of the cache's entries.
+    :param backend: A shared backend for the cache.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int = DEFAULT_CACHE_SIZE,
+        backend: Optional[CacheBackend] = None,
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.backend = backend
+        self._project_digests: Dict[
+            Tuple[Path, Tuple[str, ...], Tuple[Path, ...]], str
+        ] = {}
+        self._lock = threading.Lock()
+
+    def get_project_digest(
+        self,
+        project_path: Path,
+        ignore_file_names: Sequence[str] = (),
+        exclude: Sequence[Path] = (),
+    ) -> str:
+        """Return `get_project_digest`, computing it once per project.
+
+        The project is not expected to change while a pipeline is running.
+        """
+        key = (project_path, tuple(ignore_file_names), tuple(exclude))
+        with self._lock:
+            if key not in self._project_digests:
+                self._project_digests[key] = get_project_digest(
+                    project_path,
+                    ignore_file_names=ignore_file_names,
+                    exclude=exclude,
+                )
+            return self._project_digests[key]
+
+    def _fetch(self, key: str) -> bool:
+        """Fetch an entry from the shared backend into this cache."""
+        if self.backend is None:
+            return False
+        self.path.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(
+            prefix=".tmp-", dir=self.path
+        ) as temporary_name:
+            archive_path = Path(temporary_name) / "entry.tar.gz"
+            try:
+                if not self.backend.get(key, archive_path):
+                    return False
+                _unpack_entry(archive_path, Path(temporary_name) / "entry")
+            except (CacheBackendError, tarfile.TarError) as error:
+                emit.message(
+                    f"Failed to fetch {key} from {self.backend!r}: {error}"
+                )
+                return False
+            try:
+                os.rename(Path(temporary_name) / "entry", self.path / key)
+            except OSError:
+                # Another job fetched the same entry concurrently.
+                pass
+        self.evict()
+        return (self.path / key).is_dir()
+
+    def _store(self, key: str, entry_path: Path) -> None:
+        """Store an entry in the shared backend."""
+        if self.backend is None:
+            return
+        with tempfile.TemporaryDirectory(
+            prefix=".tmp-", dir=self.path
+        ) as temporary_name:
+            archive_path = Path(temporary_name) / "entry.tar.gz"
+            _pack_entry(entry_path, archive_path)
+            try:
+                self.backend.put(key, archive_path)
+            except CacheBackendError as error:
+                emit.message(
+                    f"Failed to store {key} in {self.backend!r}: {error}"
+                )
+
+    def restore(self, key: str, target_path: Optional[Path]) -> bool:
+        """Restore the result of a job from the cache.
+
+        :param key: The key identifying the job's inputs.
+        :param target_path: The job's output directory, if outputs are
+            being collected.
+
+        :return: True if the result was in the cache.
+        """
+        entry_path = self.path / key
+        if not entry_path.is_dir() and not self._fetch(key):
+            return False
+        try:
+            if target_path is not None:
+                if (entry_path / "files").is_dir():
+                    shutil.copytree(
+                        entry_path / "files",
+                        target_path / "files",
+                        copy_function=_replace_file,
+                        dirs_exist_ok=True,
+                    )
+                if (entry_path / "properties").is_file():
+                    target_path.mkdir(parents=True, exist_ok=True)
+                    _replace_file(
+                        str(entry_path / "properties"),
+                        str(target_path / "properties"),
+                    )
+            # Record that the entry has been used recently.
+            os.utime(entry_path)
+        except OSError:
+            # The entry may have been evicted concurrently.
+            return False
+        return True
+
+    def save(self, key: str, target_path: Optional[Path]) -> None:
+        """Save the result of a job that has succeeded in the cache.
+
+        :param key: The key identifying the job's inputs.
+        :param target_path: The job's output directory, if outputs are
+            being collected.
+        """
+        entry_path = self.path / key
+        if entry_path.exists():
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        temporary_path = Path(tempfile.mkdtemp(prefix=".tmp-", dir=self.path))
+        try:
+            if target_path is not None:
+                if (target_path / "files").is_dir():
+                    shutil.copytree(
+                        target_path / "files", temporary_path / "files"
+                    )
+                if (target_path / "properties").is_file():
+                    shutil.copy2(
+                        target_path / "properties",
+                        temporary_path / "properties",
+                    )
+            self._store(key, temporary_path)
+            if _get_size(temporary_path) > self.max_size:
+                return
+            try:
+                os.rename(temporary_path, entry_path)
+            except OSError:
+                # Another job saved the same entry concurrently.
+                return
+        finally:
+            if temporary_path.exists():
+                shutil.rmtree(temporary_path)
+        self.evict()
+
+    def evict(self) -> List[str]:
+        """Evict the least recently used entries until the cache fits.
+
+        :return: The keys of the evicted entries.
+        """
+        entries = []
+        for entry_path in self.path.iterdir():
+            if entry_path.name.startswith("."):
+                continue
+            try:
+                entries.append(
+                    (
+                        entry_path.stat().st_mtime,
+                        entry_path.name,
+                        _get_size(entry_path),
+                    )
+                )
+            except OSError:
+                continue
+        total = sum(size for _, _, size in entries)
+        evicted = []
+        for _, name, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(self.path / name, ignore_errors=True)
+            total -= size
+            evicted.append(name)
+        return evicted
@@ -0,0 +1,76 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+from argparse import ArgumentParser, Namespace
+
+from craft_cli import BaseCommand, emit
+
+from lpci.errors import CommandError
+from lpci.providers import get_provider
+from lpci.providers._buildd import SERIES_TO_BUILDD_IMAGE_ALIAS
+from lpci.utils import get_host_architecture
+
+
+class PoolCommand(BaseCommand):
+    """Maintain a pool of ready-to-use managed environments.
+
+    `lpci run-one --use-pool` runs jobs in environments from this pool, to
+    avoid launching and configuring a new environment for each job.  Each
+    pooled environment is reset once a job has finished with it.
+
+    (This command is for use by Launchpad, and is subject to change.)
+    """
+
+    name = "pool"
+    help_msg = __doc__.splitlines()[0]
+    overview = __doc__
+    hidden = True
+
+    def fill_parser(self, parser: ArgumentParser) -> None:
+        """Add arguments specific to this command."""
+        parser.add_argument(
+            "--series",
+            action="append",
+            default=[],
+            choices=sorted(SERIES_TO_BUILDD_IMAGE_ALIAS),
+            help="Keep environments for this series.  (May be repeated.)",
+        )
+        parser.add_argument(
+            "--size",
+            type=int,
+            default=1,
+            metavar="N",
+            help="Keep N environments for each series.",
+        )
+        parser.add_argument(
+            "--clean",
+            action="store_true",
+            default=False,
+            help="Delete all the environments in the pool.",
+        )
+
+    def run(self, args: Namespace) -> int:
+        """Run the command."""
+        if not args.clean and not args.series:
+            raise CommandError("Specify at least one --series, or --clean.")
+        if args.size < 1:
+            raise CommandError("--size must be at least 1.")
+
+        provider = get_provider()
+        provider.ensure_provider_is_available()
+
+        if args.clean:
+            deleted = provider.clean_pool()
+            emit.message(f"Deleted {len(deleted)} pooled environments.")
+            return 0
+
+        architecture = get_host_architecture()
+        for series in args.series:
+            launched = provider.fill_pool(
+                series=series, architecture=architecture, size=args.size
+            )
+            emit.message(
+                f"Launched {len(launched)} pooled environments for "
+                f"{series}/{architecture}."
+            )
+        return 0
@@ -1,18 +1,44 @@
 # Copyright 2021-2022 Canonical Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file LICENSE).
 
-import fnmatch
+import gzip
+import hashlib
 import io
 import itertools
 import json
 import os
+import re
 import shlex
+import shutil
 import subprocess
+import tarfile
 import tempfile
-from argparse import ArgumentParser, Namespace
+import time
+import zlib
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from contextlib import ExitStack, contextmanager
 from pathlib import Path, PurePath
 from tempfile import NamedTemporaryFile
-from typing import Dict, List, Optional, Set
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 import requests
 import yaml
@@ -24,6 +50,15 @@ from jinja2 import BaseLoader, Environment
 from pluggy import PluginManager
 
 from lpci import env
+from lpci._version import version
+from lpci.apt_cache import DEFAULT_APT_CACHE_SIZE, AptCache, get_apt_cache_path
+from lpci.cache import (
+    DEFAULT_CACHE_SIZE,
+    JobCache,
+    get_cache_backend,
+    get_job_cache_path,
+    get_tree_digest,
+)
 from lpci.config import (
     Config,
     Input,
@@ -31,15 +66,89 @@ from lpci.config import (
     Output,
     PackageType,
     PPAShortFormURL,
+    Snap,
     get_ppa_url_parts,
 )
 from lpci.errors import CommandError
+from lpci.output_paths import OutputPathMatcher
+from lpci.package_proxy import (
+    DEFAULT_PACKAGE_PROXY_SIZE,
+    PackageProxy,
+    get_package_proxy_path,
+)
 from lpci.plugin.manager import get_plugin_manager
 from lpci.plugins import PLUGINS
-from lpci.providers import Provider, get_provider
+from lpci.providers import PROJECT_SYNC_MODES, Provider, get_provider
+from lpci.scheduler import (
+    JobGraph,
+    JobKey,
+    format_job_key,
+    get_timings_path,
+    load_timings,
+    save_timings,
+)
+from lpci.signing_keys import (
+    SigningKeyCache,
+    get_fingerprint,
+    get_signing_key_cache_path,
+)
+from lpci.store import ArtifactStore, get_file_digest
 from lpci.utils import get_host_architecture
 
 LAUNCHPAD_API_BASE_URL = "https://api.launchpad.net/devel"
+# The maximum number of signing keys of PPAs to fetch at once.
+SIGNING_KEY_FETCH_WORKERS = 8
+# The number of seconds to wait for Launchpad when fetching signing keys.
+SIGNING_KEY_FETCH_TIMEOUT = 60
+# Cached signing keys are used without asking Launchpad for the PPA's
+# fingerprint if it was last reported less than SIGNING_KEY_MAX_AGE seconds
+# ago.
+SIGNING_KEY_MAX_AGE = 60 * 60
+
+# Ways of copying artifacts between the host and a managed environment:
+# "files" copies each file separately, "archive" streams all of them as a
+# single tar archive, and "auto" uses an archive once there are at least
+# ARCHIVE_TRANSFER_THRESHOLD files.
+ARTIFACT_TRANSFER_MODES = ("auto", "archive", "files")
+ARCHIVE_TRANSFER_THRESHOLD = 32
+
+# With chunked transfers, files of at least CHUNKED_TRANSFER_THRESHOLD bytes
+# are copied in chunks of TRANSFER_CHUNK_SIZE bytes: only the chunks that
+# the destination doesn't already hold are sent, compressed using gzip.
+CHUNKED_TRANSFER_THRESHOLD = 64 * 1024 * 1024
+TRANSFER_CHUNK_SIZE = 4 * 1024 * 1024
+
+# `apt update` is skipped if the package lists in an instance were updated
+# from the same sources less than APT_UPDATE_MAX_AGE seconds ago, and only
+# fetches the lists of new sources if sources were only added since then.
+# The sources used by the last update are recorded in APT_UPDATE_STATE_PATH,
+# which is inside the package lists directory so that it goes with the lists
+# it describes when they are shared between instances using
+# `--apt-cache-lists` (and is removed when `apt update` cleans them up).
+# Sources lines may include credentials, and that directory may be shared
+# on the host, so only their SHA-256 digests are recorded.
+APT_UPDATE_MAX_AGE = 60 * 60
+APT_UPDATE_STATE_PATH = PurePath("/var/lib/apt/lists/lpci-apt-update.json")
+APT_NEW_SOURCES_PATH = PurePath("/var/lib/lpci/new-sources.list")
+# Print the recorded state, the time, whether any package lists exist, the
+# digests of files in /etc/apt/sources.list.d, and /etc/apt/sources.list,
+# separated by null characters.
+_APT_SOURCES_STATE_SCRIPT = (
+    f"mkdir -p {APT_NEW_SOURCES_PATH.parent}; "
+    f"cat {APT_UPDATE_STATE_PATH} 2>/dev/null; printf '\\0'; "
+    "date +%s; printf '\\0'; "
+    "find /var/lib/apt/lists -maxdepth 1 -name '*Release' -print -quit "
+    "2>/dev/null; printf '\\0'; "
+    "cd /etc/apt && find sources.list.d -maxdepth 1 -type f "
+    "\\( -name '*.list' -o -name '*.sources' \\) -print0 2>/dev/null "
+    "| sort -z | xargs -0 -r sha256sum; printf '\\0'; "
+    "cat /etc/apt/sources.list 2>/dev/null || true"
+)
+
+# Ways of making input artifacts available in a managed environment:
+# "copy" copies them into it, and "mount" mounts them read-only from the
+# output directory on the host.
+INPUT_MODES = ("copy", "mount")
 
 
 def _check_relative_path(path: PurePath, container: PurePath) -> PurePath:
@@ -84,55 +193,562 @@ def _remove_prefix_if_possible(path: PurePath, prefix: str) -> PurePath:
         return path
 
 
-def _list_files(instance: Executor, path: Path) -> List[PurePath]:
+def _read_null_separated(
+    instance: Executor, command: List[str], stdin: Optional[IO[bytes]] = None
+) -> Generator[bytes, None, None]:
+    """Run `command` on `instance`, yielding each NUL-terminated output item.
+
+    The output is read as it is produced rather than all at once, so that
+    commands producing a very large number of items don't need much memory.
+
+    :param stdin: A file to use as the command's standard input.
+    :raises subprocess.CalledProcessError: if the command fails.
+    """
+    with tempfile.TemporaryFile() as stderr:
+        proc = instance.execute_popen(
+            command,
+            stdin=subprocess.DEVNULL if stdin is None else stdin,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+        )
+        stdout = proc.stdout
+        assert stdout is not None
+        finished = False
+        try:
+            pending = b""
+            for chunk in iter(lambda: stdout.read(65536), b""):
+                items = (pending + chunk).split(b"\0")
+                pending = items.pop()
+                yield from items
+            if pending:
+                yield pending
+            finished = True
+        finally:
+            stdout.close()
+            if not finished:
+                # The caller stopped early; don't wait for the rest.
+                proc.kill()
+            returncode = proc.wait()
+        if returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                returncode, command, stderr=stderr.read()
+            )
+
+
+def _list_files(
+    instance: Executor,
+    path: Path,
+    directory_patterns: Optional[Sequence[str]] = None,
+    file_patterns: Optional[Sequence[str]] = None,
+) -> Iterator[PurePath]:
     """Find entries in `path` on `instance`.
 
     :param instance: Provider instance to search.
     :param path: Path to directory to search.
-    :return: List of non-directory paths found, relative to `path`.
+    :param directory_patterns: If given, only search directories matching
+        one of these `find -path` patterns.
+    :param file_patterns: If given, only return entries matching one of
+        these `find -path` patterns.
+    :return: Iterator of non-directory paths found, relative to `path`,
+        which yields paths as `find` produces them.
     """
     cmd = ["find", str(path), "-mindepth", "1"]
+    if directory_patterns is not None:
+        cmd.extend(["(", "-type", "d", "!", "("])
+        cmd.extend(_join_find_patterns(directory_patterns))
+        cmd.extend([")", "-prune", ")", "-o"])
     # Exclude directories.
     cmd.extend(["!", "-type", "d"])
+    if file_patterns is not None:
+        cmd.append("(")
+        cmd.extend(_join_find_patterns(file_patterns))
+        cmd.append(")")
     # Produce unambiguous output: file name relative to the starting path,
     # terminated by NUL.
     cmd.extend(["-printf", "%P\\0"])
-    paths = (
-        instance.execute_run(cmd, capture_output=True, check=True)
-        .stdout.rstrip(b"\0")
-        .split(b"\0")
-    )
-    return [PurePath(os.fsdecode(p)) for p in paths]
+    for p in _read_null_separated(instance, cmd):
+        yield PurePath(os.fsdecode(p))
+
+
+def _join_find_patterns(patterns: Sequence[str]) -> List[str]:
+    """Return `find` arguments matching any of `patterns`."""
+    args: List[str] = []
+    for pattern in patterns:
+        if args:
+            args.append("-o")
+        args.extend(["-path", pattern])
+    return args
 
 
 def _resolve_symlinks(
-    instance: Executor, paths: List[PurePath]
-) -> List[PurePath]:
+    instance: Executor, paths: Iterable[PurePath]
+) -> Iterator[PurePath]:
     """Resolve symlinks in each of `paths` on `instance`.
 
     Similar to `Path.resolve`, but doesn't require a Python process on
-    `instance`.
+    `instance`.  The paths are passed to `readlink` in batches using
+    `xargs`, so there is no limit on how many there are.
 
     :param instance: Provider instance to inspect.
     :param paths: Paths to dereference.
-    :return: Dereferenced version of each of the input paths.
+    :return: Iterator of the dereferenced version of each of the input
+        paths, in the same order.
+    """
+    with tempfile.TemporaryFile() as stdin:
+        for path in paths:
+            stdin.write(os.fsencode(str(path)) + b"\0")
+        stdin.seek(0)
+        cmd = ["xargs", "-0", "-r", "readlink", "-f", "-v", "-z", "--"]
+        try:
+            for p in _read_null_separated(instance, cmd, stdin=stdin):
+                yield PurePath(os.fsdecode(p))
+        except subprocess.CalledProcessError as e:
+            raise CommandError(
+                f"Failed to resolve paths: "
+                f"{e.stderr.decode(errors='replace').strip()}",
+                retcode=1,
+            )
+
+
+def _use_archive_transfer(transfer: str, count: int) -> bool:
+    """Decide whether to copy `count` files as a single archive."""
+    if transfer == "auto":
+        return count >= ARCHIVE_TRANSFER_THRESHOLD
+    return transfer == "archive"
+
+
+def _copy_files(
+    copy: Callable[..., None],
+    files: Sequence[Tuple[PurePath, PurePath]],
+    workers: int = 1,
+) -> None:
+    """Copy files between the host and an instance one at a time.
+
+    Each copy costs a round trip through `lxc`, so with `workers` greater
+    than 1 up to that many copies are made concurrently.
+
+    :param copy: `push_file` or `pull_file` of an instance.
+    :param files: Pairs of the source and destination of each file.
+    :param workers: The maximum number of concurrent copies.
+    :raises CommandError: if any copy fails; if several fail, the error
+        reported is the one for the first failing file in `files`.
+    """
+    if workers <= 1 or len(files) <= 1:
+        for source, destination in files:
+            try:
+                copy(source=source, destination=destination)
+            except Exception as e:
+                raise CommandError(str(e), retcode=1)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(copy, source=source, destination=destination)
+            for source, destination in files
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                # Don't start copies that haven't started yet; those that
+                # have are finished before the pool is shut down.
+                for other in futures:
+                    other.cancel()
+                raise CommandError(str(e), retcode=1)
+
+
+def _push_archive(
+    instance: Executor,
+    sources: Dict[PurePath, Path],
+    compress: bool = False,
+) -> None:
+    """Copy files into an instance as a single tar archive.
+
+    The archive is streamed to `tar` running in the instance, which unpacks
+    it; this costs one `exec` however many files there are, rather than one
+    (or more) per file.  The parent directories of the files must already
+    exist.
+
+    :param sources: A mapping from absolute paths in the instance to copy
+        files to to the paths of those files on the host.
+    :param compress: Compress the archive using gzip.
+    """
+    cmd = ["tar", "-x", "-f", "-", "-C", "/"]
+    if compress:
+        cmd.insert(1, "-z")
+    with tempfile.TemporaryFile() as stderr:
+        proc = instance.execute_popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        assert proc.stdin is not None
+        try:
+            with tarfile.open(
+                fileobj=proc.stdin, mode="w|gz" if compress else "w|"
+            ) as tar:
+                for path, source in sources.items():
+                    # Follow symlinks, as copying each file separately
+                    # would.
+                    with open(source, "rb") as f:
+                        info = tar.gettarinfo(
+                            arcname=path.relative_to("/").as_posix(),
+                            fileobj=f,
+                        )
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = "root"
+                        tar.addfile(info, f)
+        except BrokenPipeError:
+            # tar exited early; its error output explains why.
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise CommandError(
+                f"Failed to unpack files: "
+                f"{stderr.read().decode(errors='replace').strip()}",
+                retcode=1,
+            )
+
+
+def _push_files(
+    instance: Executor,
+    sources: Dict[PurePath, Path],
+    transfer: str = "auto",
+    compress: bool = False,
+    workers: int = 1,
+    chunked: bool = False,
+) -> None:
+    """Copy files into an instance.
+
+    :param sources: A mapping from absolute paths in the instance to copy
+        files to to the paths of those files on the host.
+    :param transfer: One of `ARTIFACT_TRANSFER_MODES`.
+    :param compress: Compress the files if they are copied as an archive.
+    :param workers: The maximum number of files to copy concurrently if
+        they are copied separately.
+    :param chunked: Copy large files in compressed chunks.
     """
-    paths = (
-        instance.execute_run(
-            ["readlink", "-f", "-z", "--"] + [str(path) for path in paths],
-            capture_output=True,
-            check=True,
+    if chunked:
+        sources = dict(sources)
+        for path, source in list(sources.items()):
+            if source.stat().st_size >= CHUNKED_TRANSFER_THRESHOLD:
+                _push_chunked(instance, source, path)
+                del sources[path]
+        if not sources:
+            return
+    if _use_archive_transfer(transfer, len(sources)):
+        _push_archive(instance, sources, compress=compress)
+    else:
+        _copy_files(
+            instance.push_file,
+            [(source, path) for path, source in sources.items()],
+            workers=workers,
         )
-        .stdout.rstrip(b"\0")
-        .split(b"\0")
+
+
+def _push_stored_files(instance: Executor, files: Dict[PurePath, str]) -> None:
+    """Copy files from the artifact store in an instance into place.
+
+    :param files: A mapping from absolute paths in the instance to the
+        digests of their contents, all of which must be in the store.
+    """
+    store_path = env.get_managed_environment_artifact_store_path()
+    # Copies are cheap within the instance, and unlike hard links they
+    # can't be used to change the store.
+    script = (
+        'while IFS= read -r -d "" digest && IFS= read -r -d "" path; do '
+        'cp --reflink=auto -- "$0/$digest" "$path" || exit 1; '
+        "done"
+    )
+    instance.execute_run(
+        ["bash", "-c", script, store_path.as_posix()],
+        input=b"".join(
+            digest.encode() + b"\0" + os.fsencode(path) + b"\0"
+            for path, digest in files.items()
+        ),
+        capture_output=True,
+        check=True,
     )
-    return [PurePath(os.fsdecode(p)) for p in paths]
 
 
-def _copy_input_paths(
-    input: Input, remote_cwd: Path, instance: Executor, output_path: Path
+def _get_chunk_digests(path: Path) -> List[str]:
+    """Return the SHA-256 digest of each chunk of a file on the host."""
+    digests = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(TRANSFER_CHUNK_SIZE), b""):
+            digests.append(hashlib.sha256(chunk).hexdigest())
+    return digests
+
+
+def _get_remote_chunk_digests(instance: Executor, path: PurePath) -> List[str]:
+    """Return the SHA-256 digest of each chunk of a file on `instance`.
+
+    If the file doesn't exist, then it has no chunks.
+    """
+    script = (
+        f'[ ! -f "$0" ] || '
+        f'split -b {TRANSFER_CHUNK_SIZE} --filter=sha256sum -- "$0"'
+    )
+    output = instance.execute_run(
+        ["bash", "-c", script, str(path)], capture_output=True, check=True
+    ).stdout
+    return [line.split()[0] for line in output.decode().splitlines()]
+
+
+def _get_remote_file_stats(
+    instance: Executor, paths: Iterable[PurePath]
+) -> Iterator[Tuple[int, int]]:
+    """Return the size and permissions of each of `paths` on `instance`."""
+    with tempfile.TemporaryFile() as stdin:
+        for path in paths:
+            stdin.write(os.fsencode(str(path)) + b"\0")
+        stdin.seek(0)
+        cmd = ["xargs", "-0", "-r", "stat", "--printf", "%s %a\\0", "--"]
+        for item in _read_null_separated(instance, cmd, stdin=stdin):
+            size, mode = item.split()
+            yield int(size), int(mode, 8)
+
+
+def _push_chunked(
+    instance: Executor, source: Path, destination: PurePath
 ) -> None:
-    """Copy designated input artifacts into a job."""
+    """Copy a large file into an instance in compressed chunks.
+
+    Chunks that the file already at `destination` in the instance holds
+    are copied from there rather than from the host.
+    """
+    held: Dict[str, int] = {}
+    for index, digest in enumerate(
+        _get_remote_chunk_digests(instance, destination)
+    ):
+        held.setdefault(digest, index)
+    # Each operation is either the index of a chunk of the existing file,
+    # or "-" to read the next chunk from standard input.
+    operations = [
+        str(held[digest]) if digest in held else "-"
+        for digest in _get_chunk_digests(source)
+    ]
+    mode = os.stat(source).st_mode & 0o777
+    script = (
+        "set -eo pipefail; "
+        'tmp="$(mktemp "$0.XXXXXX")"; '
+        "trap 'rm -f \"$tmp\"' EXIT; "
+        "gzip -d -c | for operation; do "
+        'if [ "$operation" = - ]; then '
+        f"dd bs={TRANSFER_CHUNK_SIZE} count=1 iflag=fullblock status=none; "
+        "else "
+        f'dd if="$0" bs={TRANSFER_CHUNK_SIZE} skip="$operation" count=1 '
+        "status=none; "
+        'fi; done >"$tmp"; '
+        f'chmod {mode:o} "$tmp"; '
+        'mv -f "$tmp" "$0"'
+    )
+    with tempfile.TemporaryFile() as stderr:
+        proc = instance.execute_popen(
+            ["bash", "-c", script, str(destination)] + operations,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        assert proc.stdin is not None
+        try:
+            with proc.stdin, gzip.GzipFile(
+                fileobj=proc.stdin, mode="wb", compresslevel=1
+            ) as stream, open(source, "rb") as f:
+                for operation in operations:
+                    chunk = f.read(TRANSFER_CHUNK_SIZE)
+                    if operation == "-":
+                        stream.write(chunk)
+        except BrokenPipeError:
+            # The command failed; its error output explains why.
+            pass
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise CommandError(
+                f"Failed to copy '{source}' to '{destination}': "
+                f"{stderr.read().decode(errors='replace').strip()}",
+                retcode=1,
+            )
+
+
+def _pull_chunked(
+    instance: Executor, source: PurePath, destination: Path, mode: int
+) -> None:
+    """Copy a large file from an instance in compressed chunks.
+
+    Chunks that the file already at `destination` on the host holds, such
+    as the output of an earlier run of the same job, are copied from there
+    rather than from the instance.  The new file replaces the old one
+    rather than modifying it, in case it is a hard link.
+    """
+    held: Dict[str, int] = {}
+    if destination.is_file():
+        for index, digest in enumerate(_get_chunk_digests(destination)):
+            held.setdefault(digest, index)
+    remote_digests = _get_remote_chunk_digests(instance, source)
+    missing = [
+        str(index)
+        for index, digest in enumerate(remote_digests)
+        if digest not in held
+    ]
+    script = (
+        "set -o pipefail; "
+        "for index; do "
+        f'dd if="$0" bs={TRANSFER_CHUNK_SIZE} skip="$index" count=1 '
+        "status=none || exit 1; "
+        "done | gzip -1 -c"
+    )
+    temporary_path = destination.with_name(f".{destination.name}.lpci-part")
+    try:
+        with tempfile.TemporaryFile() as stderr, ExitStack() as stack:
+            proc = None
+            stream = None
+            if missing:
+                proc = instance.execute_popen(
+                    ["bash", "-c", script, str(source)] + missing,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=stderr,
+                )
+                assert proc.stdout is not None
+                stack.callback(proc.wait)
+                stack.callback(proc.stdout.close)
+                stream = stack.enter_context(
+                    gzip.GzipFile(fileobj=proc.stdout, mode="rb")
+                )
+            old = (
+                stack.enter_context(open(destination, "rb")) if held else None
+            )
+            error = None
+            with open(temporary_path, "wb") as f:
+                try:
+                    for digest in remote_digests:
+                        if digest in held:
+                            assert old is not None
+                            old.seek(held[digest] * TRANSFER_CHUNK_SIZE)
+                            chunk = old.read(TRANSFER_CHUNK_SIZE)
+                        else:
+                            assert stream is not None
+                            chunk = stream.read(TRANSFER_CHUNK_SIZE)
+                            if hashlib.sha256(chunk).hexdigest() != digest:
+                                error = "the file changed or could not be read"
+                                break
+                        f.write(chunk)
+                    else:
+                        # Read the end of the stream, which checks it.
+                        if stream is not None and stream.read():
+                            error = "unexpected data"
+                except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+                    error = str(e)
+            if proc is not None:
+                assert proc.stdout is not None
+                proc.stdout.close()
+                if proc.wait() != 0:
+                    # If the command failed, its error output explains why.
+                    stderr.seek(0)
+                    error = stderr.read().decode(errors="replace").strip()
+            if error is not None:
+                raise CommandError(
+                    f"Failed to copy '{source}': {error}", retcode=1
+                )
+        os.chmod(temporary_path, mode)
+        os.replace(temporary_path, destination)
+    finally:
+        if temporary_path.exists():
+            temporary_path.unlink()
+
+
+def _pull_archive(
+    instance: Executor,
+    destinations: Dict[PurePath, Path],
+    compress: bool = False,
+) -> None:
+    """Copy files from an instance as a single tar archive.
+
+    `tar` running in the instance streams the files back to the host as
+    one archive, which costs one `exec` however many files there are.
+
+    :param destinations: A mapping from absolute paths of files in the
+        instance to the paths on the host to copy them to.
+    :param compress: Compress the archive using gzip.
+    """
+    # Paths in the archive are relative to the root of the instance.
+    members = {
+        path.relative_to("/").as_posix(): destination
+        for path, destination in destinations.items()
+    }
+    cmd = [
+        "tar",
+        "-c",
+        "-f",
+        "-",
+        "-C",
+        "/",
+        # Copy each path as a separate file, as pulling each file
+        # separately would, even if some of them are hard links or
+        # directories.
+        "--hard-dereference",
+        "--no-recursion",
+        "--null",
+        "-T",
+        "-",
+    ]
+    if compress:
+        cmd.insert(1, "-z")
+    with tempfile.TemporaryFile() as stderr:
+        # Pass the paths on standard input so that there's no limit on how
+        # many there are.
+        with tempfile.TemporaryFile() as stdin:
+            stdin.write(b"".join(os.fsencode(m) + b"\0" for m in members))
+            stdin.seek(0)
+            proc = instance.execute_popen(
+                cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr
+            )
+        assert proc.stdout is not None
+        archive_error: Optional[tarfile.TarError] = None
+        try:
+            with proc.stdout, tarfile.open(
+                fileobj=proc.stdout, mode="r|gz" if compress else "r|"
+            ) as tar:
+                for member in tar:
+                    destination = members.get(member.name)
+                    if destination is None:
+                        continue
+                    if not member.isreg():
+                        raise CommandError(
+                            f"File not found: '/{member.name}'", retcode=1
+                        )
+                    source = tar.extractfile(member)
+                    assert source is not None
+                    destination.parent.mkdir(parents=True, exist_ok=True)
+                    with open(destination, "wb") as f:
+                        shutil.copyfileobj(source, f)
+                    os.chmod(destination, member.mode & 0o777)
+        except tarfile.TarError as e:
+            # Most likely tar failed; if so, its error output explains why.
+            archive_error = e
+        if proc.wait() != 0:
+            stderr.seek(0)
+            raise CommandError(
+                f"Failed to archive files: "
+                f"{stderr.read().decode(errors='replace').strip()}",
+                retcode=1,
+            )
+        elif archive_error is not None:
+            raise CommandError(
+                f"Failed to unpack files: {archive_error}", retcode=1
+            )
+
+
+def _get_input_source_path(input: Input, output_path: Path) -> Path:
+    """Find the output directory of the job that `input` refers to."""
     source_parent_path = output_path / input.job_name
     source_jobs = (
         list(source_parent_path.iterdir())
@@ -150,7 +766,58 @@ def _copy_input_paths(
             f"with that name was previously executed and produced output "
             f"artifacts in the following paths: {source_jobs!r}."
         )
-    source_path = source_jobs[0]
+    return source_jobs[0]
+
+
+def _mount_input_paths(
+    input: Input,
+    remote_cwd: Path,
+    instance: lxd.LXDInstance,
+    output_path: Path,
+    provider: Provider,
+) -> None:
+    """Mount designated input artifacts read-only in a job.
+
+    The artifacts are laid out as `_copy_input_paths` would copy them, but
+    nothing is copied, so the job can start however large they are.
+    """
+    source_path = _get_input_source_path(input, output_path).resolve()
+
+    [target_path] = _resolve_symlinks(
+        instance, [remote_cwd / input.target_directory]
+    )
+    _check_relative_path(target_path, remote_cwd)
+
+    for name in ("files", "properties"):
+        if (source_path / name).exists():
+            provider.mount_read_only(
+                instance,
+                host_source=source_path / name,
+                target=target_path / name,
+            )
+
+
+def _copy_input_paths(
+    input: Input,
+    remote_cwd: Path,
+    instance: Executor,
+    output_path: Path,
+    transfer: str = "auto",
+    compress: bool = False,
+    workers: int = 1,
+    store: Optional[ArtifactStore] = None,
+    chunked: bool = False,
+) -> None:
+    """Copy designated input artifacts into a job.
+
+    `transfer` is one of `ARTIFACT_TRANSFER_MODES`.  If the artifacts are
+    copied as an archive and `compress` is True, then the archive is
+    compressed; otherwise, up to `workers` files are copied concurrently.
+    If `store` is given and the artifacts were added to it, then only
+    contents that the instance does not already hold are copied.  If
+    `chunked` is True, then large files are copied in compressed chunks.
+    """
+    source_path = _get_input_source_path(input, output_path)
 
     [target_path] = _resolve_symlinks(
         instance, [remote_cwd / input.target_directory]
@@ -168,29 +835,71 @@ def _copy_input_paths(
     paths = sorted(paths)
     parent_paths = sorted(set(path.parent for path in paths) | {Path(".")})
 
-    try:
-        instance.execute_run(
-            ["mkdir", "-p"]
-            + [str(target_path / "files" / path) for path in parent_paths],
-            check=True,
-        )
+    sources: Dict[PurePath, Path] = {
+        target_path / "files" / path: source_path / "files" / path
+        for path in paths
+    }
+    stored: Dict[PurePath, str] = {}
+    manifest = store.load_manifest(source_path) if store is not None else None
+    if manifest is not None:
+        # Only copy contents that the instance doesn't already hold, and
+        # put each file in place from there.
         for path in paths:
-            instance.push_file(
-                source=source_path / "files" / path,
-                destination=target_path / "files" / path,
-            )
-        instance.push_file(
-            source=source_path / "properties",
-            destination=target_path / "properties",
+            digest = manifest.get(path.as_posix())
+            if digest is not None:
+                stored[target_path / "files" / path] = digest
+
+    store_path = env.get_managed_environment_artifact_store_path()
+    directories = [str(target_path / "files" / path) for path in parent_paths]
+    if stored:
+        directories.append(str(store_path))
+
+    try:
+        instance.execute_run(["mkdir", "-p"] + directories, check=True)
+        if stored:
+            held = set(_list_files(instance, store_path))
+            for remote_path, digest in stored.items():
+                if PurePath(digest) not in held:
+                    sources[store_path / digest] = sources[remote_path]
+                    held.add(PurePath(digest))
+                del sources[remote_path]
+        sources[target_path / "properties"] = source_path / "properties"
+        _push_files(
+            instance,
+            sources,
+            transfer=transfer,
+            compress=compress,
+            workers=workers,
+            chunked=chunked,
         )
+        if stored:
+            _push_stored_files(instance, stored)
+    except CommandError:
+        raise
     except Exception as e:
         raise CommandError(str(e), retcode=1)
 
 
 def _copy_output_paths(
-    output: Output, remote_cwd: Path, instance: Executor, target_path: Path
+    output: Output,
+    remote_cwd: Path,
+    instance: Executor,
+    target_path: Path,
+    transfer: str = "auto",
+    compress: bool = False,
+    workers: int = 1,
+    store: Optional[ArtifactStore] = None,
+    chunked: bool = False,
 ) -> None:
-    """Copy designated output paths from a completed job."""
+    """Copy designated output paths from a completed job.
+
+    `transfer` is one of `ARTIFACT_TRANSFER_MODES`.  If the paths are
+    copied as an archive and `compress` is True, then the archive is
+    compressed; otherwise, up to `workers` files are copied concurrently.
+    If `store` is given, then the copied files are added to it.  If
+    `chunked` is True, then large files are copied in compressed chunks,
+    skipping those chunks already held by the files from an earlier run.
+    """
     if output.paths is None:
         return
 
@@ -204,42 +913,84 @@ def _copy_output_paths(
             remote_cwd.parent,
         )
 
-    remote_paths = sorted(_list_files(instance, remote_cwd.parent))
+    # We list the parent of the build tree in order to allow output.paths
+    # to reference the parent directory.  Where possible, `find` only
+    # searches directories that may contain matching files and only returns
+    # files that may match, so that large trees don't have to be listed in
+    # full.
+    matcher = OutputPathMatcher(output.paths)
+    directory_patterns, file_patterns = matcher.get_find_predicates(remote_cwd)
+    remote_paths = _list_files(
+        instance,
+        remote_cwd.parent,
+        directory_patterns=directory_patterns,
+        file_patterns=file_patterns,
+    )
     output_files = target_path / "files"
 
-    filtered_paths: Set[PurePath] = set()
-    for path_pattern in output.paths:
-        # We listed the parent of the build tree in order to allow
-        # output.paths to reference the parent directory.  The patterns are
-        # still relative to the build tree, though, so make our paths
-        # relative to the build tree again so that they can be matched
-        # properly.
-        paths = [
-            os.path.relpath(path, remote_cwd.name) for path in remote_paths
-        ]
-        result = fnmatch.filter(paths, path_pattern)
-        if not result:
-            raise CommandError(
-                f"{path_pattern} has not matched any output files."
-            )
-        for name in result:
-            filtered_paths.add(PurePath(name))
+    # The patterns are still relative to the build tree, though, so make
+    # our paths relative to the build tree again so that they can be
+    # matched properly.
+    # Paths are matched as `find` produces them, so only the matching ones
+    # are kept in memory.
+    prefix = f"{remote_cwd.name}/"
+    prefix_length = len(prefix)
+
+    def relative_names() -> Iterator[str]:
+        for remote_path in remote_paths:
+            name = remote_path.as_posix()
+            if name.startswith(prefix):
+                yield name[prefix_length:]
+            else:
+                yield f"../{name}"
+
+    filtered_paths, unmatched_patterns = matcher.filter(relative_names())
+    if unmatched_patterns:
+        raise CommandError(
+            f"{unmatched_patterns[0]} has not matched any output files."
+        )
 
     resolved_paths = _resolve_symlinks(
         instance,
-        [remote_cwd / path for path in sorted(filtered_paths)],
+        (remote_cwd / path for path in sorted(set(filtered_paths))),
     )
 
+    destinations = {}
     for path in sorted(resolved_paths):
         relative_path = _remove_prefix_if_possible(
             _check_relative_path(path, remote_cwd.parent), remote_cwd.name
         )
-        destination = output_files / relative_path
+        destinations[path] = output_files / relative_path
+
+    large_files: Dict[PurePath, int] = {}
+    if chunked:
+        for path, (size, mode) in zip(
+            destinations, _get_remote_file_stats(instance, destinations)
+        ):
+            if size >= CHUNKED_TRANSFER_THRESHOLD:
+                large_files[path] = mode
+
+    for path, destination in destinations.items():
         destination.parent.mkdir(parents=True, exist_ok=True)
-        try:
-            instance.pull_file(source=path, destination=destination)
-        except Exception as e:
-            raise CommandError(str(e), retcode=1)
+        if path in large_files:
+            _pull_chunked(instance, path, destination, large_files[path])
+        elif store is not None and destination.exists():
+            # Files from earlier runs may be hard links to blobs in the
+            # store, which must not be overwritten in place.
+            destination.unlink()
+    destinations = {
+        path: destination
+        for path, destination in destinations.items()
+        if path not in large_files
+    }
+    if destinations and _use_archive_transfer(transfer, len(destinations)):
+        _pull_archive(instance, destinations, compress=compress)
+    else:
+        _copy_files(
+            instance.pull_file, list(destinations.items()), workers=workers
+        )
+    if store is not None:
+        store.save_manifest(target_path, store.add_tree(output_files))
 
 
 def _copy_output_properties(
@@ -273,6 +1024,38 @@ def _copy_output_properties(
         json.dump(properties, f)
 
 
+@contextmanager
+def _open_stream(
+    message: str, log: Optional[IO[bytes]] = None
+) -> Iterator[Any]:
+    """Open a stream for the output of a command run on an instance.
+
+    Normally this is just an emitter stream.  If `log` is given, then the
+    output is written to that file instead, so that the output of jobs
+    running concurrently can be shown separately for each job.
+    """
+    if log is None:
+        with emit.open_stream(message) as stream:
+            yield stream
+    else:
+        log.write(f"{message}\n".encode())
+        log.flush()
+        yield log.fileno()
+
+
+def _show_log(message: str, log: IO[bytes]) -> None:
+    """Show the collected output of a job using an emitter stream."""
+    log.seek(0)
+    original_mode = emit.get_mode()
+    if original_mode == EmitterMode.BRIEF:
+        emit.set_mode(EmitterMode.VERBOSE)
+    with emit.open_stream(message) as stream:
+        for chunk in iter(lambda: log.read(io.DEFAULT_BUFFER_SIZE), b""):
+            os.write(stream, chunk)
+    if original_mode == EmitterMode.BRIEF:
+        emit.set_mode(original_mode)
+
+
 def _resolve_runtime_value(
     pm: PluginManager, job: Job, hook_name: str, job_property: str
 ) -> Optional[str]:
@@ -290,45 +1073,231 @@ def _resolve_runtime_value(
     return command_value
 
 
+def _fetch_signing_key(
+    session: requests.Session,
+    cache: SigningKeyCache,
+    owner: str,
+    distribution: str,
+    archive: str,
+) -> Path:
+    """Fetch the signing key of a PPA, unless it is already in the cache.
+
+    :return: The path of the cached keyring.
+    """
+    keyring_path = cache.get_recent(
+        owner, distribution, archive, SIGNING_KEY_MAX_AGE
+    )
+    if keyring_path is not None:
+        return keyring_path
+    archive_url = (
+        f"{LAUNCHPAD_API_BASE_URL}/~{owner}/+archive/{distribution}"
+        f"/{archive}"
+    )
+    not_found_message = (
+        "Error retrieving the signing key for the"
+        f" '{owner}/{archive}/{distribution}' ppa."
+        " Please check if the PPA exists and is not empty."
+    )
+    try:
+        response = session.get(archive_url, timeout=SIGNING_KEY_FETCH_TIMEOUT)
+        if not response.ok:
+            raise CommandError(not_found_message)
+        fingerprint = response.json().get("signing_key_fingerprint")
+        if not fingerprint:
+            raise CommandError(not_found_message)
+        keyring_path = cache.get(owner, distribution, archive, fingerprint)
+        if keyring_path is not None:
+            cache.mark_checked(owner, distribution, archive, fingerprint)
+            return keyring_path
+
+        response = session.get(
+            f"{archive_url}?ws.op=getSigningKeyData",
+            timeout=SIGNING_KEY_FETCH_TIMEOUT,
+        )
+        if not response.ok:
+            raise CommandError(not_found_message)
+        signing_key = response.json()
+    except requests.RequestException as error:
+        raise CommandError(
+            "Error retrieving the signing key for the"
+            f" '{owner}/{archive}/{distribution}' ppa: {error}"
+        ) from error
+    gpg_cmd = [
+        "gpg",
+        "--ignore-time-conflict",
+        "--no-options",
+        "--no-keyring",
+    ]
+    keyring = subprocess.run(
+        gpg_cmd + ["--dearmor"],
+        input=signing_key.encode(),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    if get_fingerprint(keyring) != fingerprint.upper():
+        raise CommandError(
+            "The signing key for the"
+            f" '{owner}/{archive}/{distribution}' ppa does not have the"
+            f" fingerprint {fingerprint} reported by Launchpad."
+        )
+    return cache.put(owner, distribution, archive, keyring, fingerprint)
+
+
 def _import_signing_keys_for_ppas(
     instance: lxd.LXDInstance, ppas: Set[PPAShortFormURL]
 ) -> None:
-    for ppa in ppas:
+    cache = SigningKeyCache(get_signing_key_cache_path())
+    keyrings: Dict[PurePath, Path] = {}
+    archives = {}
+    for ppa in sorted(ppas):
         owner, distribution, archive = get_ppa_url_parts(ppa)
-        signing_key_url = (
-            f"{LAUNCHPAD_API_BASE_URL}/~{owner}/+archive/{distribution}"
-            f"/{archive}?ws.op=getSigningKeyData"
+        destination = PurePath(
+            f"/etc/apt/trusted.gpg.d/{owner}-{archive}-{distribution}.gpg"
         )
-        response = requests.get(signing_key_url)
-        if not response.ok:
-            raise CommandError(
-                "Error retrieving the signing key for the"
-                f" '{owner}/{archive}/{distribution}' ppa."
-                " Please check if the PPA exists and is not empty."
-            )
-        signing_key = response.json()
-        with NamedTemporaryFile("w+") as tmpfile:
-            tmpfile.write(signing_key)
-            tmpfile.flush()
-            with open(tmpfile.name) as keyfile:
-                gpg_cmd = [
-                    "gpg",
-                    "--ignore-time-conflict",
-                    "--no-options",
-                    "--no-keyring",
-                ]
-                with tempfile.NamedTemporaryFile(mode="wb+") as keyring:
-                    subprocess.check_call(
-                        gpg_cmd + ["--dearmor"], stdin=keyfile, stdout=keyring
-                    )
-                    os.fchmod(keyring.fileno(), 0o644)
-                    instance.push_file(
-                        destination=Path(
-                            "/etc/apt/trusted.gpg.d"
-                            f"/{owner}-{archive}-{distribution}.gpg"
-                        ),
-                        source=Path(keyring.name),
-                    )
+        archives[destination] = (owner, distribution, archive)
+
+    # Check and fetch the keys concurrently, reusing connections to
+    # Launchpad.
+    workers = min(len(archives), SIGNING_KEY_FETCH_WORKERS)
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                destination: executor.submit(
+                    _fetch_signing_key, session, cache, *parts
+                )
+                for destination, parts in archives.items()
+            }
+            for destination, future in futures.items():
+                try:
+                    keyrings[destination] = future.result()
+                except Exception:
+                    for other in futures.values():
+                        other.cancel()
+                    raise
+
+    _push_archive(instance, keyrings)
+
+
+def _get_sources_lines(sources: str) -> List[str]:
+    """Return the lines of a `sources.list` file that define sources."""
+    lines = []
+    for line in sources.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#") and line not in lines:
+            lines.append(line)
+    return lines
+
+
+def _get_apt_update_plan(
+    instance: lxd.LXDInstance,
+) -> Tuple[Optional[List[str]], Optional[Dict[str, Any]]]:
+    """Work out how much of `apt update` needs to be run in an instance.
+
+    :return: A tuple of the lines of `/etc/apt/sources.list` whose package
+        lists need to be updated (None for all sources, or an empty list
+        if the package lists are up to date), and the state to record once
+        that update has succeeded (None if it can't be determined).
+    """
+    proc = instance.execute_run(
+        ["bash", "-c", _APT_SOURCES_STATE_SCRIPT], capture_output=True
+    )
+    fields = (proc.stdout or b"").split(b"\0")
+    if proc.returncode != 0 or len(fields) != 5:
+        return None, None
+    recorded, now, lists, parts, sources_list = fields
+    try:
+        sources_lines = _get_sources_lines(sources_list.decode())
+        state: Dict[str, Any] = {
+            "time": int(now),
+            "sources-list": [
+                hashlib.sha256(line.encode()).hexdigest()
+                for line in sources_lines
+            ],
+            "sources-parts": parts.decode(),
+        }
+        previous = json.loads(recorded) if recorded.strip() else {}
+    except ValueError:
+        return None, None
+    if (
+        not lists.strip()
+        or not isinstance(previous, dict)
+        or previous.get("sources-parts") != state["sources-parts"]
+        or not isinstance(previous.get("time"), int)
+        or not 0 <= state["time"] - previous["time"] <= APT_UPDATE_MAX_AGE
+        or not isinstance(previous.get("sources-list"), list)
+        or not set(previous["sources-list"]) <= set(state["sources-list"])
+    ):
+        return None, state
+    new_lines = [
+        line
+        for line, digest in zip(sources_lines, state["sources-list"])
+        if digest not in previous["sources-list"]
+    ]
+    # The lists of the other sources still date from the earlier update.
+    state["time"] = previous["time"]
+    return new_lines, state
+
+
+def _get_missing_apt_packages(
+    instance: lxd.LXDInstance, packages: List[str], host_architecture: str
+) -> List[str]:
+    """Return the packages that aren't installed in an instance.
+
+    Packages are given as `apt install` takes them.  A package counts as
+    installed if it's installed for the given architecture (or the host
+    architecture, or is `Architecture: all`) at the given version (if
+    any); packages selected by release, by pattern or from a file always
+    count as missing, leaving them to `apt`.
+    """
+    names = []
+    wanted = {}
+    for package in packages:
+        name, _, version = package.partition("=")
+        if not re.fullmatch(r"[a-z0-9][a-z0-9+.-]*(:[a-z0-9-]+)?", name):
+            continue
+        name, _, architecture = name.partition(":")
+        names.append(name)
+        wanted[package] = (name, architecture or host_architecture, version)
+    if not names:
+        return list(packages)
+    # `dpkg-query` exits 1 if any of the packages are unknown, but still
+    # shows the others.
+    proc = instance.execute_run(
+        [
+            "dpkg-query",
+            "--show",
+            "--showformat",
+            "${Package}\t${Architecture}\t${Version}\t${Status}\n",
+            "--",
+            *sorted(set(names)),
+        ],
+        capture_output=True,
+    )
+    installed: Dict[str, Set[Tuple[str, str]]] = {}
+    if proc.returncode in (0, 1) and isinstance(proc.stdout, bytes):
+        for line in proc.stdout.decode(errors="replace").splitlines():
+            fields = line.split("\t")
+            if len(fields) == 4 and fields[3].split()[-1:] == ["installed"]:
+                installed.setdefault(fields[0], set()).add(
+                    (fields[1], fields[2])
+                )
+    missing = []
+    for package in packages:
+        if package in wanted:
+            name, architecture, version = wanted[package]
+            if any(
+                installed_architecture in (architecture, "all")
+                and version in ("", installed_version)
+                for installed_architecture, installed_version in (
+                    installed.get(name, ())
+                )
+            ):
+                continue
+        missing.append(package)
+    return missing
 
 
 def _install_apt_packages(
@@ -342,6 +1311,8 @@ def _install_apt_packages(
     package_repositories: List[str],
     environment: Optional[Dict[str, Optional[str]]],
     secrets: Optional[Dict[str, str]],
+    log: Optional[IO[bytes]] = None,
+    keep_downloaded_packages: bool = False,
 ) -> None:
     if replace_package_repositories or package_repositories:
         sources_list_path = "/etc/apt/sources.list"
@@ -378,7 +1349,7 @@ def _install_apt_packages(
         if ppas:
             _import_signing_keys_for_ppas(instance, ppas)
 
-        with emit.open_stream("Replacing /etc/apt/sources.list") as stream:
+        with _open_stream("Replacing /etc/apt/sources.list", log):
             instance.push_file_io(
                 destination=PurePath(sources_list_path),
                 content=io.BytesIO(sources.encode()),
@@ -388,26 +1359,72 @@ def _install_apt_packages(
             )
 
     # update local repository information
-    apt_update = ["apt", "update"]
-    with emit.open_stream(f"Running {apt_update}") as stream:
-        proc = instance.execute_run(
-            apt_update,
-            cwd=remote_cwd,
-            env=environment,
-            stdout=stream,
-            stderr=stream,
-        )
-    if proc.returncode != 0:
-        raise CommandError(
-            f"Job {job_name!r} for "
-            f"{job.series}/{host_architecture} failed with "
-            f"exit status {proc.returncode} "
-            f"while running `{shlex.join(apt_update)}`.",
-            retcode=proc.returncode,
+    sources_lines, apt_update_state = _get_apt_update_plan(instance)
+    if sources_lines == []:
+        emit.progress("Package lists are up to date; skipping `apt update`")
+    else:
+        apt_update = ["apt", "update"]
+        if sources_lines is not None:
+            # Only fetch the lists of the new sources, and keep the others.
+            instance.push_file_io(
+                destination=APT_NEW_SOURCES_PATH,
+                content=io.BytesIO("\n".join(sources_lines + [""]).encode()),
+                file_mode="0600",
+                group="root",
+                user="root",
+            )
+            apt_update += [
+                "-o",
+                f"Dir::Etc::SourceList={APT_NEW_SOURCES_PATH}",
+                "-o",
+                "Dir::Etc::SourceParts=-",
+                "-o",
+                "APT::Get::List-Cleanup=false",
+            ]
+        with _open_stream(f"Running {apt_update}", log) as stream:
+            proc = instance.execute_run(
+                apt_update,
+                cwd=remote_cwd,
+                env=environment,
+                stdout=stream,
+                stderr=stream,
+            )
+        if proc.returncode != 0:
+            raise CommandError(
+                f"Job {job_name!r} for "
+                f"{job.series}/{host_architecture} failed with "
+                f"exit status {proc.returncode} "
+                f"while running `{shlex.join(apt_update)}`.",
+                retcode=proc.returncode,
+            )
+        if apt_update_state is not None:
+            instance.push_file_io(
+                destination=APT_UPDATE_STATE_PATH,
+                content=io.BytesIO(json.dumps(apt_update_state).encode()),
+                file_mode="0600",
+                group="root",
+                user="root",
+            )
+    missing_packages = _get_missing_apt_packages(
+        instance, packages, host_architecture
+    )
+    if not missing_packages:
+        emit.progress(
+            f"All {len(packages)} system packages are already installed"
         )
-    packages_cmd = ["apt", "install", "-y"] + packages
-    emit.progress("Installing system packages")
-    with emit.open_stream(f"Running {packages_cmd}") as stream:
+        return
+    packages_cmd = ["apt", "install", "-y"]
+    if keep_downloaded_packages:
+        # `apt` deletes the packages it downloaded once they are installed
+        # by default, which would defeat a cache of them.
+        packages_cmd += ["-o", "APT::Keep-Downloaded-Packages=true"]
+    packages_cmd += missing_packages
+    emit.progress(
+        f"Installing {len(missing_packages)} of {len(packages)} "
+        f"system packages"
+    )
+    start = time.monotonic()
+    with _open_stream(f"Running {packages_cmd}", log) as stream:
         proc = instance.execute_run(
             packages_cmd,
             cwd=remote_cwd,
@@ -423,6 +1440,10 @@ def _install_apt_packages(
             f"while running `{shlex.join(packages_cmd)}`.",
             retcode=proc.returncode,
         )
+    emit.progress(
+        f"Installed {len(missing_packages)} of {len(packages)} system "
+        f"packages in {time.monotonic() - start:.1f}s"
+    )
 
 
 def _run_instance_command(
@@ -434,16 +1455,20 @@ def _run_instance_command(
     remote_cwd: Path,
     environment: Optional[Dict[str, Optional[str]]],
     root: bool = True,
+    log: Optional[IO[bytes]] = None,
 ) -> None:
     full_run_cmd = ["bash", "--noprofile", "--norc", "-ec", command]
     if not root:
         full_run_cmd[:0] = ["runuser", "-u", env.get_non_root_user(), "--"]
 
     emit.progress("Running command for the job...")
+    # The emitter mode is global, so leave it alone if we're only logging
+    # the output of one of several concurrent jobs; _show_log takes care of
+    # it in that case.
     original_mode = emit.get_mode()
-    if original_mode == EmitterMode.BRIEF:
+    if log is None and original_mode == EmitterMode.BRIEF:
         emit.set_mode(EmitterMode.VERBOSE)
-    with emit.open_stream(f"Running {full_run_cmd}") as stream:
+    with _open_stream(f"Running {full_run_cmd}", log) as stream:
         proc = instance.execute_run(
             full_run_cmd,
             cwd=remote_cwd,
@@ -451,7 +1476,7 @@ def _run_instance_command(
             stdout=stream,
             stderr=stream,
         )
-    if original_mode == EmitterMode.BRIEF:
+    if log is None and original_mode == EmitterMode.BRIEF:
         emit.set_mode(original_mode)
     if proc.returncode != 0:
         raise CommandError(
@@ -462,6 +1487,129 @@ def _run_instance_command(
         )
 
 
+def _get_setup_snapshot_key(
+    job: Job,
+    host_architecture: str,
+    snaps: List[Snap],
+    packages: List[str],
+    replace_package_repositories: Optional[List[str]],
+    package_repositories: List[str],
+    secrets: Optional[Dict[str, str]],
+) -> str:
+    """Return a key identifying the snaps and packages installed for a job.
+
+    Jobs whose environments are set up in the same way share a key, so a
+    snapshot taken after setting up one of them can be reused by the others.
+    """
+    setup = {
+        "series": job.series,
+        "architecture": host_architecture,
+        "snaps": [snap.dict() for snap in snaps],
+        "packages": packages,
+        "replace_package_repositories": replace_package_repositories or [],
+        "package_repositories": package_repositories,
+        # Secrets may be used in package repository lines.
+        "secrets": secrets or {},
+    }
+    return hashlib.sha256(
+        json.dumps(setup, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def _get_job_cache_key(
+    config: Config,
+    job: Job,
+    host_architecture: str,
+    commands: Sequence[Optional[str]],
+    environment: Dict[str, Optional[str]],
+    snaps: List[Snap],
+    packages: List[str],
+    replace_package_repositories: Optional[List[str]],
+    package_repositories: List[str],
+    secrets: Optional[Dict[str, str]],
+    project_digest: str,
+    input_digest: Optional[str],
+    collect_output: bool,
+) -> str:
+    """Return a key identifying everything that a job's result depends on.
+
+    Jobs with the same key are expected to produce the same output, so the
+    result of one of them can be reused for the others.
+    """
+    inputs = {
+        "version": version,
+        "job": job.dict(),
+        "architecture": host_architecture,
+        # Plugins may provide the commands that are actually run.
+        "commands": list(commands),
+        "environment": environment,
+        "snaps": [snap.dict() for snap in snaps],
+        "packages": packages,
+        "replace_package_repositories": replace_package_repositories or [],
+        "package_repositories": package_repositories,
+        "secrets": secrets or {},
+        "license": config.license.dict() if config.license else None,
+        "project": project_digest,
+        "input": input_digest,
+        "collect_output": collect_output,
+    }
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def _get_cached_job_key(
+    cache: JobCache,
+    config: Config,
+    job: Job,
+    host_architecture: str,
+    commands: Sequence[Optional[str]],
+    environment: Dict[str, Optional[str]],
+    snaps: List[Snap],
+    packages: List[str],
+    replace_package_repositories: Optional[List[str]],
+    package_repositories: List[str],
+    secrets: Optional[Dict[str, str]],
+    project_ignore_files: Sequence[str],
+    output: Optional[Path],
+) -> Optional[str]:
+    """Return the key under which a job's result is cached.
+
+    :return: The key, or None if the job's result can't be cached (for
+        instance because its input is missing, which the job reports
+        itself).
+    """
+    input_digest = None
+    if job.input is not None and output is not None:
+        try:
+            source_path = _get_input_source_path(job.input, output)
+        except CommandError:
+            return None
+        input_digest = get_tree_digest(source_path / "files")
+        if (source_path / "properties").is_file():
+            input_digest += get_file_digest(source_path / "properties")
+    project_digest = cache.get_project_digest(
+        Path.cwd(),
+        ignore_file_names=project_ignore_files,
+        exclude=[output] if output is not None else [],
+    )
+    return _get_job_cache_key(
+        config,
+        job,
+        host_architecture,
+        commands=commands,
+        environment=environment,
+        snaps=snaps,
+        packages=packages,
+        replace_package_repositories=replace_package_repositories,
+        package_repositories=package_repositories,
+        secrets=secrets,
+        project_digest=project_digest,
+        input_digest=input_digest,
+        collect_output=output is not None,
+    )
+
+
 def _run_job(
     config: Config,
     job_name: str,
@@ -474,8 +1622,49 @@ def _run_job(
     plugin_settings: Optional[List[str]] = None,
     secrets: Optional[Dict[str, str]] = None,
     gpu_nvidia: bool = False,
-) -> None:
-    """Run a single job."""
+    log: Optional[IO[bytes]] = None,
+    instance_name: Optional[str] = None,
+    project_sync: str = "copy",
+    use_gitignore: bool = False,
+    artifact_transfer: str = "auto",
+    compress_artifacts: bool = False,
+    transfer_workers: int = 1,
+    chunked_transfer: bool = False,
+    artifact_store: bool = False,
+    cache: Optional[JobCache] = None,
+    input_mode: str = "copy",
+    apt_cache: Optional[AptCache] = None,
+) -> bool:
+    """Run a single job.
+
+    Each job (including each entry in a job's matrix) runs in an instance of
+    its own, so jobs for the same series and architecture do not interfere
+    with each other.  If `instance_name` is given, the job runs in that
+    instance instead.  If `log` is given, the output of commands run for
+    the job is written to it rather than being shown directly.
+    `project_sync` is one of `PROJECT_SYNC_MODES`, and controls how the
+    project is made available in the instance.  Paths listed in
+    `.lpciignore` files (and, if `use_gitignore` is True, `.gitignore`
+    files) are not copied into the instance.  `artifact_transfer` is one of
+    `ARTIFACT_TRANSFER_MODES`, and controls how input and output artifacts
+    are copied into and out of the instance; if they are copied as an
+    archive and `compress_artifacts` is True, then the archive is
+    compressed; otherwise, up to `transfer_workers` files are copied
+    concurrently.  If `chunked_transfer` is True, then large artifacts are
+    copied in compressed chunks.  If `artifact_store` is True, then output
+    artifacts are kept in an `ArtifactStore` in the output directory.  If
+    `cache` is given, then the job is skipped if its result is in the
+    cache, and otherwise its result is saved there once it succeeds.
+    `input_mode` is one of `INPUT_MODES`, and controls how input artifacts
+    are made available in the instance, unless the job's input is
+    writable, in which case they are always copied.  If `apt_cache` is
+    given, then it is mounted in the instance before installing system
+    packages.
+
+    Returns True if the job was run, or False if it was skipped because it
+    doesn't run on the host architecture or its result was restored from
+    `cache`.
+    """
     # XXX jugmac00 2022-04-27: we should create a configuration object to be
     # passed in and not so many arguments
     job = config.jobs[job_name][job_index]
@@ -486,7 +1675,7 @@ def _run_job(
 
     host_architecture = get_host_architecture()
     if host_architecture not in job.architectures:
-        return
+        return False
     # verbosity is necessary to please mypy
     if plugin_settings is not None:
         plugin_settings_as_dict = _convert_config_list_to_dict(plugin_settings)
@@ -540,6 +1729,69 @@ def _run_job(
     cwd = Path.cwd()
     remote_cwd = env.get_managed_environment_project_path()
 
+    snaps = list(itertools.chain(*pm.hook.lpci_install_snaps()))
+    packages = list(itertools.chain(*pm.hook.lpci_install_packages()))
+    setup_snapshot = None
+    # Pooled instances are reset after each job, so there is no point in
+    # saving setup snapshots for them.  Restoring a snapshot would also
+    # discard the copy of the project that incremental syncing keeps in the
+    # instance, so that doesn't use them either.
+    if (
+        instance_name is None
+        and project_sync != "incremental"
+        and (snaps or packages)
+    ):
+        setup_snapshot = _get_setup_snapshot_key(
+            job,
+            host_architecture,
+            snaps,
+            packages,
+            replace_package_repositories,
+            package_repositories,
+            secrets,
+        )
+
+    store = None
+    if artifact_store and output is not None:
+        store = ArtifactStore(output)
+
+    project_ignore_files = [".lpciignore"]
+    if use_gitignore:
+        project_ignore_files.append(".gitignore")
+
+    target_path = None
+    if output is not None:
+        target_path = output / job_name / str(job_index)
+    cache_key = None
+    if cache is not None:
+        cache_key = _get_cached_job_key(
+            cache,
+            config,
+            job,
+            host_architecture,
+            [pre_run_command, run_command, post_run_command],
+            environment,
+            snaps,
+            packages,
+            replace_package_repositories,
+            package_repositories,
+            secrets,
+            project_ignore_files,
+            output,
+        )
+        if cache_key is not None and cache.restore(cache_key, target_path):
+            emit.progress(
+                f"Reusing the cached result of {job_name!r} for "
+                f"{job.series}/{host_architecture}"
+            )
+            if store is not None and target_path is not None:
+                files_path = target_path / "files"
+                if files_path.is_dir():
+                    store.save_manifest(
+                        target_path, store.add_tree(files_path)
+                    )
+            return False
+
     emit.progress(
         f"Launching environment for {job.series}/{host_architecture}"
     )
@@ -550,38 +1802,80 @@ def _run_job(
         architecture=host_architecture,
         gpu_nvidia=gpu_nvidia,
         root=root,
+        job_name=job_name,
+        job_index=job_index,
+        setup_snapshot=setup_snapshot,
+        instance_name=instance_name,
+        project_sync=project_sync,
+        project_ignore_files=project_ignore_files,
     ) as instance:
-        snaps = list(itertools.chain(*pm.hook.lpci_install_snaps()))
-        for snap in snaps:
-            emit.progress(
-                "Running `snap install "
-                + f"{snap.name} "
-                + f"(channel={snap.channel}, "
-                + f"classic={snap.classic})`"
-            )
-            install_from_store(
-                executor=instance,
-                snap_name=snap.name,
-                channel=snap.channel,
-                classic=snap.classic,
-            )
-        packages = list(itertools.chain(*pm.hook.lpci_install_packages()))
-        if packages:
-            _install_apt_packages(
-                job_name=job_name,
-                job=job,
-                packages=packages,
-                instance=instance,
-                host_architecture=host_architecture,
-                remote_cwd=remote_cwd,
-                replace_package_repositories=replace_package_repositories,
-                package_repositories=package_repositories,
-                environment=environment,
-                secrets=secrets,
-            )
+        if setup_snapshot is not None and provider.has_setup_snapshot(
+            instance, setup_snapshot
+        ):
+            emit.progress("Snaps and system packages are already installed")
+        else:
+            for snap in snaps:
+                emit.progress(
+                    "Running `snap install "
+                    + f"{snap.name} "
+                    + f"(channel={snap.channel}, "
+                    + f"classic={snap.classic})`"
+                )
+                install_from_store(
+                    executor=instance,
+                    snap_name=snap.name,
+                    channel=snap.channel,
+                    classic=snap.classic,
+                )
+            if packages:
+                if apt_cache is not None:
+                    provider.mount_apt_cache(
+                        instance,
+                        archives_path=apt_cache.get_archives_path(),
+                        lists_path=apt_cache.get_lists_path(
+                            job.series, host_architecture
+                        ),
+                    )
+                with ExitStack() as stack:
+                    if apt_cache is not None:
+                        # Other jobs may be using the same cache.
+                        stack.enter_context(apt_cache.lock())
+                    _install_apt_packages(
+                        job_name=job_name,
+                        job=job,
+                        packages=packages,
+                        instance=instance,
+                        host_architecture=host_architecture,
+                        remote_cwd=remote_cwd,
+                        replace_package_repositories=(
+                            replace_package_repositories
+                        ),
+                        package_repositories=package_repositories,
+                        environment=environment,
+                        secrets=secrets,
+                        log=log,
+                        keep_downloaded_packages=apt_cache is not None,
+                    )
+            if setup_snapshot is not None:
+                provider.save_setup_snapshot(instance, setup_snapshot)
 
         if job.input is not None and output is not None:
-            _copy_input_paths(job.input, remote_cwd, instance, output)
+            if input_mode == "mount" and not job.input.writable:
+                _mount_input_paths(
+                    job.input, remote_cwd, instance, output, provider
+                )
+            else:
+                _copy_input_paths(
+                    job.input,
+                    remote_cwd,
+                    instance,
+                    output,
+                    transfer=artifact_transfer,
+                    compress=compress_artifacts,
+                    workers=transfer_workers,
+                    store=store,
+                    chunked=chunked_transfer,
+                )
 
         for cmd in (pre_run_command, run_command, post_run_command):
             if cmd:
@@ -594,6 +1888,7 @@ def _run_job(
                     remote_cwd=remote_cwd,
                     environment=environment,
                     root=root,
+                    log=log,
                 )
         if config.license:
             if not job.output:
@@ -610,16 +1905,31 @@ def _run_job(
                     job.output.properties["license"] = dict()
                 job.output.properties["license"][key] = value
 
-        if job.output is not None and output is not None:
-            target_path = output / job_name / str(job_index)
+        if job.output is not None and target_path is not None:
             target_path.mkdir(parents=True, exist_ok=True)
-            _copy_output_paths(job.output, remote_cwd, instance, target_path)
+            _copy_output_paths(
+                job.output,
+                remote_cwd,
+                instance,
+                target_path,
+                transfer=artifact_transfer,
+                compress=compress_artifacts,
+                workers=transfer_workers,
+                store=store,
+                chunked=chunked_transfer,
+            )
             _copy_output_properties(
                 job.output, remote_cwd, instance, target_path
             )
 
+    if cache is not None and cache_key is not None:
+        cache.save(cache_key, target_path)
+    return True
+
 
-def _get_job_instance_name(provider: Provider, job: Job) -> str:
+def _get_job_instance_name(
+    provider: Provider, job: Job, job_name: str, job_index: int
+) -> str:
     """Return the instance name for the given provider and job."""
     cwd = Path.cwd()
     return provider.get_instance_name(
@@ -627,6 +1937,232 @@ def _get_job_instance_name(provider: Provider, job: Job) -> str:
         project_path=cwd,
         series=job.series,
         architecture=get_host_architecture(),
+        job_name=job_name,
+        job_index=job_index,
+    )
+
+
+def _get_package_repositories(args: Namespace, job: Job) -> List[str]:
+    """Return the package repositories to use for a job."""
+    # we prefer package repositories via CLI more
+    # so they need to come first
+    # also see sources.list(5)
+    package_repositories = list(args.package_repositories)
+    for group in job.package_repositories:
+        for repository in group.sources_list_lines():
+            package_repositories.append(repository)
+    return package_repositories
+
+
+def _positive_int(value: str) -> int:
+    """Parse a command-line argument that must be a positive integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise ArgumentTypeError(f"Expected a positive integer, not {value!r}.")
+    return number
+
+
+def _non_negative_int(value: str) -> int:
+    """Parse a command-line argument that must be a non-negative integer."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = -1
+    if number < 0:
+        raise ArgumentTypeError(
+            f"Expected a non-negative integer, not {value!r}."
+        )
+    return number
+
+
+def _add_project_sync_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--project-sync",
+        choices=PROJECT_SYNC_MODES,
+        default="copy",
+        help=(
+            "How to make the project available in managed environments: "
+            "'copy' (the default) copies it afresh for each job; "
+            "'incremental' keeps a copy in each environment and only "
+            "transfers files that have changed; 'overlay' mounts it "
+            "read-only with a writable overlay on top."
+        ),
+    )
+
+
+def _add_ignore_file_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--use-gitignore",
+        action="store_true",
+        default=False,
+        help=(
+            "Don't copy paths ignored by `.gitignore` files into managed "
+            "environments.  (Paths listed in `.lpciignore` files are "
+            "never copied.)"
+        ),
+    )
+
+
+def _add_artifact_transfer_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--artifact-transfer",
+        choices=ARTIFACT_TRANSFER_MODES,
+        default="auto",
+        help=(
+            "How to copy artifacts into and out of managed "
+            "environments: 'files' copies each file separately; "
+            "'archive' streams them all as a single tar archive; 'auto' "
+            f"(the default) uses an archive for "
+            f"{ARCHIVE_TRANSFER_THRESHOLD} or more files."
+        ),
+    )
+    parser.add_argument(
+        "--compress-artifacts",
+        action="store_true",
+        default=False,
+        help="Compress artifacts that are copied as an archive.",
+    )
+    parser.add_argument(
+        "--transfer-workers",
+        type=_positive_int,
+        default=1,
+        metavar="N",
+        help=(
+            "Copy up to N artifacts at once when copying them "
+            "separately rather than as an archive."
+        ),
+    )
+    parser.add_argument(
+        "--chunked-transfer",
+        action="store_true",
+        default=False,
+        help=(
+            "Copy large artifacts in compressed chunks, skipping chunks "
+            "that the destination already holds."
+        ),
+    )
+
+
+def _add_artifact_store_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--artifact-store",
+        action="store_true",
+        default=False,
+        help=(
+            "Keep the contents of output files in a store in the output "
+            "directory, shared by identical files, and only copy input "
+            "files whose contents are not already in the managed "
+            "environment."
+        ),
+    )
+
+
+def _add_input_mode_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--input-mode",
+        choices=INPUT_MODES,
+        default="copy",
+        help=(
+            "How to make input artifacts available in managed "
+            "environments: 'copy' (the default) copies them in; 'mount' "
+            "mounts them read-only, except for jobs whose input is "
+            "writable."
+        ),
+    )
+
+
+def _add_apt_cache_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--apt-cache",
+        action="store_true",
+        default=False,
+        help=(
+            "Keep the packages that apt downloads in managed environments "
+            "in a cache on the host, and reuse them in later jobs."
+        ),
+    )
+    parser.add_argument(
+        "--apt-cache-lists",
+        action="store_true",
+        default=False,
+        help=(
+            "Keep apt's package lists in the apt cache too (implies "
+            "--apt-cache)."
+        ),
+    )
+    parser.add_argument(
+        "--apt-cache-size",
+        type=_non_negative_int,
+        default=DEFAULT_APT_CACHE_SIZE // (1024 * 1024),
+        metavar="MB",
+        help=(
+            "Prune the least recently used packages once the apt cache is "
+            "larger than this many megabytes."
+        ),
+    )
+
+
+def _add_package_proxy_arguments(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "--package-proxy",
+        action="store_true",
+        default=False,
+        help=(
+            "Send HTTP requests from managed environments through a caching "
+            "proxy on the host, which keeps packages and archive indexes "
+            "for reuse by later jobs."
+        ),
+    )
+    parser.add_argument(
+        "--package-proxy-size",
+        type=_non_negative_int,
+        default=DEFAULT_PACKAGE_PROXY_SIZE // (1024 * 1024),
+        metavar="MB",
+        help=(
+            "Prune the least recently used files once the package proxy's "
+            "cache is larger than this many megabytes."
+        ),
+    )
+
+
+@contextmanager
+def _package_proxy(args: Namespace, provider: Provider) -> Iterator[None]:
+    """Run the package proxy requested by the command line, if any."""
+    if not args.package_proxy:
+        yield
+        return
+    with PackageProxy(
+        get_package_proxy_path(),
+        max_size=args.package_proxy_size * 1024 * 1024,
+    ) as proxy:
+        provider.package_proxy_port = proxy.port
+        try:
+            yield
+        finally:
+            provider.package_proxy_port = None
+            statistics = proxy.statistics
+            emit.message(
+                f"Package proxy: {statistics.hits} hits, "
+                f"{statistics.misses} misses, "
+                f"{statistics.passed_through} passed through; "
+                f"{statistics.bytes_from_cache / (1024 * 1024):.1f} MB from "
+                f"cache, "
+                f"{statistics.bytes_from_upstream / (1024 * 1024):.1f} MB "
+                f"from upstream"
+            )
+
+
+def _get_apt_cache(args: Namespace) -> Optional[AptCache]:
+    """Return the apt cache requested by the command line, if any."""
+    if not args.apt_cache and not args.apt_cache_lists:
+        return None
+    return AptCache(
+        get_apt_cache_path(),
+        max_size=args.apt_cache_size * 1024 * 1024,
+        lists=args.apt_cache_lists,
     )
 
 
@@ -661,6 +2197,77 @@ class RunCommand(BaseCommand):
                 "for the pipeline after the running it."
             ),
         )
+        parser.add_argument(
+            "--parallel",
+            type=_positive_int,
+            default=1,
+            metavar="N",
+            help=(
+                "Run up to N jobs of each stage of the pipeline "
+                "concurrently, each in its own managed environment."
+            ),
+        )
+        parser.add_argument(
+            "--scheduler",
+            choices=["stages", "dag"],
+            default="stages",
+            help=(
+                "How to order jobs: 'stages' (the default) waits for each "
+                "stage of the pipeline to finish before starting the next; "
+                "'dag' starts a job that takes input from another job as "
+                "soon as that job has finished."
+            ),
+        )
+        parser.add_argument(
+            "--show-plan",
+            action="store_true",
+            default=False,
+            help=(
+                "Show the order in which jobs will be run, and the critical "
+                "path through the pipeline."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            default=False,
+            help="Show the plan without running any jobs.",
+        )
+        parser.add_argument(
+            "--cache",
+            action="store_true",
+            default=False,
+            help=(
+                "Skip jobs whose result is cached from an identical job, "
+                "and cache the results of jobs that succeed."
+            ),
+        )
+        parser.add_argument(
+            "--cache-size",
+            type=_non_negative_int,
+            default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+            metavar="MB",
+            help=(
+                "Evict the least recently used job results once the cache "
+                "is larger than this many megabytes."
+            ),
+        )
+        parser.add_argument(
+            "--shared-cache",
+            metavar="LOCATION",
+            help=(
+                "Share job results with other hosts through a cache in this "
+                "directory, or at this http(s) URL supporting GET and PUT "
+                "(implies --cache)."
+            ),
+        )
+        _add_project_sync_arguments(parser)
+        _add_ignore_file_arguments(parser)
+        _add_artifact_transfer_arguments(parser)
+        _add_input_mode_arguments(parser)
+        _add_apt_cache_arguments(parser)
+        _add_package_proxy_arguments(parser)
+        _add_artifact_store_arguments(parser)
         # Job configuration options.
         parser.add_argument(
             "--apt-replace-repositories",
@@ -717,6 +2324,12 @@ class RunCommand(BaseCommand):
                 "Please use `--replace-package-repositories instead"
             )
         config = Config.load(args.config)
+        graph = JobGraph(config, use_inputs=args.scheduler == "dag")
+
+        if args.show_plan or args.dry_run:
+            self._show_plan(graph)
+        if args.dry_run:
+            return 0
 
         provider = get_provider()
         provider.ensure_provider_is_available()
@@ -726,7 +2339,140 @@ class RunCommand(BaseCommand):
             with open(args.secrets_file) as f:
                 content = f.read()
             secrets = yaml.safe_load(content)
+        self._durations: Dict[JobKey, float] = {}
+        self._cache: Optional[JobCache] = None
+        if args.cache or args.shared_cache:
+            self._cache = JobCache(
+                get_job_cache_path(),
+                max_size=args.cache_size * 1024 * 1024,
+                backend=(
+                    get_cache_backend(args.shared_cache)
+                    if args.shared_cache
+                    else None
+                ),
+            )
+        self._apt_cache = _get_apt_cache(args)
+        try:
+            with _package_proxy(args, provider):
+                if args.scheduler == "dag":
+                    self._run_graph(args, config, provider, secrets, graph)
+                else:
+                    self._run_stages(args, config, provider, secrets)
+        finally:
+            if self._apt_cache is not None:
+                self._apt_cache.prune()
+            if self._durations:
+                cwd = Path.cwd()
+                save_timings(get_timings_path(cwd.name, cwd), self._durations)
+        return 0
+
+    def _show_plan(self, graph: JobGraph) -> None:
+        """Show the dependencies and critical path of a pipeline."""
+        cwd = Path.cwd()
+        durations = load_timings(get_timings_path(cwd.name, cwd))
+        emit.message("Plan:")
+        for key in graph.jobs:
+            line = f"  {format_job_key(key)}"
+            if key in durations:
+                line += f" ({durations[key]:.1f}s)"
+            predecessors = sorted(graph.predecessors[key])
+            if predecessors:
+                line += " after " + ", ".join(
+                    format_job_key(predecessor) for predecessor in predecessors
+                )
+            emit.message(line)
+        for job_name in graph.missing:
+            emit.message(f"  {job_name!r} has no job definition")
+
+        if durations:
+            path, total = graph.get_critical_path(durations)
+            description = f"{total:.1f}s, from previous runs"
+        else:
+            # Without recorded durations, count each job equally.
+            path, total = graph.get_critical_path(
+                durations, default_duration=1.0
+            )
+            description = f"{total:.0f} jobs, no previous runs recorded"
+        emit.message(
+            f"Critical path ({description}): "
+            + " -> ".join(format_job_key(key) for key in path)
+        )
+
+    def _run_pipeline_job(
+        self,
+        args: Namespace,
+        config: Config,
+        provider: Provider,
+        secrets: Dict[str, str],
+        job_name: str,
+        job_index: int,
+        log: Optional[IO[bytes]] = None,
+    ) -> None:
+        """Run a single job from the pipeline, recording its duration."""
+        job = config.jobs[job_name][job_index]
+        start = time.monotonic()
+        ran = _run_job(
+            config,
+            job_name,
+            job_index,
+            provider,
+            args.output_directory,
+            replace_package_repositories=(
+                args.apt_replace_repositories
+                + args.replace_package_repositories
+            ),
+            package_repositories=_get_package_repositories(args, job),
+            env_from_cli=args.set_env,
+            plugin_settings=args.plugin_setting,
+            secrets=secrets,
+            gpu_nvidia=args.gpu_nvidia,
+            log=log,
+            project_sync=args.project_sync,
+            use_gitignore=args.use_gitignore,
+            artifact_transfer=args.artifact_transfer,
+            compress_artifacts=args.compress_artifacts,
+            transfer_workers=args.transfer_workers,
+            chunked_transfer=args.chunked_transfer,
+            artifact_store=args.artifact_store,
+            cache=self._cache,
+            input_mode=args.input_mode,
+            apt_cache=self._apt_cache,
+        )
+        # Skipped jobs would make the recorded timings misleading.
+        if ran:
+            self._durations[(job_name, job_index)] = time.monotonic() - start
+
+    def _clean_job_instance(
+        self, provider: Provider, job: Job, job_name: str, job_index: int
+    ) -> None:
+        """Clean the managed environment used by a job."""
+        cwd = Path.cwd()
+        provider.clean_project_environments(
+            project_name=cwd.name,
+            project_path=cwd,
+            instances=[
+                _get_job_instance_name(provider, job, job_name, job_index),
+            ],
+        )
+
+    def _run_stages(
+        self,
+        args: Namespace,
+        config: Config,
+        provider: Provider,
+        secrets: Dict[str, str],
+    ) -> None:
+        """Run the stages of a pipeline one after another."""
         for stage in config.pipeline:
+            if args.parallel > 1:
+                stage_failed = self._run_stage_in_parallel(
+                    args, config, provider, secrets, stage
+                )
+                if stage_failed:
+                    raise CommandError(
+                        f"Some jobs in {stage} failed; stopping.", retcode=1
+                    )
+                continue
             stage_failed = False
             for job_name in stage:
                 try:
@@ -736,29 +2482,20 @@ class RunCommand(BaseCommand):
                             f"No job definition for {job_name!r}"
                         )
                     for job_index, job in enumerate(jobs):
-                        # we prefer package repositories via CLI more
-                        # so they need to come first
-                        # also see sources.list(5)
-                        package_repositories = list(args.package_repositories)
-                        for group in job.package_repositories:
-                            for repository in group.sources_list_lines():
-                                package_repositories.append(repository)
-                        _run_job(
-                            config,
-                            job_name,
-                            job_index,
-                            provider,
-                            args.output_directory,
-                            replace_package_repositories=(
-                                args.apt_replace_repositories
-                                + args.replace_package_repositories
-                            ),
-                            package_repositories=package_repositories,
-                            env_from_cli=args.set_env,
-                            plugin_settings=args.plugin_setting,
-                            secrets=secrets,
-                            gpu_nvidia=args.gpu_nvidia,
-                        )
+                        try:
+                            self._run_pipeline_job(
+                                args,
+                                config,
+                                provider,
+                                secrets,
+                                job_name,
+                                job_index,
+                            )
+                        finally:
+                            if args.clean:
+                                self._clean_job_instance(
+                                    provider, job, job_name, job_index
+                                )
 
                 except CommandError as e:
                     if len(stage) == 1:
@@ -768,21 +2505,164 @@ class RunCommand(BaseCommand):
                     else:
                         emit.error(e)
                         stage_failed = True
-                finally:
-                    if args.clean:
-                        cwd = Path.cwd()
-                        provider.clean_project_environments(
-                            project_name=cwd.name,
-                            project_path=cwd,
-                            instances=[
-                                _get_job_instance_name(provider, job),
-                            ],
-                        )
             if stage_failed:
                 raise CommandError(
                     f"Some jobs in {stage} failed; stopping.", retcode=1
                 )
-        return 0
+
+    def _run_stage_in_parallel(
+        self,
+        args: Namespace,
+        config: Config,
+        provider: Provider,
+        secrets: Dict[str, str],
+        stage: Sequence[str],
+    ) -> bool:
+        """Run all the jobs in a stage concurrently.
+
+        The output of each job is collected separately and shown once that
+        job has finished, in pipeline order.
+
+        :return: True if any of the jobs failed.
+        """
+        errors: List[CommandError] = []
+        with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+            running: List[Tuple[str, int, Job, IO[bytes], "Future[None]"]]
+            running = []
+            for job_name in stage:
+                for job_index, job in enumerate(config.jobs.get(job_name, [])):
+                    log: IO[bytes] = tempfile.TemporaryFile()
+                    future = executor.submit(
+                        self._run_pipeline_job,
+                        args,
+                        config,
+                        provider,
+                        secrets,
+                        job_name,
+                        job_index,
+                        log=log,
+                    )
+                    running.append((job_name, job_index, job, log, future))
+
+            # Collect results in pipeline order, so that errors and job
+            # output are reported deterministically.
+            for job_name in stage:
+                if not config.jobs.get(job_name):
+                    errors.append(
+                        CommandError(f"No job definition for {job_name!r}")
+                    )
+                    continue
+                for name, job_index, job, log, future in running:
+                    if name != job_name:
+                        continue
+                    try:
+                        future.result()
+                    except CommandError as e:
+                        errors.append(e)
+                    finally:
+                        with log:
+                            _show_log(
+                                f"Output of {job_name!r} #{job_index}", log
+                            )
+                        if args.clean:
+                            self._clean_job_instance(
+                                provider, job, job_name, job_index
+                            )
+
+        if errors and len(stage) == 1:
+            # Single-job stage, so just reraise the first error in order to
+            # get simpler error messages.
+            raise errors[0]
+        for error in errors:
+            emit.error(error)
+        return bool(errors)
+
+    def _run_graph(
+        self,
+        args: Namespace,
+        config: Config,
+        provider: Provider,
+        secrets: Dict[str, str],
+        graph: JobGraph,
+    ) -> None:
+        """Run each job in a pipeline as soon as its dependencies allow.
+
+        Up to `args.parallel` jobs are run at once.  If a job fails, then
+        the jobs that depend on it are skipped, but other jobs carry on.
+        """
+        if graph.missing:
+            raise CommandError(f"No job definition for {graph.missing[0]!r}")
+        concurrent = args.parallel > 1
+        finished: Set[JobKey] = set()
+        errors: Dict[JobKey, CommandError] = {}
+        pending = list(graph.jobs)
+        running: Dict["Future[None]", Tuple[JobKey, Optional[IO[bytes]]]]
+        running = {}
+        with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+            while pending or running:
+                for key in list(pending):
+                    if len(running) >= args.parallel:
+                        break
+                    if graph.predecessors[key] <= finished:
+                        pending.remove(key)
+                        log: Optional[IO[bytes]] = None
+                        if concurrent:
+                            log = tempfile.TemporaryFile()
+                        future = executor.submit(
+                            self._run_pipeline_job,
+                            args,
+                            config,
+                            provider,
+                            secrets,
+                            *key,
+                            log=log,
+                        )
+                        running[future] = (key, log)
+                # Every pending job depends only on jobs that have finished,
+                # are running, or are pending themselves.
+                assert running
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(
+                    done, key=lambda f: graph.jobs.index(running[f][0])
+                ):
+                    key, log = running.pop(future)
+                    job_name, job_index = key
+                    try:
+                        future.result()
+                        finished.add(key)
+                    except CommandError as e:
+                        errors[key] = e
+                        skipped = graph.get_descendants(key)
+                        for skipped_key in pending:
+                            if skipped_key in skipped:
+                                emit.message(
+                                    f"Skipping {format_job_key(skipped_key)}"
+                                    f" since {format_job_key(key)} failed."
+                                )
+                        pending = [k for k in pending if k not in skipped]
+                    finally:
+                        if log is not None:
+                            with log:
+                                _show_log(
+                                    f"Output of {format_job_key(key)}", log
+                                )
+                        if args.clean:
+                            self._clean_job_instance(
+                                provider,
+                                config.jobs[job_name][job_index],
+                                job_name,
+                                job_index,
+                            )
+
+        if errors:
+            if len(graph.jobs) == 1:
+                # Single-job pipeline, so just reraise this in order to get
+                # simpler error messages.
+                raise errors[graph.jobs[0]]
+            for key in graph.jobs:
+                if key in errors:
+                    emit.error(errors[key])
+            raise CommandError("Some jobs failed; stopping.", retcode=1)
 
 
 class RunOneCommand(BaseCommand):
@@ -819,6 +2699,22 @@ class RunOneCommand(BaseCommand):
                 "after running it."
             ),
         )
+        parser.add_argument(
+            "--use-pool",
+            action="store_true",
+            default=False,
+            help=(
+                "Run the job in a managed environment from the pool "
+                "maintained by `lpci pool`, if one is ready."
+            ),
+        )
+        _add_project_sync_arguments(parser)
+        _add_ignore_file_arguments(parser)
+        _add_artifact_transfer_arguments(parser)
+        _add_input_mode_arguments(parser)
+        _add_apt_cache_arguments(parser)
+        _add_package_proxy_arguments(parser)
+        _add_artifact_store_arguments(parser)
         parser.add_argument("job", help="Run only this job name.")
         parser.add_argument(
             "index",
@@ -907,30 +2803,59 @@ class RunOneCommand(BaseCommand):
         for group in job.package_repositories:
             for repository in group.sources_list_lines():
                 package_repositories.append(repository)
-        try:
-            _run_job(
-                config,
-                args.job,
-                args.index,
-                provider,
-                args.output_directory,
-                replace_package_repositories=(
-                    args.apt_replace_repositories
-                    + args.replace_package_repositories
-                ),
-                package_repositories=package_repositories,
-                env_from_cli=args.set_env,
-                plugin_settings=args.plugin_setting,
-                secrets=secrets,
-                gpu_nvidia=args.gpu_nvidia,
+        pool_instance = None
+        if args.use_pool:
+            pool_instance = provider.claim_pool_instance(
+                series=job.series, architecture=get_host_architecture()
             )
+            if pool_instance is None:
+                emit.progress(
+                    "No pooled environment is ready; launching a new one"
+                )
+        apt_cache = _get_apt_cache(args)
+        try:
+            with _package_proxy(args, provider):
+                _run_job(
+                    config,
+                    args.job,
+                    args.index,
+                    provider,
+                    args.output_directory,
+                    replace_package_repositories=(
+                        args.apt_replace_repositories
+                        + args.replace_package_repositories
+                    ),
+                    package_repositories=package_repositories,
+                    env_from_cli=args.set_env,
+                    plugin_settings=args.plugin_setting,
+                    secrets=secrets,
+                    gpu_nvidia=args.gpu_nvidia,
+                    instance_name=pool_instance,
+                    project_sync=args.project_sync,
+                    use_gitignore=args.use_gitignore,
+                    artifact_transfer=args.artifact_transfer,
+                    compress_artifacts=args.compress_artifacts,
+                    transfer_workers=args.transfer_workers,
+                    chunked_transfer=args.chunked_transfer,
+                    artifact_store=args.artifact_store,
+                    input_mode=args.input_mode,
+                    apt_cache=apt_cache,
+                )
         finally:
-            if args.clean:
+            if apt_cache is not None:
+                apt_cache.prune()
+            if pool_instance is not None:
+                provider.release_pool_instance(pool_instance)
+            elif args.clean:
                 cwd = Path.cwd()
                 provider.clean_project_environments(
                     project_name=cwd.name,
                     project_path=cwd,
-                    instances=[_get_job_instance_name(provider, job)],
+                    instances=[
+                        _get_job_instance_name(
+                            provider, job, args.job, args.index
+                        )
+                    ],
                 )
 
         return 0
@@ -6,6 +6,7 @@ from typing import List
 from unittest.mock import ANY, call
 
 from craft_cli import CraftError
+from fixtures import EnvironmentVariable, TempDir
 from testtools import TestCase
 
 from lpci.main import main
@@ -23,6 +24,15 @@ class _CommandResult:
 
 
 class CommandBaseTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        # Don't reuse the results of jobs from other tests.
+        self.useFixture(
+            EnvironmentVariable(
+                "XDG_CACHE_HOME", self.useFixture(TempDir()).path
+            )
+        )
+
     def run_command(self, *args, **kwargs):
         with RecordingEmitterFixture() as emitter:
             exit_code = main(list(args))
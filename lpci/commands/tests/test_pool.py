@@ -0,0 +1,101 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+from unittest.mock import call, patch
+
+from testtools.matchers import MatchesStructure
+
+from lpci.commands.tests import CommandBaseTestCase
+from lpci.errors import CommandError
+from lpci.providers.tests import makeLXDProvider
+
+
+class TestPool(CommandBaseTestCase):
+    def test_requires_series(self):
+        result = self.run_command("pool")
+
+        self.assertThat(
+            result,
+            MatchesStructure.byEquality(
+                exit_code=1,
+                errors=[
+                    CommandError("Specify at least one --series, or --clean.")
+                ],
+            ),
+        )
+
+    def test_invalid_size(self):
+        result = self.run_command("pool", "--series", "focal", "--size", "0")
+
+        self.assertThat(
+            result,
+            MatchesStructure.byEquality(
+                exit_code=1,
+                errors=[CommandError("--size must be at least 1.")],
+            ),
+        )
+
+    @patch("lpci.commands.pool.get_provider")
+    def test_lxd_not_ready(self, mock_get_provider):
+        mock_get_provider.return_value = makeLXDProvider(is_ready=False)
+
+        result = self.run_command("pool", "--series", "focal")
+
+        self.assertThat(
+            result,
+            MatchesStructure.byEquality(
+                exit_code=1,
+                errors=[CommandError("LXD is broken")],
+            ),
+        )
+
+    @patch("lpci.commands.pool.get_provider")
+    @patch("lpci.commands.pool.get_host_architecture", return_value="amd64")
+    @patch("lpci.providers._lxd.LXDProvider.fill_pool")
+    def test_fills_pool(
+        self, mock_fill_pool, mock_get_host_architecture, mock_get_provider
+    ):
+        mock_get_provider.return_value = makeLXDProvider()
+        mock_fill_pool.side_effect = [
+            ["lpci-pool-focal-amd64-1"],
+            ["lpci-pool-jammy-amd64-0", "lpci-pool-jammy-amd64-1"],
+        ]
+
+        result = self.run_command(
+            "pool", "--series", "focal", "--series", "jammy", "--size", "2"
+        )
+
+        self.assertThat(
+            result,
+            MatchesStructure.byEquality(
+                exit_code=0,
+                messages=[
+                    "Launched 1 pooled environments for focal/amd64.",
+                    "Launched 2 pooled environments for jammy/amd64.",
+                ],
+            ),
+        )
+        self.assertEqual(
+            [
+                call(series="focal", architecture="amd64", size=2),
+                call(series="jammy", architecture="amd64", size=2),
+            ],
+            mock_fill_pool.call_args_list,
+        )
+
+    @patch("lpci.commands.pool.get_provider")
+    @patch("lpci.providers._lxd.LXDProvider.clean_pool")
+    def test_clean(self, mock_clean_pool, mock_get_provider):
+        mock_get_provider.return_value = makeLXDProvider()
+        mock_clean_pool.return_value = ["lpci-pool-focal-amd64-0"]
+
+        result = self.run_command("pool", "--clean")
+
+        self.assertThat(
+            result,
+            MatchesStructure.byEquality(
+                exit_code=0,
+                messages=["Deleted 1 pooled environments."],
+            ),
+        )
+        mock_clean_pool.assert_called_once_with()
@@ -68,6 +68,7 @@ class Input(ModelConfigDefaults):
 
     job_name: StrictStr
     target_directory: StrictStr
+    writable: Optional[bool] = False
 
 
 def _validate_plugin_config(
@@ -18,3 +18,8 @@ def get_managed_environment_home_path() -> Path:
 def get_managed_environment_project_path() -> Path:
     """Path for project when running in managed environment."""
     return Path("/build/lpci/project")
+
+
+def get_managed_environment_artifact_store_path() -> Path:
+    """Path for artifact contents kept in managed environment, by digest."""
+    return Path("/build/lpci/store")
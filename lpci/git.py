@@ -4,10 +4,15 @@
 __all__ = [
     "get_current_branch",
     "get_current_remote_url",
+    "get_tracked_files",
 ]
 
+import hashlib
+import os
+import stat
 import subprocess
-from typing import Optional
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 
 def get_current_branch() -> Optional[str]:
@@ -52,3 +57,76 @@ def get_current_remote_url() -> Optional[str]:
         ).stdout.rstrip("\n")
     else:
         return None
+
+
+def get_tracked_files(path: Path) -> Optional[Dict[str, Tuple[str, str]]]:
+    """Return the files under `path` that are tracked by Git.
+
+    Files are described as they are in the working tree: tracked files
+    that have been modified since they were added to the index are hashed
+    again, and those that have been deleted are left out.  Untracked files
+    and the contents of `.git` are not considered.
+
+    :return: A mapping from the paths of the files relative to `path` to
+        their Git mode and object ID, or None if `path` is not in a Git
+        working tree or has no tracked files.
+    """
+    try:
+        ls_files = subprocess.run(
+            ["git", "ls-files", "--stage", "-z"],
+            cwd=path,
+            capture_output=True,
+            check=True,
+        ).stdout
+        modified = subprocess.run(
+            ["git", "diff-files", "--name-only", "--relative", "-z"],
+            cwd=path,
+            capture_output=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    files = {}
+    for record in ls_files.split(b"\0")[:-1]:
+        info, _, raw_name = record.partition(b"\t")
+        mode, object_id, _ = info.decode().split(" ")
+        files[os.fsdecode(raw_name)] = (mode, object_id)
+    if not files:
+        return None
+
+    to_hash: List[str] = []
+    for name in {os.fsdecode(raw) for raw in modified.split(b"\0")[:-1]}:
+        try:
+            st = os.lstat(path / name)
+        except FileNotFoundError:
+            files.pop(name, None)
+            continue
+        if stat.S_ISLNK(st.st_mode):
+            target = os.fsencode(os.readlink(path / name))
+            object_id = hashlib.sha1(
+                f"blob {len(target)}\0".encode() + target
+            ).hexdigest()
+            files[name] = ("120000", object_id)
+        elif stat.S_ISREG(st.st_mode):
+            if "\n" in name:
+                # `git hash-object --stdin-paths` can't take this name.
+                return None
+            mode = "100755" if st.st_mode & 0o111 else "100644"
+            files[name] = (mode, "")
+            to_hash.append(name)
+    if to_hash:
+        # Hash the files as `git add` would, so that the result is the
+        # same whether or not a change has been added to the index.
+        try:
+            object_ids = subprocess.run(
+                ["git", "hash-object", "--stdin-paths"],
+                cwd=path,
+                input="".join(f"{name}\n" for name in to_hash).encode(),
+                capture_output=True,
+                check=True,
+            ).stdout.split()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        for name, raw_object_id in zip(to_hash, object_ids):
+            files[name] = (files[name][0], raw_object_id.decode())
+    return files
@@ -22,6 +22,7 @@ from craft_cli import (
 
 from lpci._version import version_description as lpci_version
 from lpci.commands.clean import CleanCommand
+from lpci.commands.pool import PoolCommand
 from lpci.commands.release import ReleaseCommand
 from lpci.commands.run import RunCommand, RunOneCommand
 from lpci.commands.version import VersionCommand
@@ -58,6 +59,7 @@ _configure_logger("craft_providers")
 
 _basic_commands = [
     CleanCommand,
+    PoolCommand,
     RunCommand,
     RunOneCommand,
     VersionCommand,
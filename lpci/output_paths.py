@@ -0,0 +1,155 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""Matching of files against the `output.paths` of a job."""
+
+__all__ = [
+    "OutputPathMatcher",
+]
+
+import fnmatch
+import re
+from pathlib import PurePath
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+# Characters with a special meaning in the patterns used by `find -path`.
+_GLOB_CHARACTERS = re.compile(r"([*?\[\\])")
+
+
+def _escape_glob(path: str) -> str:
+    """Escape a literal path for use in a `find -path` pattern."""
+    return _GLOB_CHARACTERS.sub(r"\\\1", path)
+
+
+def _has_wildcard(component: str) -> bool:
+    return "*" in component or "?" in component
+
+
+def _may_start_with(pattern: str, text: str) -> bool:
+    """Return True if `pattern` may match a string starting with `text`."""
+    for i, character in enumerate(text):
+        if i >= len(pattern):
+            return False
+        elif pattern[i] == "*":
+            return True
+        elif pattern[i] != "?" and pattern[i] != character:
+            return False
+    return True
+
+
+class OutputPathMatcher:
+    """Match paths against `fnmatch`-style patterns in a single pass.
+
+    Paths and patterns are relative to the build tree, and paths outside
+    the build tree start with `../`.  As with `fnmatch`, wildcards also
+    match `/`, so `*.whl` matches `dist/foo.whl`.
+
+    :param patterns: The patterns to match.
+    """
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        self.patterns = list(patterns)
+        self._regex = re.compile(
+            "|".join(
+                f"(?P<pattern{i}>{fnmatch.translate(pattern)})"
+                for i, pattern in enumerate(self.patterns)
+            )
+        )
+
+    def filter(self, paths: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """Filter paths by the patterns.
+
+        :return: A tuple of the paths that match any pattern, and the
+            patterns that match none of the paths.
+        """
+        if not self.patterns:
+            return [], []
+        matched = []
+        matched_groups = set()
+        for path in paths:
+            match = self._regex.match(path)
+            if match is not None:
+                matched.append(path)
+                matched_groups.add(match.lastgroup)
+        # Only the first matching pattern is recorded for each path, so
+        # check any remaining patterns against the (usually few) matching
+        # paths individually.
+        unmatched = [
+            pattern
+            for i, pattern in enumerate(self.patterns)
+            if f"pattern{i}" not in matched_groups
+            and not any(fnmatch.fnmatchcase(path, pattern) for path in matched)
+        ]
+        return matched, unmatched
+
+    def _get_find_pattern(
+        self, pattern: str, build_tree: PurePath
+    ) -> Optional[str]:
+        """Return a `find -path` pattern for files that may match `pattern`.
+
+        `find -path` treats `*` and `?` like `fnmatch` does, but matches
+        absolute paths rather than paths relative to the build tree, so
+        each pattern is anchored at the build tree or its parent.  The
+        result may match some files that `pattern` doesn't, but never
+        misses one that it does.
+
+        :return: The pattern, or None if it can't be expressed for `find`.
+        """
+        if "[" in pattern or "\\" in pattern:
+            return None
+        if pattern.startswith("../"):
+            return f"{_escape_glob(str(build_tree.parent))}/{pattern[3:]}"
+        stripped = pattern.lstrip("*")
+        if stripped != pattern:
+            # A leading `*` may also match the `../` of paths outside the
+            # build tree, which is only safe to ignore if the rest of the
+            # pattern can't match part of it.
+            if not stripped or any(
+                _may_start_with(stripped, text) for text in ("/", "./", "../")
+            ):
+                return None
+            return f"*{stripped}"
+        if _may_start_with(pattern, "../"):
+            return None
+        return f"{_escape_glob(str(build_tree))}/{pattern}"
+
+    def get_find_predicates(
+        self, build_tree: PurePath
+    ) -> Tuple[Optional[List[str]], Optional[List[str]]]:
+        """Return patterns for `find` to select files under `build_tree`.
+
+        :return: A tuple of `find -path` patterns matching the directories
+            that need to be searched, and `find -path` patterns matching
+            files that may match; either is None if all directories or
+            all files need to be considered.
+        """
+        find_patterns = []
+        for pattern in self.patterns:
+            find_pattern = self._get_find_pattern(pattern, build_tree)
+            if find_pattern is None:
+                return None, None
+            find_patterns.append(find_pattern)
+
+        directories: List[str] = []
+        root = _escape_glob(str(build_tree.parent))
+        for find_pattern in find_patterns:
+            components = find_pattern.split("/")[:-1]
+            # Only the literal leading directories of a pattern can be used
+            # to prune the search.
+            literal = []
+            for component in components:
+                if _has_wildcard(component):
+                    break
+                literal.append(component)
+            prefix = "/".join(literal)
+            if prefix == root or not prefix.startswith(root + "/"):
+                return None, find_patterns
+            # Search the ancestors of the prefix within the parent of the
+            # build tree, and anything below the prefix that the rest of
+            # the pattern might match.
+            depth = root.count("/") + 1
+            for i in range(depth + 1, len(literal) + 1):
+                directories.append("/".join(literal[:i]))
+            if _has_wildcard(find_pattern.split("/", len(literal))[-1]):
+                directories.append(f"{prefix}/*")
+        return sorted(set(directories)), find_patterns
@@ -0,0 +1,505 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""A caching HTTP proxy for the packages fetched by managed environments."""
+
+__all__ = [
+    "DEFAULT_PACKAGE_PROXY_SIZE",
+    "PackageProxy",
+    "PackageProxyStatistics",
+    "get_package_proxy_path",
+]
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from platformdirs import user_cache_path
+
+DEFAULT_PACKAGE_PROXY_SIZE = 4 * 1024 * 1024 * 1024
+
+# Package files and files fetched by hash never change once published, so
+# they are served from the cache without asking the upstream server.
+_IMMUTABLE_PATH = re.compile(r"(\.u?deb|\.ddeb|/by-hash/[^/]+/[^/]+)$")
+# Other files under `dists/` are archive indexes, which are revalidated
+# with the upstream server before being served from the cache, unless that
+# was done less than INDEX_MAX_AGE seconds ago.
+_INDEX_PATH = re.compile(r"/dists/")
+INDEX_MAX_AGE = 60
+
+# Response headers worth keeping with cached files.
+_CACHED_HEADERS = (
+    "Content-Encoding",
+    "Content-Type",
+    "ETag",
+    "Last-Modified",
+)
+# Headers that only apply to a single connection.
+_HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+# Request headers identifying a client to the upstream server.  Requests
+# carrying them may be for private content, so they are never cached.
+_CREDENTIAL_HEADERS = ("Authorization", "Cookie")
+_CHUNK_SIZE = 64 * 1024
+
+
+def get_package_proxy_path() -> Path:
+    """Return the path used to cache files fetched through the proxy."""
+    return user_cache_path("lpci") / "proxy"
+
+
+class PackageProxyStatistics(NamedTuple):
+    """How the requests made through a `PackageProxy` were served.
+
+    `hits` counts cacheable requests served from the cache (including
+    indexes that the upstream server confirmed to be unchanged), `misses`
+    counts cacheable requests fetched from the upstream server, and
+    `passed_through` counts other requests.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    passed_through: int = 0
+    bytes_from_cache: int = 0
+    bytes_from_upstream: int = 0
+
+
+class _ProxyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, proxy: "PackageProxy") -> None:
+        self.proxy = proxy
+        super().__init__(("127.0.0.1", 0), _ProxyRequestHandler)
+
+
+class _ProxyRequestHandler(BaseHTTPRequestHandler):
+    server: _ProxyServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.server.proxy._handle(self, cacheable=True)
+
+    def do_HEAD(self) -> None:
+        self.server.proxy._handle(self, cacheable=False)
+
+    def do_POST(self) -> None:
+        self.server.proxy._handle(self, cacheable=False)
+
+    def do_PUT(self) -> None:
+        self.server.proxy._handle(self, cacheable=False)
+
+    def do_DELETE(self) -> None:
+        self.server.proxy._handle(self, cacheable=False)
+
+    def do_CONNECT(self) -> None:
+        self.send_error(501, "CONNECT is not supported")
+
+
+class PackageProxy:
+    """An HTTP proxy that caches package archive downloads on disk.
+
+    Managed environments send their plain HTTP requests through the
+    proxy.  Package files and archive indexes (as fetched by `apt`) are
+    kept in a cache that persists between runs, and concurrent requests for
+    the same file are only fetched from the upstream server once; other
+    requests are passed through unchanged.  Requests to the upstream server
+    honour the host's own proxy settings.
+
+    Once the cached files take up more than `max_size` bytes, those used
+    least recently are pruned when the proxy is stopped.
+
+    :param path: The directory holding the cache.
+    :param max_size: The maximum total size of the cached files.
+    :param timeout: The timeout in seconds for upstream requests.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int = DEFAULT_PACKAGE_PROXY_SIZE,
+        timeout: float = 60,
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self._server: Optional[_ProxyServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._url_locks: Dict[str, Tuple[threading.Lock, int]] = {}
+        self._statistics = PackageProxyStatistics()
+
+    @property
+    def port(self) -> int:
+        """The port on which the proxy listens on the loopback interface."""
+        assert self._server is not None
+        return self._server.server_address[1]
+
+    @property
+    def statistics(self) -> PackageProxyStatistics:
+        """How the requests made through the proxy so far were served."""
+        with self._lock:
+            return self._statistics
+
+    def start(self) -> None:
+        """Start serving requests in a background thread."""
+        (self.path / "entries").mkdir(parents=True, exist_ok=True)
+        self._server = _ProxyServer(self)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"poll_interval": 0.1},
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving requests, and prune the cache."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.prune()
+
+    def __enter__(self) -> "PackageProxy":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def _count(self, **increments: int) -> None:
+        with self._lock:
+            self._statistics = self._statistics._replace(
+                **{
+                    name: getattr(self._statistics, name) + increment
+                    for name, increment in increments.items()
+                }
+            )
+
+    def _get_entry_path(self, url: str) -> Path:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return self.path / "entries" / key[:2] / key
+
+    def _lock_url(self, url: str) -> threading.Lock:
+        """Return the lock serializing fetches of `url`."""
+        with self._lock:
+            url_lock, users = self._url_locks.get(url, (threading.Lock(), 0))
+            self._url_locks[url] = (url_lock, users + 1)
+        url_lock.acquire()
+        return url_lock
+
+    def _unlock_url(self, url: str, url_lock: threading.Lock) -> None:
+        url_lock.release()
+        with self._lock:
+            _, users = self._url_locks[url]
+            if users == 1:
+                del self._url_locks[url]
+            else:
+                self._url_locks[url] = (url_lock, users - 1)
+
+    def _load_metadata(self, entry_path: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(entry_path.with_suffix(".json")) as f:
+                metadata: Dict[str, Any] = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not entry_path.is_file():
+            return None
+        return metadata
+
+    def _save_metadata(
+        self, entry_path: Path, metadata: Dict[str, Any]
+    ) -> None:
+        fd, temporary_name = tempfile.mkstemp(
+            prefix=".tmp-", dir=entry_path.parent
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(metadata, f)
+        os.replace(temporary_name, entry_path.with_suffix(".json"))
+
+    def _handle(self, handler: _ProxyRequestHandler, cacheable: bool) -> None:
+        url = handler.path
+        parsed = urlparse(url)
+        if parsed.scheme != "http" or not parsed.netloc:
+            handler.send_error(400, "Only absolute http URLs are supported")
+            return
+        immutable = bool(_IMMUTABLE_PATH.search(parsed.path))
+        if (
+            not cacheable
+            or not (immutable or _INDEX_PATH.search(parsed.path))
+            or parsed.username is not None
+            or any(name in handler.headers for name in _CREDENTIAL_HEADERS)
+        ):
+            self._pass_through(handler)
+            return
+
+        url_lock = self._lock_url(url)
+        try:
+            entry_path = self._get_entry_path(url)
+            metadata = self._load_metadata(entry_path)
+            if metadata is not None and (
+                immutable
+                or time.time() - metadata["validated"] < INDEX_MAX_AGE
+            ):
+                self._serve_cached(handler, entry_path, metadata)
+                return
+            self._fetch(handler, url, entry_path, metadata)
+        finally:
+            self._unlock_url(url, url_lock)
+
+    def _get_request_headers(
+        self, handler: _ProxyRequestHandler
+    ) -> Dict[str, str]:
+        return {
+            name: value
+            for name, value in handler.headers.items()
+            if name.lower() not in _HOP_BY_HOP_HEADERS
+        }
+
+    def _send_headers(
+        self,
+        handler: _ProxyRequestHandler,
+        status: int,
+        headers: Dict[str, str],
+        content_length: Optional[int],
+    ) -> None:
+        handler.send_response(status)
+        for name, value in headers.items():
+            if name.lower() not in _HOP_BY_HOP_HEADERS | {"content-length"}:
+                handler.send_header(name, value)
+        if content_length is not None:
+            handler.send_header("Content-Length", str(content_length))
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+
+    def _serve_cached(
+        self,
+        handler: _ProxyRequestHandler,
+        entry_path: Path,
+        metadata: Dict[str, Any],
+    ) -> None:
+        headers: Dict[str, str] = metadata["headers"]
+        # Record that the entry has been used recently.
+        os.utime(entry_path)
+        if (
+            "ETag" in headers
+            and handler.headers.get("If-None-Match") == headers["ETag"]
+        ) or (
+            "Last-Modified" in headers
+            and handler.headers.get("If-Modified-Since")
+            == headers["Last-Modified"]
+        ):
+            self._count(hits=1)
+            self._send_headers(handler, 304, headers, None)
+            return
+        size = entry_path.stat().st_size
+        self._count(hits=1, bytes_from_cache=size)
+        self._send_headers(handler, 200, headers, size)
+        if handler.command != "HEAD":
+            with open(entry_path, "rb") as f:
+                try:
+                    shutil.copyfileobj(f, handler.wfile)
+                except OSError:
+                    pass
+
+    def _fetch(
+        self,
+        handler: _ProxyRequestHandler,
+        url: str,
+        entry_path: Path,
+        metadata: Optional[Dict[str, Any]],
+    ) -> None:
+        """Fetch a cacheable file, storing it while sending it on."""
+        headers = {"Accept-Encoding": "identity"}
+        if metadata is not None:
+            cached_headers = metadata["headers"]
+            if "ETag" in cached_headers:
+                headers["If-None-Match"] = cached_headers["ETag"]
+            if "Last-Modified" in cached_headers:
+                headers["If-Modified-Since"] = cached_headers["Last-Modified"]
+        try:
+            response = requests.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            )
+        except requests.RequestException as error:
+            if metadata is not None:
+                # Better a stale index than none at all.
+                self._serve_cached(handler, entry_path, metadata)
+            else:
+                handler.send_error(502, str(error))
+            return
+        with response:
+            if response.status_code == 304 and metadata is not None:
+                metadata["validated"] = time.time()
+                self._save_metadata(entry_path, metadata)
+                self._serve_cached(handler, entry_path, metadata)
+                return
+            if response.status_code != 200:
+                self._count(passed_through=1)
+                self._relay(handler, response)
+                return
+            self._count(misses=1)
+            self._store(handler, url, response, entry_path)
+
+    def _store(
+        self,
+        handler: _ProxyRequestHandler,
+        url: str,
+        response: requests.Response,
+        entry_path: Path,
+    ) -> None:
+        cached_headers = {
+            name: response.headers[name]
+            for name in _CACHED_HEADERS
+            if name in response.headers
+        }
+        content_length = response.headers.get("Content-Length")
+        self._send_headers(
+            handler,
+            200,
+            cached_headers,
+            int(content_length) if content_length is not None else None,
+        )
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temporary_name = tempfile.mkstemp(
+            prefix=".tmp-", dir=entry_path.parent
+        )
+        client_connected = True
+        size = 0
+        # Hold back the last chunk until the file is in the cache, so that
+        # the file is always there once the client has all of it.
+        pending = b""
+
+        def send(chunk: bytes) -> None:
+            nonlocal client_connected
+            if client_connected and chunk:
+                try:
+                    handler.wfile.write(chunk)
+                except OSError:
+                    # Carry on filling the cache for later requests.
+                    client_connected = False
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in self._iter_raw(response):
+                    f.write(chunk)
+                    size += len(chunk)
+                    self._count(bytes_from_upstream=len(chunk))
+                    send(pending)
+                    pending = chunk
+            if content_length is not None and size != int(content_length):
+                raise OSError("Truncated response")
+            os.replace(temporary_name, entry_path)
+            self._save_metadata(
+                entry_path,
+                {
+                    "url": url,
+                    "headers": cached_headers,
+                    "validated": time.time(),
+                },
+            )
+        except (OSError, requests.RequestException):
+            pass
+        finally:
+            if os.path.exists(temporary_name):
+                os.unlink(temporary_name)
+            send(pending)
+
+    def _iter_raw(self, response: requests.Response) -> Iterator[bytes]:
+        # Keep the content exactly as sent, since clients check digests of
+        # files rather than of their decoded contents.
+        return response.raw.stream(_CHUNK_SIZE, decode_content=False)
+
+    def _relay(
+        self, handler: _ProxyRequestHandler, response: requests.Response
+    ) -> None:
+        content_length = response.headers.get("Content-Length")
+        self._send_headers(
+            handler,
+            response.status_code,
+            dict(response.headers),
+            int(content_length) if content_length is not None else None,
+        )
+        if handler.command == "HEAD":
+            return
+        try:
+            for chunk in self._iter_raw(response):
+                self._count(bytes_from_upstream=len(chunk))
+                handler.wfile.write(chunk)
+        except (OSError, requests.RequestException):
+            pass
+
+    def _pass_through(self, handler: _ProxyRequestHandler) -> None:
+        """Forward an uncacheable request to the upstream server."""
+        body = None
+        length = handler.headers.get("Content-Length")
+        if length is not None:
+            body = handler.rfile.read(int(length))
+        try:
+            response = requests.request(
+                handler.command,
+                handler.path,
+                headers=self._get_request_headers(handler),
+                data=body,
+                stream=True,
+                allow_redirects=False,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as error:
+            handler.send_error(502, str(error))
+            return
+        self._count(passed_through=1)
+        with response:
+            self._relay(handler, response)
+
+    def prune(self) -> List[str]:
+        """Prune the least recently used files until the cache fits.
+
+        :return: The URLs of the pruned files.
+        """
+        entries = []
+        for entry_path in (self.path / "entries").glob("*/*.json"):
+            data_path = entry_path.with_suffix("")
+            try:
+                stat = data_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, data_path, stat.st_size))
+        total = sum(size for _, _, size in entries)
+        pruned = []
+        for _, data_path, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            metadata = self._load_metadata(data_path)
+            for path in (data_path.with_suffix(".json"), data_path):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+            if metadata is not None:
+                pruned.append(metadata["url"])
+        return pruned
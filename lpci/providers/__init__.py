@@ -2,14 +2,24 @@
 # GNU General Public License version 3 (see the file LICENSE).
 
 __all__ = [
+    "PROJECT_SYNC_MODES",
     "Provider",
     "get_provider",
 ]
 
-from lpci.providers._base import Provider
+import os
+
+from lpci.providers._base import PROJECT_SYNC_MODES, Provider
 from lpci.providers._lxd import LXDProvider
+from lpci.providers._lxd_api import LXDAPIClient, find_lxd_socket
 
 
 def get_provider() -> Provider:
     """Get the configured or appropriate provider for the host OS."""
+    if os.environ.get("LPCI_LXD_API") == "1":
+        # Talk to the LXD daemon directly if asked to, rather than running
+        # `lxc` for every operation.
+        socket_path = find_lxd_socket()
+        if socket_path is not None:
+            return LXDProvider(lxc=LXDAPIClient(socket_path))
     return LXDProvider()
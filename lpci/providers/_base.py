@@ -4,19 +4,27 @@
 """Build environment provider support for lpci."""
 
 __all__ = [
+    "PROJECT_SYNC_MODES",
     "Provider",
 ]
 
+import hashlib
 import os
 import re
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
-from pathlib import Path
-from typing import Dict, Generator, List, Optional
+from pathlib import Path, PurePath
+from typing import Dict, Generator, List, Optional, Sequence
 
 from craft_providers import bases, lxd
 from pydantic import StrictStr
 
+# Ways of making the project available in a managed environment: "copy"
+# copies the whole project afresh for each job, "incremental" keeps a copy
+# in the environment and only transfers files that have changed, and
+# "overlay" mounts a writable overlay over a read-only mount of the project.
+PROJECT_SYNC_MODES = ("copy", "incremental", "overlay")
+
 
 def sanitize_lxd_instance_name(name: str) -> str:
     """LXD instance names need to follow a certain pattern.
@@ -30,9 +38,24 @@ def sanitize_lxd_instance_name(name: str) -> str:
     return name[:63]
 
 
+def _get_job_instance_suffix(job_name: str, job_index: int) -> str:
+    """Return an instance name suffix identifying a single job.
+
+    The suffix is kept short and hashed so that it survives truncation of
+    long instance names.
+    """
+    job_id = f"{job_name}/{job_index}".encode()
+    return hashlib.sha256(job_id).hexdigest()[:8]
+
+
 class Provider(ABC):
     """A build environment provider for lpci."""
 
+    # If set, launched environments send their HTTP requests through a
+    # caching proxy listening on this port on the host's loopback interface
+    # (see `lpci.package_proxy`).
+    package_proxy_port: Optional[int] = None
+
     @abstractmethod
     def clean_project_environments(
         self,
@@ -74,6 +97,8 @@ class Provider(ABC):
         project_path: Path,
         series: str,
         architecture: str,
+        job_name: Optional[str] = None,
+        job_index: Optional[int] = None,
     ) -> str:
         """Get the name for an instance using the given parameters.
 
@@ -81,15 +106,31 @@ class Provider(ABC):
         :param project_path: Path to project.
         :param series: Distribution series name.
         :param architecture: Targeted architecture name.
+        :param job_name: If given, the name of the job that the instance is
+            dedicated to.
+        :param job_index: The index of that job (defaults to 0).
         """
         name = (
             f"lpci-{project_name}-{project_path.stat().st_ino}"
             f"-{series}-{architecture}"
         )
-        return sanitize_lxd_instance_name(name)
+        if job_name is None:
+            return sanitize_lxd_instance_name(name)
+        suffix = _get_job_instance_suffix(job_name, job_index or 0)
+        return (
+            sanitize_lxd_instance_name(name)[: 63 - len(suffix) - 1]
+            + f"-{suffix}"
+        )
+
+    def get_command_environment(
+        self, package_proxy: bool = False
+    ) -> Dict[str, Optional[str]]:
+        """Construct the required environment.
 
-    def get_command_environment(self) -> Dict[str, Optional[str]]:
-        """Construct the required environment."""
+        :param package_proxy: If True and `package_proxy_port` is set,
+            direct HTTP requests to the package proxy on that port, which
+            must already be reachable from the environment.
+        """
         env = bases.buildd.default_command_environment()
 
         # Pass through host environment that target may need.
@@ -97,6 +138,9 @@ class Provider(ABC):
             if env_key in os.environ:
                 env[env_key] = os.environ[env_key]
 
+        if package_proxy and self.package_proxy_port is not None:
+            env["http_proxy"] = f"http://127.0.0.1:{self.package_proxy_port}"
+
         return env
 
     @abstractmethod
@@ -110,6 +154,12 @@ class Provider(ABC):
         architecture: str,
         gpu_nvidia: bool = False,
         root: bool = False,
+        job_name: Optional[str] = None,
+        job_index: Optional[int] = None,
+        setup_snapshot: Optional[str] = None,
+        instance_name: Optional[str] = None,
+        project_sync: str = "copy",
+        project_ignore_files: Sequence[str] = (),
     ) -> Generator[lxd.LXDInstance, None, None]:
         """Launch environment for specified series and architecture.
 
@@ -119,4 +169,131 @@ class Provider(ABC):
         :param architecture: Targeted architecture name.
         :param gpu_nvidia: If True, pass through an NVIDIA GPU from the host
             to the environment.
+        :param job_name: If given, launch an instance dedicated to this job
+            rather than one shared by all jobs for the same series and
+            architecture.
+        :param job_index: The index of that job.
+        :param setup_snapshot: If given, restore the instance from the
+            snapshot saved with this key by `save_setup_snapshot`, if any,
+            before copying the project into it.  If there is no such
+            snapshot, then the project is only copied in once
+            `save_setup_snapshot` has been called.
+        :param instance_name: If given, use this instance (for example, one
+            claimed from the pool) rather than one named after the project.
+        :param project_sync: How to make the project available in the
+            instance; one of `PROJECT_SYNC_MODES`.
+        :param project_ignore_files: Names of files in the project listing
+            paths not to copy into the instance, in the syntax of
+            `.gitignore`.
+        """
+
+    @abstractmethod
+    def has_setup_snapshot(
+        self, instance: lxd.LXDInstance, setup_snapshot: str
+    ) -> bool:
+        """Check whether an instance was restored from a setup snapshot.
+
+        :param instance: The instance.
+        :param setup_snapshot: The key identifying the setup snapshot.
+
+        :return: True if the instance is in the state saved with this key.
+        """
+
+    @abstractmethod
+    def save_setup_snapshot(
+        self, instance: lxd.LXDInstance, setup_snapshot: str
+    ) -> None:
+        """Save the current state of an instance for reuse by later runs.
+
+        Only one setup snapshot is kept for each instance.  The snapshot
+        does not include the project or any mounts, which are only added
+        to the instance afterwards.
+
+        :param instance: The instance.
+        :param setup_snapshot: A key identifying how the instance was set
+            up.
+        """
+
+    @abstractmethod
+    def mount_read_only(
+        self,
+        instance: lxd.LXDInstance,
+        *,
+        host_source: Path,
+        target: PurePath,
+    ) -> None:
+        """Mount a host directory read-only in a launched environment.
+
+        The mount is removed when the environment is torn down.
+
+        :param instance: The instance.
+        :param host_source: The absolute path of the directory on the host.
+        :param target: The path at which to mount it in the instance.
+        """
+
+    @abstractmethod
+    def mount_apt_cache(
+        self,
+        instance: lxd.LXDInstance,
+        *,
+        archives_path: Path,
+        lists_path: Optional[Path] = None,
+    ) -> None:
+        """Mount host directories as apt's caches in a launched environment.
+
+        The mounts are removed when the environment is torn down.
+
+        :param instance: The instance.
+        :param archives_path: The directory on the host to use as
+            `/var/cache/apt/archives`.
+        :param lists_path: If given, the directory on the host to use as
+            `/var/lib/apt/lists`.
+        """
+
+    @abstractmethod
+    def fill_pool(
+        self, *, series: str, architecture: str, size: int
+    ) -> List[str]:
+        """Launch environments until the pool has `size` for this series.
+
+        Pooled environments are not tied to any project.  Each is launched
+        and configured ahead of time, so that jobs can start in it quickly.
+
+        :param series: Distribution series name.
+        :param architecture: Targeted architecture name.
+        :param size: The number of environments to keep in the pool.
+
+        :return: List of instances launched.
+        """
+
+    @abstractmethod
+    def claim_pool_instance(
+        self, *, series: str, architecture: str
+    ) -> Optional[str]:
+        """Claim a ready environment from the pool.
+
+        :param series: Distribution series name.
+        :param architecture: Targeted architecture name.
+
+        :return: The name of the claimed instance, or None if no pooled
+            environment is ready.
+        """
+
+    @abstractmethod
+    def release_pool_instance(self, instance_name: str) -> None:
+        """Return a claimed environment to the pool.
+
+        The environment is reset to its pristine state in the background,
+        and becomes ready to be claimed again once that has finished.  If
+        that fails, the environment is deleted instead, so that `fill_pool`
+        can replace it.
+
+        :param instance_name: The name of the claimed instance.
+        """
+
+    @abstractmethod
+    def clean_pool(self) -> List[str]:
+        """Delete all the environments in the pool.
+
+        :return: List of instances deleted.
         """
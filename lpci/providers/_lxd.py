@@ -7,14 +7,33 @@ __all__ = [
     "LXDProvider",
 ]
 
+import fcntl
+import functools
+import os
 import re
+import shlex
 import subprocess
+import tempfile
+import threading
 from contextlib import contextmanager
-from pathlib import Path
-from typing import Any, Generator, List, Optional, Protocol
+from pathlib import Path, PurePath
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Protocol,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from craft_cli import emit
 from craft_providers import Base, bases, lxd
+from craft_providers.lxd.remotes import RemoteImage
+from platformdirs import user_state_path
 from pydantic import StrictStr
 
 from lpci.env import (
@@ -28,10 +47,48 @@ from lpci.providers._buildd import (
     SERIES_TO_BUILDD_IMAGE_ALIAS,
     LPCIBuilddBaseConfiguration,
 )
+from lpci.providers._script import SetupScript
+from lpci.providers._sync import (
+    FIND_ENTRIES_FORMAT,
+    FileEntry,
+    IgnoreRules,
+    get_changes,
+    get_host_entries,
+    has_ignore_files,
+    parse_instance_entries,
+    write_tar,
+)
 from lpci.utils import ask_user
 
 _lxc_client = lxd.LXC()
 
+# Each instance keeps at most one snapshot of its state after installing
+# the snaps and packages needed by its job, along with a key identifying
+# that set-up in the instance's configuration.
+_SETUP_SNAPSHOT_NAME = "lpci-setup"
+_PACKAGE_PROXY_DEVICE = "lpci-package-proxy"
+_SETUP_SNAPSHOT_CONFIG_KEY = "user.lpci.setup-snapshot"
+
+# Pooled instances are snapshotted once they are ready, with their state
+# recorded in their configuration.  Restoring that snapshot after a job
+# resets an instance and marks it as ready again in one step.
+_POOL_SNAPSHOT_NAME = "lpci-pool-base"
+_POOL_STATE_CONFIG_KEY = "user.lpci.pool-state"
+
+
+def _get_pool_instance_prefix(series: str, architecture: str) -> str:
+    return sanitize_lxd_instance_name(f"lpci-pool-{series}-{architecture}-")
+
+
+@contextmanager
+def _pool_lock() -> Generator[None, None, None]:
+    """Serialize claims of pooled instances by concurrent `lpci` processes."""
+    lock_path = user_state_path("lpci") / "pool.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
 
 class _LXDInstaller(Protocol):
     def install(self) -> str:
@@ -110,6 +167,15 @@ class LXDProvider(Provider):
         self.lxd_launcher = lxd_launcher
         self.lxd_project = lxd_project
         self.lxd_remote = lxd_remote
+        # The LXD setup shared by all instances only needs to be done once
+        # per provider, but jobs may be launched from several threads.
+        self._setup_lock = threading.Lock()
+        self._added_image_remotes: Set[str] = set()
+        self._project_exists = False
+        self._profile_gpu_nvidia: Optional[bool] = None
+        # Instances whose project is held back until their setup snapshot
+        # is saved, mapped to how to make the project available.
+        self._pending_projects: Dict[str, Callable[[], None]] = {}
 
     def clean_project_environments(
         self,
@@ -239,77 +305,633 @@ class LXDProvider(Provider):
             **kwargs,
         )
 
-    def _set_up_non_root_user(
+    def _run_lxc(
+        self, command: List[str], check: bool = True
+    ) -> subprocess.CompletedProcess:  # type: ignore[type-arg]
+        """Run an `lxc` command that craft-providers does not wrap."""
+        return self.lxc._run_lxc(
+            command, check=check, capture_output=True, project=self.lxd_project
+        )
+
+    def _list_instance_names(self) -> List[str]:
+        try:
+            return self.lxc.list_names(
+                project=self.lxd_project, remote=self.lxd_remote
+            )
+        except lxd.LXDError as error:
+            raise CommandError(str(error)) from error
+
+    def _config_get(self, instance_name: str, key: str) -> str:
+        try:
+            return self.lxc.config_get(
+                instance_name=instance_name,
+                key=key,
+                project=self.lxd_project,
+                remote=self.lxd_remote,
+            )
+        except lxd.LXDError as error:
+            raise CommandError(str(error)) from error
+
+    def _config_set(self, instance_name: str, key: str, value: str) -> None:
+        try:
+            self.lxc.config_set(
+                instance_name=instance_name,
+                key=key,
+                value=value,
+                project=self.lxd_project,
+                remote=self.lxd_remote,
+            )
+        except lxd.LXDError as error:
+            raise CommandError(str(error)) from error
+
+    def _get_setup_snapshot(self, instance_name: str) -> str:
+        return self._config_get(instance_name, _SETUP_SNAPSHOT_CONFIG_KEY)
+
+    def _set_setup_snapshot(
+        self, instance_name: str, setup_snapshot: str
+    ) -> None:
+        self._config_set(
+            instance_name, _SETUP_SNAPSHOT_CONFIG_KEY, setup_snapshot
+        )
+
+    def _restore_setup_snapshot(
         self,
         instance: lxd.LXDInstance,
         instance_name: str,
-    ) -> None:
+        base_configuration: LPCIBuilddBaseConfiguration,
+        setup_snapshot: str,
+    ) -> bool:
+        """Restore an instance from its setup snapshot, if it matches.
 
-        default_user = get_non_root_user()
-        create_cmd = "getent passwd " + default_user + " >/dev/null"
-        create_cmd += " || useradd -m -U " + default_user
+        :return: True if the instance was restored.
+        """
+        if self._get_setup_snapshot(instance_name) != setup_snapshot:
+            return False
+        emit.progress("Restoring environment from setup snapshot")
+        try:
+            self._run_lxc(
+                [
+                    "restore",
+                    f"{self.lxd_remote}:{instance_name}",
+                    _SETUP_SNAPSHOT_NAME,
+                ]
+            )
+        except subprocess.CalledProcessError as error:
+            # Fall back to setting up the environment from scratch.
+            emit.trace(f"Failed to restore setup snapshot: {error.stderr!r}")
+            self._set_setup_snapshot(instance_name, "")
+            return False
+        # The restored configuration predates recording the key.
+        self._set_setup_snapshot(instance_name, setup_snapshot)
+        try:
+            base_configuration.wait_until_ready(executor=instance)
+        except bases.BaseConfigurationError as error:
+            raise CommandError(str(error)) from error
+        return True
 
-        # Create default user if doesn't exist.
-        self._internal_execute_run(
-            instance, instance_name, ["sh", "-c", create_cmd], check=True
+    def has_setup_snapshot(
+        self, instance: lxd.LXDInstance, setup_snapshot: str
+    ) -> bool:
+        """See `Provider.has_setup_snapshot`."""
+        return (
+            self._get_setup_snapshot(instance.instance_name) == setup_snapshot
         )
 
-        # Give ownership of the project directory to _lpci
-        self._internal_execute_run(
-            instance,
-            instance_name,
+    def save_setup_snapshot(
+        self, instance: lxd.LXDInstance, setup_snapshot: str
+    ) -> None:
+        """See `Provider.save_setup_snapshot`."""
+        instance_name = instance.instance_name
+        make_project_available = self._pending_projects.pop(
+            instance_name, None
+        )
+        if make_project_available is not None:
+            # Leave the devices attached for this run, such as apt's caches
+            # and the package proxy, out of the snapshot.
+            try:
+                instance.unmount_all()
+            except lxd.LXDError as error:
+                raise CommandError(str(error)) from error
+            if self.package_proxy_port is not None:
+                self._detach_package_proxy(instance_name)
+        self._save_setup_snapshot(instance_name, setup_snapshot)
+        if make_project_available is not None:
+            if self.package_proxy_port is not None:
+                self._attach_package_proxy(instance, instance_name)
+            make_project_available()
+
+    def _save_setup_snapshot(
+        self, instance_name: str, setup_snapshot: str
+    ) -> None:
+        emit.progress("Saving setup snapshot")
+        self._run_lxc(
             [
-                "chown",
-                "-R",
-                f"{default_user}:{default_user}",
-                str(get_managed_environment_project_path()),
+                "delete",
+                f"{self.lxd_remote}:{instance_name}/{_SETUP_SNAPSHOT_NAME}",
             ],
-            check=True,
+            check=False,
         )
+        try:
+            self._run_lxc(
+                [
+                    "snapshot",
+                    f"{self.lxd_remote}:{instance_name}",
+                    _SETUP_SNAPSHOT_NAME,
+                ]
+            )
+        except subprocess.CalledProcessError as error:
+            # The snapshot is only an optimization, so carry on without it.
+            emit.trace(f"Failed to save setup snapshot: {error.stderr!r}")
+            return
+        self._set_setup_snapshot(instance_name, setup_snapshot)
 
-    @contextmanager
-    def launched_environment(
+    def mount_read_only(
         self,
+        instance: lxd.LXDInstance,
         *,
-        project_name: str,
-        project_path: Path,
-        series: str,
-        architecture: str,
-        gpu_nvidia: bool = False,
-        root: bool = True,
-    ) -> Generator[lxd.LXDInstance, None, None]:
-        """Launch environment for specified series and architecture.
+        host_source: Path,
+        target: PurePath,
+    ) -> None:
+        """See `Provider.mount_read_only`."""
+        try:
+            self._add_read_only_mount(
+                instance, instance.instance_name, host_source, target
+            )
+        except subprocess.CalledProcessError as error:
+            stderr = error.stderr.decode(errors="replace").strip()
+            raise CommandError(
+                f"Failed to mount {str(host_source)!r} at "
+                f"{target.as_posix()!r}: {stderr}"
+            ) from error
 
-        :param project_name: Name of project.
-        :param project_path: Path to project.
-        :param series: Distribution series name.
-        :param architecture: Targeted architecture name.
-        """
-        alias = SERIES_TO_BUILDD_IMAGE_ALIAS[series]
-        instance_name = self.get_instance_name(
-            project_name=project_name,
-            project_path=project_path,
-            series=series,
-            architecture=architecture,
-        )
-        environment = self.get_command_environment()
+    def mount_apt_cache(
+        self,
+        instance: lxd.LXDInstance,
+        *,
+        archives_path: Path,
+        lists_path: Optional[Path] = None,
+    ) -> None:
+        """See `Provider.mount_apt_cache`."""
+        mounts = [(archives_path, PurePath("/var/cache/apt/archives"))]
+        if lists_path is not None:
+            mounts.append((lists_path, PurePath("/var/lib/apt/lists")))
         try:
-            image_remote = lxd.get_remote_image(alias.value)
+            for host_source, target in mounts:
+                instance.mount(host_source=host_source, target=target)
         except lxd.LXDError as error:
             raise CommandError(str(error)) from error
-        # XXX 2023-03-10 jugmac00: The following line is not explicitly covered
-        # by our test suite. We probably need to add something like
-        # `mock_lxd.get_remote_image` and then assert on `add_remote` being
-        # called.
-        image_remote.add_remote(lxc=self.lxc)
-        base_configuration = LPCIBuilddBaseConfiguration(
-            alias=alias, environment=environment, hostname=instance_name
+
+    def fill_pool(
+        self, *, series: str, architecture: str, size: int
+    ) -> List[str]:
+        """See `Provider.fill_pool`."""
+        prefix = _get_pool_instance_prefix(series, architecture)
+        existing = set(self._list_instance_names())
+        launched: List[str] = []
+        for index in range(size):
+            instance_name = f"{prefix}{index}"
+            if instance_name in existing:
+                continue
+            emit.progress(f"Launching pooled environment {instance_name!r}")
+            instance, _ = self._launch(
+                instance_name=instance_name, series=series
+            )
+            self._config_set(instance_name, _POOL_STATE_CONFIG_KEY, "ready")
+            try:
+                self._run_lxc(
+                    [
+                        "snapshot",
+                        f"{self.lxd_remote}:{instance_name}",
+                        _POOL_SNAPSHOT_NAME,
+                    ]
+                )
+            except subprocess.CalledProcessError as error:
+                raise CommandError(str(error)) from error
+            launched.append(instance_name)
+        return launched
+
+    def claim_pool_instance(
+        self, *, series: str, architecture: str
+    ) -> Optional[str]:
+        """See `Provider.claim_pool_instance`."""
+        prefix = _get_pool_instance_prefix(series, architecture)
+        with _pool_lock():
+            for instance_name in sorted(self._list_instance_names()):
+                if not instance_name.startswith(prefix):
+                    continue
+                state = self._config_get(instance_name, _POOL_STATE_CONFIG_KEY)
+                if state == "ready":
+                    self._config_set(
+                        instance_name, _POOL_STATE_CONFIG_KEY, "claimed"
+                    )
+                    emit.trace(
+                        f"Claimed pooled environment {instance_name!r}."
+                    )
+                    return instance_name
+        return None
+
+    def release_pool_instance(self, instance_name: str) -> None:
+        """See `Provider.release_pool_instance`."""
+        self._config_set(instance_name, _POOL_STATE_CONFIG_KEY, "recycling")
+        lxc = shlex.join(
+            [str(self.lxc.lxc_path), "--project", self.lxd_project]
+        )
+        target = shlex.quote(f"{self.lxd_remote}:{instance_name}")
+        failed = shlex.quote(
+            f"Failed to reset pooled environment {instance_name!r}; "
+            f"deleting it."
+        )
+        log_path = user_state_path("lpci") / "pool" / f"{instance_name}.log"
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        emit.trace(
+            f"Resetting pooled environment {instance_name!r} in the "
+            f"background; see {str(log_path)!r}."
         )
+        # Restoring the snapshot also restores the "ready" state.  Don't
+        # wait for this, so that the caller can move on to its next job.
+        # An instance that can't be reset is deleted rather than left in
+        # the "recycling" state, so that `fill_pool` replaces it.
+        with open(log_path, "wb") as log:
+            subprocess.Popen(
+                [
+                    "sh",
+                    "-c",
+                    f"{lxc} restore {target} {_POOL_SNAPSHOT_NAME} && "
+                    f"{lxc} start {target} || "
+                    f"{{ echo {failed}; {lxc} delete --force {target}; }}",
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+                start_new_session=True,
+            )
 
-        if self.lxd_project not in self.lxc.project_list(self.lxd_remote):
-            self.lxc.project_create(
-                project=self.lxd_project, remote=self.lxd_remote
+    def clean_pool(self) -> List[str]:
+        """See `Provider.clean_pool`."""
+        deleted: List[str] = []
+        for instance_name in self._list_instance_names():
+            if not instance_name.startswith("lpci-pool-"):
+                continue
+            emit.trace(f"Deleting container {instance_name!r}.")
+            try:
+                self.lxc.delete(
+                    instance_name=instance_name,
+                    force=True,
+                    project=self.lxd_project,
+                    remote=self.lxd_remote,
+                )
+            except lxd.LXDError as error:
+                raise CommandError(str(error)) from error
+            deleted.append(instance_name)
+        return deleted
+
+    def _run_setup_script(
+        self,
+        instance: lxd.LXDInstance,
+        instance_name: str,
+        script: SetupScript,
+    ) -> bytes:
+        """Run a setup script in a single `exec`.
+
+        :return: The output of the steps of the script that keep it.
+        :raises CommandError: if any step of the script fails.
+        """
+        try:
+            proc = self._internal_execute_run(
+                instance,
+                instance_name,
+                script.render(),
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError as error:
+            raise script.get_error(
+                error.returncode, error.stderr.decode(errors="replace")
+            ) from error
+        output: bytes = proc.stdout
+        return output
+
+    def _add_copy_steps(
+        self, script: SetupScript, source_path: Path, owner: str
+    ) -> None:
+        """Add steps copying the project from a mount in the instance."""
+        managed_project_path = get_managed_environment_project_path()
+        script.add(
+            "remove the old project",
+            ["rm", "-rf", managed_project_path.as_posix()],
+        )
+        if owner == "root":
+            script.add(
+                "create the project directory",
+                ["mkdir", "-p", managed_project_path.parent.as_posix()],
+            )
+            script.add(
+                "copy the project",
+                [
+                    "cp",
+                    "-a",
+                    source_path.as_posix(),
+                    managed_project_path.as_posix(),
+                ],
+            )
+        else:
+            script.add(
+                "create the project directory",
+                ["mkdir", "-p", managed_project_path.as_posix()],
+            )
+            # Copy through tar so that the copy is owned by `owner` from
+            # the start, rather than changing its ownership afterwards.
+            script.add(
+                "copy the project",
+                [
+                    "tar",
+                    "-c",
+                    "-f",
+                    "-",
+                    f"--owner={owner}",
+                    f"--group={owner}",
+                    "-C",
+                    source_path.as_posix(),
+                    ".",
+                ],
+                [
+                    "tar",
+                    "-x",
+                    "-f",
+                    "-",
+                    "-C",
+                    managed_project_path.as_posix(),
+                ],
+            )
+
+    def _sync_project(
+        self,
+        instance: lxd.LXDInstance,
+        instance_name: str,
+        project_path: Path,
+        host_entries: Dict[str, FileEntry],
+        instance_entries: Dict[str, FileEntry],
+        owner: str,
+    ) -> None:
+        """Copy the project into the instance by streaming it over `exec`.
+
+        Only files whose entries differ between `host_entries` and
+        `instance_entries` (or that were added or removed) are transferred.
+        """
+        managed_project_path = get_managed_environment_project_path()
+        to_delete, to_copy = get_changes(host_entries, instance_entries)
+        emit.trace(
+            f"Synchronizing project: deleting {len(to_delete)} paths and "
+            f"copying {len(to_copy)} paths."
+        )
+        if to_delete:
+            self._internal_execute_run(
+                instance,
+                instance_name,
+                ["xargs", "-0", "rm", "-rf", "--"],
+                cwd=managed_project_path.as_posix(),
+                input=b"".join(
+                    os.fsencode(path) + b"\0" for path in to_delete
+                ),
+                check=True,
+            )
+        if to_copy:
+            with tempfile.TemporaryFile() as stderr:
+                tar = instance.lxc.exec(
+                    instance_name=instance_name,
+                    command=[
+                        "tar",
+                        "-x",
+                        "-f",
+                        "-",
+                        "-C",
+                        managed_project_path.as_posix(),
+                    ],
+                    project=self.lxd_project,
+                    remote=self.lxd_remote,
+                    runner=subprocess.Popen,
+                    stdin=subprocess.PIPE,
+                    stderr=stderr,
+                )
+                try:
+                    write_tar(tar.stdin, project_path, to_copy, owner=owner)
+                except BrokenPipeError:
+                    # tar exited early; its error output explains why.
+                    pass
+                finally:
+                    try:
+                        tar.stdin.close()
+                    except BrokenPipeError:
+                        pass
+                returncode = tar.wait()
+                if returncode != 0:
+                    stderr.seek(0)
+                    raise CommandError(
+                        f"Failed to copy the project into {instance_name!r} "
+                        f"(exit status {returncode}): "
+                        f"{stderr.read().decode(errors='replace').strip()}"
+                    )
+
+    def _add_read_only_mount(
+        self,
+        instance: lxd.LXDInstance,
+        instance_name: str,
+        host_source: Path,
+        target: PurePath,
+    ) -> None:
+        # craft-providers cannot add read-only mounts.
+        if not instance.is_mounted(host_source=host_source, target=target):
+            self._run_lxc(
+                [
+                    "config",
+                    "device",
+                    "add",
+                    f"{self.lxd_remote}:{instance_name}",
+                    f"disk-{target.as_posix()}",
+                    "disk",
+                    f"source={host_source}",
+                    f"path={target.as_posix()}",
+                    "readonly=true",
+                ]
+            )
+
+    def _mount_project_overlay(
+        self,
+        instance: lxd.LXDInstance,
+        instance_name: str,
+        script: SetupScript,
+        project_path: Path,
+        lower_path: Path,
+        owner: str,
+    ) -> None:
+        """Mount a writable overlay over a read-only mount of the project.
+
+        The mount is added immediately, and the overlay is set up by steps
+        added to `script`.  Changes made by jobs are discarded when the
+        overlay is unmounted.
+        """
+        managed_project_path = get_managed_environment_project_path()
+        overlay_path = managed_project_path.parent / "overlay"
+        self._add_read_only_mount(
+            instance, instance_name, project_path, lower_path
+        )
+        script.add(
+            "remove the old project",
+            [
+                "rm",
+                "-rf",
+                managed_project_path.as_posix(),
+                overlay_path.as_posix(),
+            ],
+        )
+        script.add(
+            "create the project directory",
+            [
+                "mkdir",
+                "-p",
+                managed_project_path.as_posix(),
+                (overlay_path / "upper").as_posix(),
+                (overlay_path / "work").as_posix(),
+            ],
+        )
+        script.add(
+            "mount the project",
+            [
+                "mount",
+                "-t",
+                "overlay",
+                "overlay",
+                "-o",
+                f"lowerdir={lower_path.as_posix()},"
+                f"upperdir={(overlay_path / 'upper').as_posix()},"
+                f"workdir={(overlay_path / 'work').as_posix()}",
+                managed_project_path.as_posix(),
+            ],
+        )
+        if owner != "root":
+            # Changing the ownership of a file would copy up its contents,
+            # so only hand over the directories, which are cheap to copy
+            # up.  The build user can then create, replace and remove
+            # files anywhere in the project.
+            script.add(
+                "give the project directories to the build user",
+                [
+                    "find",
+                    managed_project_path.as_posix(),
+                    "-type",
+                    "d",
+                    "-exec",
+                    "chown",
+                    f"{owner}:{owner}",
+                    "{}",
+                    "+",
+                ],
+            )
+
+    def _unmount_project_overlay(
+        self, instance: lxd.LXDInstance, instance_name: str
+    ) -> None:
+        managed_project_path = get_managed_environment_project_path()
+        script = SetupScript()
+        script.add(
+            "unmount the project", ["umount", managed_project_path.as_posix()]
+        )
+        script.add(
+            "remove the overlay",
+            [
+                "rm",
+                "-rf",
+                (managed_project_path.parent / "overlay").as_posix(),
+            ],
+        )
+        self._run_setup_script(instance, instance_name, script)
+
+    def _attach_package_proxy(
+        self, instance: lxd.LXDInstance, instance_name: str
+    ) -> None:
+        """Make the package proxy reachable from an instance, and use it.
+
+        An LXD proxy device forwards the proxy's port on the instance's
+        loopback interface to the same port on the host's.
+        """
+        address = f"tcp:127.0.0.1:{self.package_proxy_port}"
+        # A device may be left over from a snapshot or an earlier run.
+        self._detach_package_proxy(instance_name)
+        try:
+            self._run_lxc(
+                [
+                    "config",
+                    "device",
+                    "add",
+                    f"{self.lxd_remote}:{instance_name}",
+                    _PACKAGE_PROXY_DEVICE,
+                    "proxy",
+                    f"listen={address}",
+                    f"connect={address}",
+                    "bind=instance",
+                ]
             )
+        except subprocess.CalledProcessError as error:
+            stderr = error.stderr.decode(errors="replace").strip()
+            raise CommandError(
+                f"Failed to attach the package proxy to {instance_name!r}: "
+                f"{stderr}"
+            ) from error
+        instance.default_command_environment.update(
+            self.get_command_environment(package_proxy=True)
+        )
+
+    def _detach_package_proxy(self, instance_name: str) -> None:
+        self._run_lxc(
+            [
+                "config",
+                "device",
+                "remove",
+                f"{self.lxd_remote}:{instance_name}",
+                _PACKAGE_PROXY_DEVICE,
+            ],
+            check=False,
+        )
+
+    def _add_non_root_user_steps(self, script: SetupScript) -> None:
+        default_user = get_non_root_user()
+        create_cmd = "getent passwd " + default_user + " >/dev/null"
+        create_cmd += " || useradd -m -U " + default_user
+
+        # Create default user if doesn't exist.
+        script.add("create the build user", ["sh", "-c", create_cmd])
+
+    def _set_up_project(
+        self, image_remote: RemoteImage, gpu_nvidia: bool
+    ) -> None:
+        """Prepare the LXD project and its default profile for launching.
+
+        This is idempotent, so it is only done once per provider (unless
+        `gpu_nvidia` changes).
+        """
+        with self._setup_lock:
+            if image_remote.remote_name not in self._added_image_remotes:
+                # XXX 2023-03-10 jugmac00: The following line is not
+                # explicitly covered by our test suite. We probably need to
+                # add something like `mock_lxd.get_remote_image` and then
+                # assert on `add_remote` being called.
+                image_remote.add_remote(lxc=self.lxc)
+                self._added_image_remotes.add(image_remote.remote_name)
+
+            if not self._project_exists:
+                if self.lxd_project not in self.lxc.project_list(
+                    self.lxd_remote
+                ):
+                    self.lxc.project_create(
+                        project=self.lxd_project, remote=self.lxd_remote
+                    )
+                self._project_exists = True
+
+            if self._profile_gpu_nvidia != gpu_nvidia:
+                self._configure_profile(gpu_nvidia)
+                self._profile_gpu_nvidia = gpu_nvidia
+
+    def _configure_profile(self, gpu_nvidia: bool) -> None:
         # Copy the default profile from the default project and adjust it
         # for our needs.  Unfortunately we have to edit the default profile
         # in our project since there's no way to get craft-providers to use
@@ -324,6 +946,18 @@ class LXDProvider(Provider):
         else:
             profile["config"].pop("nvidia.runtime", None)
             profile["devices"].pop("gpu", None)
+        # Editing the profile updates every instance using it, so avoid
+        # doing so if an earlier run already left it as we want it.
+        current_profile = self.lxc.profile_show(
+            profile="default",
+            project=self.lxd_project,
+            remote=self.lxd_remote,
+        )
+        if all(
+            current_profile.get(key) == profile.get(key)
+            for key in ("config", "description", "devices")
+        ):
+            return
         self.lxc.profile_edit(
             profile="default",
             config=profile,
@@ -331,6 +965,28 @@ class LXDProvider(Provider):
             remote=self.lxd_remote,
         )
 
+    def _launch(
+        self, *, instance_name: str, series: str, gpu_nvidia: bool = False
+    ) -> Tuple[lxd.LXDInstance, LPCIBuilddBaseConfiguration]:
+        """Launch an instance, or start it if it already exists.
+
+        :param instance_name: Name of the instance.
+        :param series: Distribution series name.
+        :param gpu_nvidia: If True, pass through an NVIDIA GPU from the host
+            to the instance.
+        :return: The instance and its base configuration.
+        """
+        alias = SERIES_TO_BUILDD_IMAGE_ALIAS[series]
+        environment = self.get_command_environment()
+        try:
+            image_remote = lxd.get_remote_image(alias.value)
+        except lxd.LXDError as error:
+            raise CommandError(str(error)) from error
+        base_configuration = LPCIBuilddBaseConfiguration(
+            alias=alias, environment=environment, hostname=instance_name
+        )
+        self._set_up_project(image_remote, gpu_nvidia)
+
         try:
             instance = self.lxd_launcher(
                 name=instance_name,
@@ -347,61 +1003,223 @@ class LXDProvider(Provider):
             )
         except (bases.BaseConfigurationError, lxd.LXDError) as error:
             raise CommandError(str(error)) from error
+        return instance, base_configuration
+
+    def _make_project_available(
+        self,
+        instance: lxd.LXDInstance,
+        instance_name: str,
+        project_path: Path,
+        root: bool,
+        project_sync: str,
+        project_ignore_files: Sequence[str],
+    ) -> None:
+        """Make the project available in an instance.
 
+        See `launched_environment` for the parameters.
+        """
         managed_project_path = get_managed_environment_project_path()
-        try:
-            tmp_project_path = (
-                get_managed_environment_home_path() / "tmp-project"
+        tmp_project_path = get_managed_environment_home_path() / "tmp-project"
+        owner = "root" if root else get_non_root_user()
+        ignore_rules = IgnoreRules()
+        host_entries = None
+        # Walking the project is only worth it for a plain copy if
+        # there is something to exclude.
+        if project_sync == "incremental" or (
+            project_sync == "copy"
+            and has_ignore_files(project_path, project_ignore_files)
+        ):
+            host_entries = get_host_entries(
+                project_path, ignore_rules, project_ignore_files, owner
             )
+        # Without anything to exclude, copying the whole project from a
+        # mount is cheaper than streaming it into the instance.
+        copy_from_mount = project_sync == "copy" and not ignore_rules
+        if copy_from_mount:
             instance.mount(host_source=project_path, target=tmp_project_path)
-            try:
-                self._internal_execute_run(
+        try:
+            # Run as much of the setup as possible in a single `exec`.
+            script = SetupScript()
+            if not root:
+                # The user must exist before files can be given to it.
+                self._add_non_root_user_steps(script)
+            if copy_from_mount:
+                self._add_copy_steps(script, tmp_project_path, owner)
+            elif project_sync == "overlay":
+                self._mount_project_overlay(
                     instance,
                     instance_name,
-                    ["rm", "-rf", managed_project_path.as_posix()],
-                    check=True,
+                    script,
+                    project_path,
+                    tmp_project_path,
+                    owner,
                 )
-                self._internal_execute_run(
-                    instance,
-                    instance_name,
-                    ["mkdir", "-p", managed_project_path.parent.as_posix()],
-                    check=True,
+            else:
+                if project_sync == "copy":
+                    script.add(
+                        "remove the old project",
+                        ["rm", "-rf", managed_project_path.as_posix()],
+                    )
+                script.add(
+                    "create the project directory",
+                    ["mkdir", "-p", managed_project_path.as_posix()],
                 )
-                self._internal_execute_run(
-                    instance,
-                    instance_name,
+                if not root:
+                    script.add(
+                        "give the project directory to the build user",
+                        [
+                            "chown",
+                            f"{owner}:{owner}",
+                            managed_project_path.as_posix(),
+                        ],
+                    )
+            script.add(
+                "remove policy-rc.d",
+                ["rm", "-f", "/usr/local/sbin/policy-rc.d"],
+            )
+            if project_sync == "incremental":
+                script.add(
+                    "list the project",
                     [
-                        "cp",
-                        "-a",
-                        tmp_project_path.as_posix(),
+                        "find",
                         managed_project_path.as_posix(),
+                        "-mindepth",
+                        "1",
+                        "-printf",
+                        FIND_ENTRIES_FORMAT,
                     ],
-                    check=True,
+                    output=True,
                 )
-                self._internal_execute_run(
+            output = self._run_setup_script(instance, instance_name, script)
+            if host_entries is not None and not copy_from_mount:
+                instance_entries: Dict[str, FileEntry] = {}
+                if project_sync == "incremental":
+                    # Ignored paths in the instance are left alone.
+                    instance_entries = {
+                        path: entry
+                        for path, entry in parse_instance_entries(
+                            output
+                        ).items()
+                        if not ignore_rules.is_excluded(
+                            path, entry.kind == "d"
+                        )
+                    }
+                self._sync_project(
                     instance,
                     instance_name,
-                    ["rm", "-f", "/usr/local/sbin/policy-rc.d"],
-                    check=True,
+                    project_path,
+                    host_entries,
+                    instance_entries,
+                    owner,
                 )
-                if not root:
-                    self._set_up_non_root_user(
-                        instance=instance, instance_name=instance_name
-                    )
-            except subprocess.CalledProcessError as error:
-                raise CommandError(str(error)) from error
-            finally:
+        except subprocess.CalledProcessError as error:
+            raise CommandError(str(error)) from error
+        finally:
+            if copy_from_mount:
                 instance.unmount(target=tmp_project_path)
 
+    @contextmanager
+    def launched_environment(
+        self,
+        *,
+        project_name: str,
+        project_path: Path,
+        series: str,
+        architecture: str,
+        gpu_nvidia: bool = False,
+        root: bool = True,
+        job_name: Optional[str] = None,
+        job_index: Optional[int] = None,
+        setup_snapshot: Optional[str] = None,
+        instance_name: Optional[str] = None,
+        project_sync: str = "copy",
+        project_ignore_files: Sequence[str] = (),
+    ) -> Generator[lxd.LXDInstance, None, None]:
+        """Launch environment for specified series and architecture.
+
+        :param project_name: Name of project.
+        :param project_path: Path to project.
+        :param series: Distribution series name.
+        :param architecture: Targeted architecture name.
+        :param job_name: If given, launch an instance dedicated to this job.
+        :param job_index: The index of that job.
+        :param setup_snapshot: If given, restore the setup snapshot saved
+            with this key, if any.
+        :param instance_name: If given, use this instance (for example, one
+            claimed from the pool) rather than one named after the project.
+        :param project_sync: How to make the project available in the
+            instance; one of `PROJECT_SYNC_MODES`.
+        :param project_ignore_files: Names of files in the project listing
+            paths not to copy into the instance, in the syntax of
+            `.gitignore`.
+        """
+        if instance_name is None:
+            instance_name = self.get_instance_name(
+                project_name=project_name,
+                project_path=project_path,
+                series=series,
+                architecture=architecture,
+                job_name=job_name,
+                job_index=job_index,
+            )
+        instance, base_configuration = self._launch(
+            instance_name=instance_name, series=series, gpu_nvidia=gpu_nvidia
+        )
+
+        managed_project_path = get_managed_environment_project_path()
+        try:
+            make_project_available = functools.partial(
+                self._make_project_available,
+                instance,
+                instance_name,
+                project_path,
+                root,
+                project_sync,
+                project_ignore_files,
+            )
+            if setup_snapshot is not None and not (
+                self._restore_setup_snapshot(
+                    instance, instance_name, base_configuration, setup_snapshot
+                )
+            ):
+                # Hold the project back until the setup snapshot has been
+                # saved, so that the snapshot only holds what the job
+                # installed.  Jobs install packages from the project
+                # directory, so it must exist.
+                script = SetupScript()
+                script.add(
+                    "create the project directory",
+                    ["mkdir", "-p", managed_project_path.as_posix()],
+                )
+                script.add(
+                    "remove policy-rc.d",
+                    ["rm", "-f", "/usr/local/sbin/policy-rc.d"],
+                )
+                self._run_setup_script(instance, instance_name, script)
+                self._pending_projects[instance_name] = make_project_available
+            else:
+                make_project_available()
+            if self.package_proxy_port is not None:
+                self._attach_package_proxy(instance, instance_name)
+
             yield instance
         finally:
+            # The project may never have been made available.
+            project_pending = (
+                self._pending_projects.pop(instance_name, None) is not None
+            )
             try:
-                self._internal_execute_run(
-                    instance,
-                    instance_name,
-                    ["rm", "-rf", managed_project_path.as_posix()],
-                    check=True,
-                )
+                if self.package_proxy_port is not None:
+                    self._detach_package_proxy(instance_name)
+                if project_sync == "overlay" and not project_pending:
+                    self._unmount_project_overlay(instance, instance_name)
+                elif project_sync == "copy":
+                    self._internal_execute_run(
+                        instance,
+                        instance_name,
+                        ["rm", "-rf", managed_project_path.as_posix()],
+                        check=True,
+                    )
                 instance.unmount_all()
                 instance.stop()
             except lxd.LXDError as error:
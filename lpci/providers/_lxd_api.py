@@ -0,0 +1,689 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""A client for the LXD REST API on the local unix socket."""
+
+__all__ = [
+    "LXDAPIClient",
+    "find_lxd_socket",
+]
+
+import http.client
+import json
+import math
+import os
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+from pathlib import Path, PurePath
+from typing import IO, Any, Callable, Dict, List, Optional, Union
+from urllib.parse import quote, urlencode
+
+from craft_providers import lxd
+
+# Where the LXD daemon listens, in order of preference, if $LXD_DIR is not
+# set.
+_LXD_SOCKET_PATHS = (
+    Path("/var/snap/lxd/common/lxd/unix.socket"),
+    Path("/var/lib/lxd/unix.socket"),
+)
+
+# Keyword arguments to `LXC.exec` that can be handled by the REST API.
+# Other arguments, such as input or a stream for the output, need a live
+# connection to the process and so are left to the `lxc` CLI.
+_API_EXEC_ARGUMENTS = {"capture_output", "text", "stdout", "stderr"}
+
+# Methods that can safely be sent again if the connection fails.
+_IDEMPOTENT_METHODS = {"GET", "HEAD"}
+
+
+def find_lxd_socket() -> Optional[Path]:
+    """Find the unix socket of the local LXD daemon, if we can use it."""
+    if "LXD_DIR" in os.environ:
+        paths = [Path(os.environ["LXD_DIR"]) / "unix.socket"]
+    else:
+        paths = list(_LXD_SOCKET_PATHS)
+    for path in paths:
+        if path.is_socket() and os.access(path, os.R_OK | os.W_OK):
+            return path
+    return None
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """An HTTP connection over a unix socket."""
+
+    def __init__(self, socket_path: Path) -> None:
+        # The host name is only used in the Host header.
+        super().__init__("lxd")
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.socket_path))
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def is_dropped(self) -> bool:
+        """Return whether the daemon has closed an idle connection."""
+        if self.sock is None:
+            return False
+        # An idle connection only becomes readable once it is closed.
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable)
+
+
+class LXDAPIClient(lxd.LXC):
+    """An `lxc` client that talks to the LXD REST API where it can.
+
+    `lxd.LXC` runs the `lxc` CLI for every operation, which costs a fork,
+    an exec and the CLI's own start-up for each command run in an instance.
+    This sends the operations that lpci uses most often to the local LXD
+    daemon over a persistent connection to its unix socket instead, and
+    leaves everything else (and anything for other remotes) to the CLI.
+
+    Commands run with `exec` are only sent over the REST API if their
+    output is captured or discarded, since the API only returns their
+    output once they have finished; commands whose output is streamed to
+    the user still use the CLI.
+
+    :param socket_path: The path to the LXD daemon's unix socket.
+    """
+
+    def __init__(self, socket_path: Path) -> None:
+        super().__init__()
+        self.socket_path = socket_path
+        # Each thread keeps a connection of its own.
+        self._local = threading.local()
+
+    def _get_connection(self) -> _UnixHTTPConnection:
+        connection: Optional[_UnixHTTPConnection] = getattr(
+            self._local, "connection", None
+        )
+        if connection is None:
+            connection = _UnixHTTPConnection(self.socket_path)
+            self._local.connection = connection
+        return connection
+
+    def _request(
+        self,
+        method: str,
+        endpoint: str,
+        *,
+        project: Optional[str] = None,
+        body: Union[bytes, IO[bytes], None] = None,
+        headers: Optional[Dict[str, str]] = None,
+        **params: Any,
+    ) -> http.client.HTTPResponse:
+        """Send a request, returning the response.
+
+        The caller must read the whole response before making another
+        request.
+        """
+        if project is not None:
+            params["project"] = project
+        if params:
+            endpoint += ("&" if "?" in endpoint else "?") + urlencode(params)
+        headers = dict(headers or {})
+        if isinstance(body, bytes):
+            headers["Content-Length"] = str(len(body))
+        elif body is not None:
+            headers["Content-Length"] = str(os.fstat(body.fileno()).st_size)
+        connection = self._get_connection()
+        if method not in _IDEMPOTENT_METHODS and connection.is_dropped():
+            # Requests with side effects are never sent twice, so make sure
+            # that they don't go to a connection that the daemon has
+            # already closed.
+            connection.close()
+        try:
+            connection.request(method, endpoint, body=body, headers=headers)
+            return connection.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            connection.close()
+            if method not in _IDEMPOTENT_METHODS:
+                raise
+            # The daemon may have closed an idle connection; try again once
+            # with a new one.
+            connection.request(method, endpoint, body=body, headers=headers)
+            return connection.getresponse()
+
+    def _request_json(
+        self,
+        method: str,
+        endpoint: str,
+        *,
+        brief: str,
+        project: Optional[str] = None,
+        data: Any = None,
+        wait_timeout: Optional[float] = None,
+        **params: Any,
+    ) -> Any:
+        """Send a request and return the metadata of its response.
+
+        If the request starts a background operation, then wait for it to
+        finish.
+
+        :param brief: A description of the failure, if the request fails.
+        :param wait_timeout: If given, only wait this many seconds for a
+            background operation to finish.
+        :raises lxd.LXDError: if the request fails.
+        :raises TimeoutError: if a background operation does not finish in
+            time.
+        """
+        body = None if data is None else json.dumps(data).encode()
+        headers = {} if data is None else {"Content-Type": "application/json"}
+        try:
+            response = self._request(
+                method,
+                endpoint,
+                project=project,
+                body=body,
+                headers=headers,
+                **params,
+            )
+            content = json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            raise lxd.LXDError(brief=brief, details=str(error)) from error
+        if content.get("type") == "error":
+            raise lxd.LXDError(brief=brief, details=content.get("error"))
+        if content.get("type") == "async":
+            wait_params: Dict[str, Any] = {}
+            if wait_timeout is not None:
+                wait_params["timeout"] = math.ceil(wait_timeout)
+            operation = self._request_json(
+                "GET",
+                f"{content['operation']}/wait",
+                brief=brief,
+                **wait_params,
+            )
+            if operation.get("status") == "Running":
+                raise TimeoutError(content["operation"])
+            if operation.get("status_code") != 200:
+                raise lxd.LXDError(brief=brief, details=operation.get("err"))
+            return operation.get("metadata")
+        return content.get("metadata")
+
+    def _instance_path(self, instance_name: str) -> str:
+        return f"/1.0/instances/{quote(instance_name, safe='')}"
+
+    def exec(
+        self,
+        *,
+        command: List[str],
+        instance_name: str,
+        cwd: Optional[str] = None,
+        mode: Optional[str] = None,
+        project: str = "default",
+        remote: str = "local",
+        runner: Callable[..., Any] = subprocess.run,
+        timeout: Optional[float] = None,
+        check: bool = False,
+        **kwargs: Any,
+    ) -> Any:
+        """See `lxd.LXC.exec`."""
+        stdout = kwargs.get("stdout")
+        stderr = kwargs.get("stderr")
+        if (
+            remote != "local"
+            or runner is not subprocess.run
+            or mode is not None
+            or not set(kwargs) <= _API_EXEC_ARGUMENTS
+            or stdout not in (None, subprocess.PIPE, subprocess.DEVNULL)
+            or stderr
+            not in (
+                None,
+                subprocess.PIPE,
+                subprocess.DEVNULL,
+                subprocess.STDOUT,
+            )
+        ):
+            return super().exec(
+                command=command,
+                instance_name=instance_name,
+                cwd=cwd,
+                mode=mode,
+                project=project,
+                remote=remote,
+                runner=runner,
+                timeout=timeout,
+                check=check,
+                **kwargs,
+            )
+
+        brief = f"Failed to execute command in instance {instance_name!r}."
+        data: Dict[str, Any] = {
+            "command": command,
+            "wait-for-websocket": False,
+            "interactive": False,
+            "record-output": True,
+        }
+        if cwd is not None:
+            data["cwd"] = cwd
+        try:
+            response = self._request_json(
+                "POST",
+                f"{self._instance_path(instance_name)}/exec",
+                brief=brief,
+                project=project,
+                data=data,
+                wait_timeout=timeout,
+            )
+        except TimeoutError as error:
+            assert timeout is not None
+            raise subprocess.TimeoutExpired(command, timeout) from error
+        # Collect the recorded output, removing it from the instance.
+        output: List[bytes] = []
+        for fd in ("1", "2"):
+            log_path = response["output"][fd]
+            log = self._request("GET", log_path, project=project).read()
+            self._request("DELETE", log_path, project=project).read()
+            output.append(log)
+        out, err = output
+        if stderr == subprocess.STDOUT:
+            out, err = out + err, b""
+
+        returncode = response["return"]
+        # Bytes, or strings if text is True.
+        captured_stdout: Any = None
+        captured_stderr: Any = None
+        if kwargs.get("capture_output") or stdout == subprocess.PIPE:
+            captured_stdout = out
+        elif stdout is None:
+            sys.stdout.buffer.write(out)
+            sys.stdout.flush()
+        if kwargs.get("capture_output") or stderr == subprocess.PIPE:
+            captured_stderr = err
+        elif stderr is None:
+            sys.stderr.buffer.write(err)
+            sys.stderr.flush()
+        if kwargs.get("text"):
+            if captured_stdout is not None:
+                captured_stdout = captured_stdout.decode()
+            if captured_stderr is not None:
+                captured_stderr = captured_stderr.decode()
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, command, captured_stdout, captured_stderr
+            )
+        return subprocess.CompletedProcess(
+            command, returncode, captured_stdout, captured_stderr
+        )
+
+    def file_pull(
+        self,
+        *,
+        instance_name: str,
+        source: PurePath,
+        destination: Path,
+        create_dirs: bool = False,
+        recursive: bool = False,
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.file_pull`."""
+        if remote != "local" or recursive:
+            return super().file_pull(
+                instance_name=instance_name,
+                source=source,
+                destination=destination,
+                create_dirs=create_dirs,
+                recursive=recursive,
+                project=project,
+                remote=remote,
+            )
+
+        brief = (
+            f"Failed to pull file {source.as_posix()!r} "
+            f"from instance {instance_name!r}."
+        )
+        try:
+            response = self._request(
+                "GET",
+                f"{self._instance_path(instance_name)}/files",
+                project=project,
+                path=source.as_posix(),
+            )
+            if response.status != 200:
+                content = json.loads(response.read())
+                raise lxd.LXDError(brief=brief, details=content.get("error"))
+            if response.getheader("X-LXD-type", "file") != "file":
+                # LXD lists the contents of directories instead.
+                response.read()
+                raise lxd.LXDError(
+                    brief=brief,
+                    details=f"{source.as_posix()!r} is not a regular file.",
+                )
+            mode = response.getheader("X-LXD-mode")
+            if create_dirs:
+                destination.parent.mkdir(parents=True, exist_ok=True)
+            # Stream the file to its destination rather than reading it
+            # into memory.
+            with open(destination, "wb") as f:
+                shutil.copyfileobj(response, f)
+            # Like `lxc file pull`, keep the file's permissions, but not
+            # its ownership.
+            if mode is not None:
+                os.chmod(destination, int(mode, 8))
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            raise lxd.LXDError(brief=brief, details=str(error)) from error
+
+    def file_push(
+        self,
+        *,
+        instance_name: str,
+        source: Path,
+        destination: PurePath,
+        create_dirs: bool = False,
+        recursive: bool = False,
+        gid: Optional[int] = None,
+        uid: Optional[int] = None,
+        mode: Optional[str] = None,
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.file_push`."""
+        # The API doesn't create parent directories.
+        if remote != "local" or recursive or create_dirs:
+            return super().file_push(
+                instance_name=instance_name,
+                source=source,
+                destination=destination,
+                create_dirs=create_dirs,
+                recursive=recursive,
+                gid=gid,
+                uid=uid,
+                mode=mode,
+                project=project,
+                remote=remote,
+            )
+
+        brief = (
+            f"Failed to push file {source.as_posix()!r} "
+            f"to instance {instance_name!r}."
+        )
+        try:
+            with open(source, "rb") as f:
+                # Like `lxc file push`, default to the mode and ownership of
+                # the source file.
+                st = os.fstat(f.fileno())
+                headers = {
+                    "Content-Type": "application/octet-stream",
+                    "X-LXD-type": "file",
+                    "X-LXD-write": "overwrite",
+                    "X-LXD-mode": mode or f"{st.st_mode & 0o7777:04o}",
+                    "X-LXD-uid": str(st.st_uid if uid is None else uid),
+                    "X-LXD-gid": str(st.st_gid if gid is None else gid),
+                }
+                response = self._request(
+                    "POST",
+                    f"{self._instance_path(instance_name)}/files",
+                    project=project,
+                    body=f,
+                    headers=headers,
+                    path=destination.as_posix(),
+                )
+                content = json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError) as error:
+            raise lxd.LXDError(brief=brief, details=str(error)) from error
+        if content.get("type") == "error":
+            raise lxd.LXDError(brief=brief, details=content.get("error"))
+
+    def list(
+        self, *, project: str = "default", remote: str = "local"
+    ) -> List[Dict[str, Any]]:
+        """See `lxd.LXC.list`."""
+        if remote != "local":
+            return super().list(project=project, remote=remote)
+        instances: List[Dict[str, Any]] = self._request_json(
+            "GET",
+            "/1.0/instances",
+            brief="Failed to list instances.",
+            project=project,
+            recursion=1,
+        )
+        return instances
+
+    def config_get(
+        self,
+        *,
+        instance_name: str,
+        key: str,
+        project: str = "default",
+        remote: str = "local",
+    ) -> str:
+        """See `lxd.LXC.config_get`."""
+        if remote != "local":
+            return super().config_get(
+                instance_name=instance_name,
+                key=key,
+                project=project,
+                remote=remote,
+            )
+        instance = self._request_json(
+            "GET",
+            self._instance_path(instance_name),
+            brief=(
+                f"Failed to get value for config key {key!r} "
+                f"for instance {instance_name!r}."
+            ),
+            project=project,
+        )
+        return str(instance["config"].get(key, ""))
+
+    def config_set(
+        self,
+        *,
+        instance_name: str,
+        key: str,
+        value: str,
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.config_set`."""
+        if remote != "local":
+            return super().config_set(
+                instance_name=instance_name,
+                key=key,
+                value=value,
+                project=project,
+                remote=remote,
+            )
+        self._request_json(
+            "PATCH",
+            self._instance_path(instance_name),
+            brief=(
+                f"Failed to set config key {key!r} to {value!r} "
+                f"for instance {instance_name!r}."
+            ),
+            project=project,
+            data={"config": {key: value}},
+        )
+
+    def config_device_show(
+        self,
+        *,
+        instance_name: str,
+        project: str = "default",
+        remote: str = "local",
+    ) -> Dict[str, Any]:
+        """See `lxd.LXC.config_device_show`."""
+        if remote != "local":
+            return super().config_device_show(
+                instance_name=instance_name, project=project, remote=remote
+            )
+        instance = self._request_json(
+            "GET",
+            self._instance_path(instance_name),
+            brief=f"Failed to show devices for instance {instance_name!r}.",
+            project=project,
+        )
+        devices: Dict[str, Any] = instance["devices"]
+        return devices
+
+    def _change_state(
+        self,
+        instance_name: str,
+        action: str,
+        brief: str,
+        project: str,
+        force: bool = False,
+        timeout: int = -1,
+    ) -> None:
+        self._request_json(
+            "PUT",
+            f"{self._instance_path(instance_name)}/state",
+            brief=brief,
+            project=project,
+            data={"action": action, "force": force, "timeout": timeout},
+        )
+
+    def start(
+        self,
+        *,
+        instance_name: str,
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.start`."""
+        if remote != "local":
+            return super().start(
+                instance_name=instance_name, project=project, remote=remote
+            )
+        self._change_state(
+            instance_name,
+            "start",
+            f"Failed to start {instance_name!r}.",
+            project,
+        )
+
+    def stop(
+        self,
+        *,
+        instance_name: str,
+        force: bool = False,
+        timeout: int = -1,
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.stop`."""
+        if remote != "local":
+            return super().stop(
+                instance_name=instance_name,
+                force=force,
+                timeout=timeout,
+                project=project,
+                remote=remote,
+            )
+        self._change_state(
+            instance_name,
+            "stop",
+            f"Failed to stop {instance_name!r}.",
+            project,
+            force=force,
+            timeout=timeout,
+        )
+
+    def delete(
+        self,
+        *,
+        instance_name: str,
+        force: bool = False,
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.delete`."""
+        if remote != "local":
+            return super().delete(
+                instance_name=instance_name,
+                force=force,
+                project=project,
+                remote=remote,
+            )
+        brief = f"Failed to delete instance {instance_name!r}."
+        if force:
+            # The API refuses to delete running instances.
+            instance = self._request_json(
+                "GET",
+                self._instance_path(instance_name),
+                brief=brief,
+                project=project,
+            )
+            if instance["status"] != "Stopped":
+                self._change_state(
+                    instance_name, "stop", brief, project, force=True
+                )
+        self._request_json(
+            "DELETE",
+            self._instance_path(instance_name),
+            brief=brief,
+            project=project,
+        )
+
+    def profile_show(
+        self, *, profile: str, project: str = "default", remote: str = "local"
+    ) -> Dict[str, Any]:
+        """See `lxd.LXC.profile_show`."""
+        if remote != "local":
+            return super().profile_show(
+                profile=profile, project=project, remote=remote
+            )
+        config: Dict[str, Any] = self._request_json(
+            "GET",
+            f"/1.0/profiles/{quote(profile, safe='')}",
+            brief=f"Failed to show profile {profile!r}.",
+            project=project,
+        )
+        return config
+
+    def profile_edit(
+        self,
+        *,
+        profile: str,
+        config: Dict[str, Any],
+        project: str = "default",
+        remote: str = "local",
+    ) -> None:
+        """See `lxd.LXC.profile_edit`."""
+        if remote != "local":
+            return super().profile_edit(
+                profile=profile, config=config, project=project, remote=remote
+            )
+        self._request_json(
+            "PUT",
+            f"/1.0/profiles/{quote(profile, safe='')}",
+            brief=f"Failed to set profile {profile!r}.",
+            project=project,
+            data={
+                key: config[key]
+                for key in ("config", "description", "devices")
+                if key in config
+            },
+        )
+
+    def project_list(self, remote: str = "local") -> List[str]:
+        """See `lxd.LXC.project_list`."""
+        if remote != "local":
+            return super().project_list(remote=remote)
+        projects = self._request_json(
+            "GET",
+            "/1.0/projects",
+            brief=f"Failed to list projects on remote {remote!r}.",
+            recursion=1,
+        )
+        return [project["name"] for project in projects]
+
+    def project_create(self, *, project: str, remote: str = "local") -> None:
+        """See `lxd.LXC.project_create`."""
+        if remote != "local":
+            return super().project_create(project=project, remote=remote)
+        self._request_json(
+            "POST",
+            "/1.0/projects",
+            brief=f"Failed to create project {project!r}.",
+            data={"name": project},
+        )
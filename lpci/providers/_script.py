@@ -0,0 +1,86 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""Scripts that run several setup commands in a single `exec`."""
+
+__all__ = [
+    "SetupScript",
+]
+
+import re
+import shlex
+from typing import List, NamedTuple, Optional, Sequence
+
+from lpci.errors import CommandError
+
+_FAILURE_MARKER = "lpci-setup-failed"
+_FAILURE_RE = re.compile(rf"^{_FAILURE_MARKER}:(\d+):(\d+)\n?", re.M)
+
+
+class _Step(NamedTuple):
+    description: str
+    # Commands to run in a pipeline.
+    commands: Sequence[Sequence[str]]
+    output: bool
+
+
+class SetupScript:
+    """A sequence of setup commands, stopping at the first failure.
+
+    Running commands one at a time in an instance costs a round trip
+    through `lxc exec` each, so the commands are composed into a script to
+    be run by `bash` instead.  Only the standard output of steps added with
+    `output=True` is kept on standard output; everything else is sent to
+    standard error.
+    """
+
+    def __init__(self) -> None:
+        self.steps: List[_Step] = []
+
+    def add(
+        self,
+        description: str,
+        *commands: Sequence[str],
+        output: bool = False,
+    ) -> None:
+        """Add a step to the script.
+
+        :param description: What the step does, for use in error messages;
+            for example, "create the project directory".
+        :param commands: One or more commands; if there are several, then
+            they are run as a pipeline.
+        :param output: Keep the standard output of this step.
+        """
+        self.steps.append(_Step(description, commands, output))
+
+    def render(self) -> List[str]:
+        """Return a command that runs the script."""
+        lines = ["set -o pipefail"]
+        for index, step in enumerate(self.steps):
+            pipeline = " | ".join(
+                shlex.join(command) for command in step.commands
+            )
+            if not step.output:
+                pipeline += " >&2"
+            lines.append(
+                f"{pipeline} || "
+                f'{{ echo "{_FAILURE_MARKER}:{index}:$?" >&2; exit 1; }}'
+            )
+        return ["bash", "-c", "\n".join(lines)]
+
+    def get_error(self, returncode: int, stderr: str) -> CommandError:
+        """Describe the failure of a run of this script."""
+        match: Optional["re.Match[str]"] = None
+        for match in _FAILURE_RE.finditer(stderr):
+            pass
+        if match is None:
+            return CommandError(
+                f"Setup failed with exit status {returncode}: "
+                f"{stderr.strip()}"
+            )
+        step = self.steps[int(match.group(1))]
+        output = _FAILURE_RE.sub("", stderr).strip()
+        message = f"Failed to {step.description} (exit status {match[2]})"
+        if output:
+            message += f": {output}"
+        return CommandError(message)
@@ -0,0 +1,299 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""Incremental synchronization of a project into a managed environment."""
+
+__all__ = [
+    "FIND_ENTRIES_FORMAT",
+    "FileEntry",
+    "IgnoreRules",
+    "get_changes",
+    "get_host_entries",
+    "has_ignore_files",
+    "parse_instance_entries",
+    "write_tar",
+]
+
+import os
+import re
+import stat
+import tarfile
+from pathlib import Path
+from typing import (
+    IO,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+)
+
+# Arguments for `find -printf` that list the entries in a tree in the form
+# expected by `parse_instance_entries`.
+FIND_ENTRIES_FORMAT = r"%P\0%y\0%m\0%s\0%T@\0%l\0%u\0"
+
+
+class FileEntry(NamedTuple):
+    """The metadata of a file that decides whether it needs to be copied."""
+
+    # "f" for a regular file, "d" for a directory, or "l" for a symbolic
+    # link, as in `find -printf %y`.
+    kind: str
+    mode: int
+    # Sizes and modification times (in whole seconds) are only compared for
+    # regular files.
+    size: int = 0
+    mtime: int = 0
+    # Symbolic link targets.
+    target: str = ""
+    owner: str = "root"
+
+
+def _translate_pattern(pattern: str) -> str:
+    """Translate a gitignore-style glob to a regular expression."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        at_start = i == 0 or pattern[i - 1] == "/"
+        if at_start and pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif at_start and pattern[i:] == "**":
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 2) != -1:
+            start, end = i + 1, pattern.find("]", i + 2)
+            members = pattern[start:end].replace("[", "\\[")
+            if members.startswith("!"):
+                members = "^" + members[1:]
+            parts.append(f"[{members}]")
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(parts)
+
+
+class IgnoreRules:
+    """Rules excluding paths from a project, in the syntax of `.gitignore`.
+
+    As with git, the last matching rule wins, and a path inside an ignored
+    directory cannot be re-included.
+    """
+
+    def __init__(self) -> None:
+        # (base directory, pattern, negated, only matches directories)
+        self._rules: List[Tuple[str, Pattern[str], bool, bool]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self._rules)
+
+    def add(self, lines: Iterable[str], base: str = "") -> None:
+        """Add rules from an ignore file in the directory `base`."""
+        for line in lines:
+            line = line.rstrip("\n")
+            if not line.endswith("\\ "):
+                line = line.rstrip(" ")
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            elif line.startswith(("\\!", "\\#")):
+                line = line[1:]
+            directory_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                # Patterns containing a slash are relative to `base`.
+                regex = _translate_pattern(line.lstrip("/"))
+            else:
+                regex = "(?:.*/)?" + _translate_pattern(line)
+            self._rules.append(
+                (base, re.compile(regex + r"\Z"), negated, directory_only)
+            )
+
+    def match(self, path: str, is_directory: bool) -> bool:
+        """Return True if the rules ignore `path` itself."""
+        ignored = False
+        for base, regex, negated, directory_only in self._rules:
+            if directory_only and not is_directory:
+                continue
+            prefix = base + "/" if base else ""
+            if not path.startswith(prefix):
+                continue
+            prefix_length = len(prefix)
+            relative_path = path[prefix_length:]
+            if regex.match(relative_path):
+                ignored = not negated
+        return ignored
+
+    def is_excluded(self, path: str, is_directory: bool) -> bool:
+        """Return True if the rules ignore `path` or any of its parents."""
+        parts = path.split("/")
+        return any(
+            self.match("/".join(parts[:i]), True) for i in range(1, len(parts))
+        ) or self.match(path, is_directory)
+
+
+def _make_entry(
+    kind: str, mode: int, size: int, mtime: float, target: str, owner: str
+) -> FileEntry:
+    if kind == "f":
+        return FileEntry(kind, mode, size=size, mtime=int(mtime), owner=owner)
+    elif kind == "l":
+        return FileEntry(kind, mode, target=target, owner=owner)
+    else:
+        return FileEntry(kind, mode, owner=owner)
+
+
+def has_ignore_files(root: Path, ignore_file_names: Sequence[str]) -> bool:
+    """Check whether any directory in a tree on the host has ignore files.
+
+    This only lists directories, so it is much cheaper than
+    `get_host_entries`.
+    """
+    if not ignore_file_names:
+        return False
+    for _, _, filenames in os.walk(root):
+        if any(name in filenames for name in ignore_file_names):
+            return True
+    return False
+
+
+def get_host_entries(
+    root: Path,
+    ignore_rules: Optional[IgnoreRules] = None,
+    ignore_file_names: Sequence[str] = (),
+    owner: str = "root",
+) -> Dict[str, FileEntry]:
+    """Return the entries in a tree on the host, keyed by relative path.
+
+    Files other than regular files, directories and symbolic links (such as
+    sockets) are skipped, as they would be by `cp -a` into a fresh tree.
+
+    :param ignore_rules: If given, skip paths matching these rules.
+    :param ignore_file_names: Add rules to `ignore_rules` from files with
+        these names in each directory that is walked.
+    :param owner: The user who should own the entries once copied.
+    """
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        relative_dirpath = os.path.relpath(dirpath, root)
+        if relative_dirpath == ".":
+            relative_dirpath = ""
+        if ignore_rules is not None:
+            for ignore_file_name in ignore_file_names:
+                if ignore_file_name in filenames:
+                    path = os.path.join(dirpath, ignore_file_name)
+                    with open(path, errors="replace") as ignore_file:
+                        ignore_rules.add(ignore_file, base=relative_dirpath)
+        for name in list(dirnames) + filenames:
+            path = os.path.join(dirpath, name)
+            relative_path = os.path.join(relative_dirpath, name)
+            if ignore_rules is not None and ignore_rules.match(
+                relative_path, name in dirnames
+            ):
+                if name in dirnames:
+                    # Don't descend into ignored directories.
+                    dirnames.remove(name)
+                continue
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                kind, target = "f", ""
+            elif stat.S_ISDIR(st.st_mode):
+                kind, target = "d", ""
+            elif stat.S_ISLNK(st.st_mode):
+                kind, target = "l", os.readlink(path)
+            else:
+                continue
+            entries[relative_path] = _make_entry(
+                kind,
+                stat.S_IMODE(st.st_mode),
+                st.st_size,
+                st.st_mtime,
+                target,
+                owner,
+            )
+    return entries
+
+
+def parse_instance_entries(output: bytes) -> Dict[str, FileEntry]:
+    """Parse the output of `find -printf FIND_ENTRIES_FORMAT`."""
+    fields = iter(os.fsdecode(field) for field in output.split(b"\0")[:-1])
+    entries = {}
+    # Each entry has seven fields.
+    for path, kind, mode, size, mtime, target, owner in zip(*[fields] * 7):
+        if kind in ("f", "d", "l"):
+            entries[path] = _make_entry(
+                kind, int(mode, 8), int(size), float(mtime), target, owner
+            )
+    return entries
+
+
+def get_changes(
+    host_entries: Dict[str, FileEntry], instance_entries: Dict[str, FileEntry]
+) -> Tuple[List[str], List[str]]:
+    """Work out how to bring a tree in an instance up to date.
+
+    :return: A tuple of the paths to delete from the instance (deleting
+        directories recursively), followed by the paths to copy to it from
+        the host (not recursively).  Parents come before their children.
+    """
+    deleted = set()
+    to_delete = []
+    for path in sorted(instance_entries):
+        host_entry = host_entries.get(path)
+        if host_entry is not None and (
+            host_entry.kind == instance_entries[path].kind
+        ):
+            continue
+        deleted.add(path)
+        if os.path.dirname(path) not in deleted:
+            to_delete.append(path)
+    to_copy = [
+        path
+        for path in sorted(host_entries)
+        if host_entries[path] != instance_entries.get(path)
+    ]
+    return to_delete, to_copy
+
+
+def write_tar(
+    fileobj: IO[bytes], root: Path, paths: Iterable[str], owner: str = "root"
+) -> None:
+    """Write a stream of some files in a tree as a tar archive.
+
+    Files are owned by `owner` in the archive, so that extracting the
+    archive as root gives them to that user without a separate `chown`.
+    """
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        for path in paths:
+            info = tar.gettarinfo(root / path, arcname=path)
+            if info.islnk():
+                # The file that this is a hard link to may not be in the
+                # archive, so store a copy of it instead.
+                info.type = tarfile.REGTYPE
+                info.linkname = ""
+                info.size = os.stat(root / path).st_size
+            # GNU tar prefers names to IDs when extracting.
+            info.uid = info.gid = 0
+            info.uname = info.gname = owner
+            if info.isreg():
+                with open(root / path, "rb") as f:
+                    tar.addfile(info, f)
+            else:
+                tar.addfile(info)
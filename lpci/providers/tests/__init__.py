@@ -1,8 +1,9 @@
 # Copyright 2021 Canonical Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file LICENSE).
 
+import copy
 from dataclasses import dataclass
-from typing import Optional
+from typing import Any, Callable, Dict, Optional
 from unittest.mock import Mock
 
 from craft_providers.lxd import LXC, LXDError, LXDInstallationError, launch
@@ -29,6 +30,28 @@ class FakeLXDInstaller:
             raise LXDError("LXD is broken")
 
 
+def makeProfileShow(
+    default_profile: Dict[str, Any],
+    project_profile: Optional[Dict[str, Any]] = None,
+) -> Callable[..., Dict[str, Any]]:
+    """Create a fake `LXC.profile_show` for tests.
+
+    :param default_profile: The default profile in the default project.
+    :param project_profile: The default profile in other projects (empty,
+        as in a new project, if not given).
+    """
+    if project_profile is None:
+        project_profile = {"config": {}, "description": "", "devices": {}}
+
+    def profile_show(*, profile: str, project: str, remote: str) -> Any:
+        if project == "default":
+            return copy.deepcopy(default_profile)
+        else:
+            return copy.deepcopy(project_profile)
+
+    return profile_show
+
+
 def makeLXDProvider(
     lxc: Optional[LXC] = None,
     can_install: bool = True,
@@ -1,12 +1,49 @@
 # Copyright 2021 Canonical Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file LICENSE).
 
+from pathlib import Path
+from unittest.mock import patch
+
+from craft_providers.lxd import LXC
+from fixtures import EnvironmentVariable
 from testtools import TestCase
 
 from lpci.providers import get_provider
 from lpci.providers._lxd import LXDProvider
+from lpci.providers._lxd_api import LXDAPIClient
 
 
 class TestGetProvider(TestCase):
-    def test_default(self):
-        self.assertIsInstance(get_provider(), LXDProvider)
+    def setUp(self):
+        super().setUp()
+        self.useFixture(EnvironmentVariable("LPCI_LXD_API"))
+
+    @patch("lpci.providers.find_lxd_socket")
+    def test_default(self, mock_find_lxd_socket):
+        mock_find_lxd_socket.return_value = Path("/lxd/unix.socket")
+
+        provider = get_provider()
+
+        assert isinstance(provider, LXDProvider)
+        self.assertIs(type(provider.lxc), LXC)
+        mock_find_lxd_socket.assert_not_called()
+
+    @patch("lpci.providers.find_lxd_socket")
+    def test_lxd_api(self, mock_find_lxd_socket):
+        self.useFixture(EnvironmentVariable("LPCI_LXD_API", "1"))
+        mock_find_lxd_socket.return_value = Path("/lxd/unix.socket")
+
+        provider = get_provider()
+
+        assert isinstance(provider, LXDProvider)
+        assert isinstance(provider.lxc, LXDAPIClient)
+        self.assertEqual(Path("/lxd/unix.socket"), provider.lxc.socket_path)
+
+    @patch("lpci.providers.find_lxd_socket", return_value=None)
+    def test_lxd_api_without_socket(self, mock_find_lxd_socket):
+        self.useFixture(EnvironmentVariable("LPCI_LXD_API", "1"))
+
+        provider = get_provider()
+
+        assert isinstance(provider, LXDProvider)
+        self.assertIs(type(provider.lxc), LXC)
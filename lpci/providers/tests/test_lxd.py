@@ -1,19 +1,23 @@
 # Copyright 2021 Canonical Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file LICENSE).
 
+import io
+import os
 import re
 import subprocess
+import tarfile
 from pathlib import Path
 from typing import Any, AnyStr, List
 from unittest.mock import ANY, Mock, call, patch
 
 from craft_providers.bases import BaseConfigurationError, BuilddBaseAlias
 from craft_providers.lxd import LXC, LXDError, launch
+from fixtures import EnvironmentVariable, TempDir
 from testtools import TestCase
 
 from lpci.errors import CommandError
 from lpci.providers._buildd import LPCIBuilddBaseConfiguration
-from lpci.providers.tests import makeLXDProvider
+from lpci.providers.tests import makeLXDProvider, makeProfileShow
 from lpci.tests.fixtures import RecordingEmitterFixture
 
 _base_path = (
@@ -21,6 +25,17 @@ _base_path = (
 )
 
 
+def _setup_command(*steps: str) -> List[str]:
+    """Return the command expected to run a setup script."""
+    lines = ["set -o pipefail"]
+    for index, step in enumerate(steps):
+        lines.append(
+            f"{step} >&2 || "
+            f'{{ echo "lpci-setup-failed:{index}:$?" >&2; exit 1; }}'
+        )
+    return ["bash", "-c", "\n".join(lines)]
+
+
 class TestLXDProvider(TestCase):
     def setUp(self):
         super().setUp()
@@ -377,6 +392,40 @@ class TestLXDProvider(TestCase):
             ),
         )
 
+    def test_get_instance_name_for_job(self):
+        provider = makeLXDProvider()
+
+        self.assertEqual(
+            "lpci-my-project-12345-focal-amd64-cad4a5be",
+            provider.get_instance_name(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+                job_name="test",
+                job_index=1,
+            ),
+        )
+
+    def test_get_instance_name_for_job_truncates_project_name(self):
+        # The part of the name identifying the job survives truncation.
+        provider = makeLXDProvider()
+
+        names = [
+            provider.get_instance_name(
+                project_name="a" * 100,
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+                job_name="test",
+                job_index=job_index,
+            )
+            for job_index in (0, 1)
+        ]
+
+        self.assertEqual([63, 63], [len(name) for name in names])
+        self.assertNotEqual(names[0], names[1])
+
     @patch("os.environ", {"IGNORE": "sentinel", "PATH": "not-using-host-path"})
     def test_get_command_environment_minimal(self):
         provider = makeLXDProvider()
@@ -411,13 +460,113 @@ class TestLXDProvider(TestCase):
         )
 
     @patch("os.environ", {"PATH": "not-using-host-path"})
-    def test_launched_environment(self):
+    def test_get_command_environment_with_package_proxy(self):
+        provider = makeLXDProvider()
+        provider.package_proxy_port = 3142
+
+        self.assertEqual(
+            {"PATH": _base_path}, provider.get_command_environment()
+        )
+        self.assertEqual(
+            {"PATH": _base_path, "http_proxy": "http://127.0.0.1:3142"},
+            provider.get_command_environment(package_proxy=True),
+        )
+
+    @patch("os.environ", {"PATH": "not-using-host-path"})
+    def test_launched_environment_package_proxy(self):
         expected_instance_name = "lpci-my-project-12345-focal-amd64"
         mock_lxc = Mock(spec=LXC)
-        mock_lxc.profile_show.return_value = {
-            "config": {"sentinel": "true"},
-            "devices": {"eth0": {}},
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = []
+        mock_lxc.remote_list.return_value = {}
+        mock_launcher = Mock(spec=launch)
+        mock_launcher.return_value.default_command_environment = {
+            "PATH": _base_path
         }
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+        provider.package_proxy_port = 3142
+        device_calls = [
+            call(
+                [
+                    "config",
+                    "device",
+                    "remove",
+                    f"test-remote:{expected_instance_name}",
+                    "lpci-package-proxy",
+                ],
+                check=False,
+                capture_output=True,
+                project="test-project",
+            ),
+            call(
+                [
+                    "config",
+                    "device",
+                    "add",
+                    f"test-remote:{expected_instance_name}",
+                    "lpci-package-proxy",
+                    "proxy",
+                    "listen=tcp:127.0.0.1:3142",
+                    "connect=tcp:127.0.0.1:3142",
+                    "bind=instance",
+                ],
+                check=True,
+                capture_output=True,
+                project="test-project",
+            ),
+        ]
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+        ) as instance:
+            self.assertEqual(device_calls, mock_lxc._run_lxc.call_args_list)
+            self.assertEqual(
+                {"PATH": _base_path, "http_proxy": "http://127.0.0.1:3142"},
+                instance.default_command_environment,
+            )
+            mock_lxc._run_lxc.reset_mock()
+
+        self.assertEqual(device_calls[:1], mock_lxc._run_lxc.call_args_list)
+
+    @patch("os.environ", {"PATH": "not-using-host-path"})
+    def test_launched_environment_package_proxy_error(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = []
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc._run_lxc.side_effect = [
+            subprocess.CompletedProcess([], 1),
+            subprocess.CalledProcessError(
+                1, ["lxc", "config"], stderr=b"Error: Port in use\n"
+            ),
+            subprocess.CompletedProcess([], 0),
+        ]
+        provider = makeLXDProvider(lxc=mock_lxc)
+        provider.package_proxy_port = 3142
+
+        with self.assertRaisesRegex(
+            CommandError,
+            r"^Failed to attach the package proxy to '.*': "
+            r"Error: Port in use$",
+        ):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+            ):
+                pass  # pragma: no cover
+
+    @patch("os.environ", {"PATH": "not-using-host-path"})
+    def test_launched_environment(self):
+        expected_instance_name = "lpci-my-project-12345-focal-amd64"
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            {"config": {"sentinel": "true"}, "devices": {"eth0": {}}}
+        )
         mock_lxc.project_list.return_value = []
         mock_lxc.remote_list.return_value = {}
         mock_launcher = Mock(spec=launch)
@@ -434,8 +583,20 @@ class TestLXDProvider(TestCase):
             mock_lxc.project_create.assert_called_once_with(
                 project="test-project", remote="test-remote"
             )
-            mock_lxc.profile_show.assert_called_once_with(
-                profile="default", project="default", remote="test-remote"
+            self.assertEqual(
+                [
+                    call(
+                        profile="default",
+                        project="default",
+                        remote="test-remote",
+                    ),
+                    call(
+                        profile="default",
+                        project="test-project",
+                        remote="test-remote",
+                    ),
+                ],
+                mock_lxc.profile_show.call_args_list,
             )
             mock_lxc.profile_edit.assert_called_once_with(
                 profile="default",
@@ -471,40 +632,17 @@ class TestLXDProvider(TestCase):
                     ),
                     call().lxc.exec(
                         instance_name=expected_instance_name,
-                        command=["rm", "-rf", "/build/lpci/project"],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=["mkdir", "-p", "/build/lpci"],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=[
-                            "cp",
-                            "-a",
-                            "/root/tmp-project",
-                            "/build/lpci/project",
-                        ],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=["rm", "-f", "/usr/local/sbin/policy-rc.d"],
+                        command=_setup_command(
+                            "rm -rf /build/lpci/project",
+                            "mkdir -p /build/lpci",
+                            "cp -a /root/tmp-project /build/lpci/project",
+                            "rm -f /usr/local/sbin/policy-rc.d",
+                        ),
                         project="test-project",
                         remote="test-remote",
                         runner=subprocess.run,
                         check=True,
+                        capture_output=True,
                     ),
                     call().unmount(target=Path("/root/tmp-project")),
                 ],
@@ -532,10 +670,9 @@ class TestLXDProvider(TestCase):
     def test_launched_environment_default_user(self):
         expected_instance_name = "lpci-my-project-12345-focal-amd64"
         mock_lxc = Mock(spec=LXC)
-        mock_lxc.profile_show.return_value = {
-            "config": {"sentinel": "true"},
-            "devices": {"eth0": {}},
-        }
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            {"config": {"sentinel": "true"}, "devices": {"eth0": {}}}
+        )
         mock_lxc.project_list.return_value = []
         mock_lxc.remote_list.return_value = {}
         mock_launcher = Mock(spec=launch)
@@ -553,8 +690,20 @@ class TestLXDProvider(TestCase):
             mock_lxc.project_create.assert_called_once_with(
                 project="test-project", remote="test-remote"
             )
-            mock_lxc.profile_show.assert_called_once_with(
-                profile="default", project="default", remote="test-remote"
+            self.assertEqual(
+                [
+                    call(
+                        profile="default",
+                        project="default",
+                        remote="test-remote",
+                    ),
+                    call(
+                        profile="default",
+                        project="test-project",
+                        remote="test-remote",
+                    ),
+                ],
+                mock_lxc.profile_show.call_args_list,
             )
             mock_lxc.profile_edit.assert_called_once_with(
                 profile="default",
@@ -590,66 +739,21 @@ class TestLXDProvider(TestCase):
                     ),
                     call().lxc.exec(
                         instance_name=expected_instance_name,
-                        command=["rm", "-rf", "/build/lpci/project"],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=["mkdir", "-p", "/build/lpci"],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=[
-                            "cp",
-                            "-a",
-                            "/root/tmp-project",
-                            "/build/lpci/project",
-                        ],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=["rm", "-f", "/usr/local/sbin/policy-rc.d"],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=[
-                            "sh",
-                            "-c",
-                            "getent passwd _lpci >/dev/null"
-                            + " || useradd -m -U _lpci",
-                        ],
-                        project="test-project",
-                        remote="test-remote",
-                        runner=subprocess.run,
-                        check=True,
-                    ),
-                    call().lxc.exec(
-                        instance_name=expected_instance_name,
-                        command=[
-                            "chown",
-                            "-R",
-                            "_lpci:_lpci",
-                            "/build/lpci/project",
-                        ],
+                        command=_setup_command(
+                            "sh -c 'getent passwd _lpci >/dev/null"
+                            " || useradd -m -U _lpci'",
+                            "rm -rf /build/lpci/project",
+                            "mkdir -p /build/lpci/project",
+                            "tar -c -f - --owner=_lpci --group=_lpci "
+                            "-C /root/tmp-project . | "
+                            "tar -x -f - -C /build/lpci/project",
+                            "rm -f /usr/local/sbin/policy-rc.d",
+                        ),
                         project="test-project",
                         remote="test-remote",
                         runner=subprocess.run,
                         check=True,
+                        capture_output=True,
                     ),
                     call().unmount(target=Path("/root/tmp-project")),
                 ],
@@ -712,8 +816,13 @@ class TestLXDProvider(TestCase):
         def execute(
             command: List[str], **kwargs: Any
         ) -> "subprocess.CompletedProcess[AnyStr]":
-            if command[0] == "cp":
-                raise subprocess.CalledProcessError(1, command)
+            if command[0] == "bash":
+                raise subprocess.CalledProcessError(
+                    1,
+                    command,
+                    stderr=b"cp: cannot stat '/root/tmp-project': Nope\n"
+                    b"lpci-setup-failed:2:1\n",
+                )
             else:
                 return subprocess.CompletedProcess([], 0)
 
@@ -722,7 +831,9 @@ class TestLXDProvider(TestCase):
         provider = makeLXDProvider(lxd_launcher=mock_launcher)
         mock_launcher.return_value.lxc.exec.side_effect = execute
         with self.assertRaisesRegex(
-            CommandError, r"returned non-zero exit status 1"
+            CommandError,
+            r"^Failed to copy the project \(exit status 1\): "
+            r"cp: cannot stat '/root/tmp-project': Nope$",
         ):
             with provider.launched_environment(
                 project_name="my-project",
@@ -741,32 +852,12 @@ class TestLXDProvider(TestCase):
                 ),
                 call().lxc.exec(
                     instance_name=expected_instance_name,
-                    command=["rm", "-rf", "/build/lpci/project"],
-                    project="test-project",
-                    remote="test-remote",
-                    runner=subprocess.run,
-                    check=True,
-                ),
-                call().lxc.exec(
-                    instance_name=expected_instance_name,
-                    command=["mkdir", "-p", "/build/lpci"],
-                    project="test-project",
-                    remote="test-remote",
-                    runner=subprocess.run,
-                    check=True,
-                ),
-                call().lxc.exec(
-                    instance_name=expected_instance_name,
-                    command=[
-                        "cp",
-                        "-a",
-                        "/root/tmp-project",
-                        "/build/lpci/project",
-                    ],
+                    command=ANY,
                     project="test-project",
                     remote="test-remote",
                     runner=subprocess.run,
                     check=True,
+                    capture_output=True,
                 ),
                 call().unmount(target=Path("/root/tmp-project")),
                 call().lxc.exec(
@@ -889,10 +980,13 @@ class TestLXDProvider(TestCase):
         # With gpu_nvidia=False, launched_environment removes any existing
         # NVIDIA GPU configuration from the default profile.
         mock_lxc = Mock(spec=LXC)
-        mock_lxc.profile_show.return_value = {
+        gpu_profile = {
             "config": {"nvidia.runtime": "true"},
             "devices": {"gpu": {"type": "gpu"}},
         }
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            gpu_profile, project_profile=gpu_profile
+        )
         mock_lxc.project_list.return_value = []
         mock_lxc.remote_list.return_value = {}
         mock_launcher = Mock(spec=launch)
@@ -916,7 +1010,9 @@ class TestLXDProvider(TestCase):
         # With gpu_nvidia=True, launched_environment adds NVIDIA GPU
         # configuration to the default profile.
         mock_lxc = Mock(spec=LXC)
-        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            {"config": {}, "devices": {}}
+        )
         mock_lxc.project_list.return_value = []
         mock_lxc.remote_list.return_value = {}
         mock_launcher = Mock(spec=launch)
@@ -939,3 +1035,1378 @@ class TestLXDProvider(TestCase):
                 project="test-project",
                 remote="test-remote",
             )
+
+    @patch.object(LPCIBuilddBaseConfiguration, "wait_until_ready")
+    def test_launched_environment_restores_setup_snapshot(
+        self, mock_wait_until_ready
+    ):
+        expected_instance_name = "lpci-my-project-12345-focal-amd64"
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.config_get.return_value = "setup-key"
+        mock_launcher = Mock(spec=launch)
+        mock_launcher.return_value.mount.side_effect = (
+            lambda **kwargs: mock_wait_until_ready.assert_called_once_with(
+                executor=mock_launcher.return_value
+            )
+        )
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            setup_snapshot="setup-key",
+        ) as instance:
+            self.assertIsNotNone(instance)
+
+        mock_lxc.config_get.assert_called_once_with(
+            instance_name=expected_instance_name,
+            key="user.lpci.setup-snapshot",
+            project="test-project",
+            remote="test-remote",
+        )
+        mock_lxc._run_lxc.assert_called_once_with(
+            ["restore", f"test-remote:{expected_instance_name}", "lpci-setup"],
+            check=True,
+            capture_output=True,
+            project="test-project",
+        )
+        mock_lxc.config_set.assert_called_once_with(
+            instance_name=expected_instance_name,
+            key="user.lpci.setup-snapshot",
+            value="setup-key",
+            project="test-project",
+            remote="test-remote",
+        )
+        mock_launcher.return_value.mount.assert_called_once()
+
+    @patch.object(LPCIBuilddBaseConfiguration, "wait_until_ready")
+    def test_launched_environment_ignores_stale_setup_snapshot(
+        self, mock_wait_until_ready
+    ):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.config_get.return_value = "old-setup-key"
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            setup_snapshot="setup-key",
+        ) as instance:
+            self.assertIsNotNone(instance)
+
+        mock_lxc._run_lxc.assert_not_called()
+        mock_lxc.config_set.assert_not_called()
+        mock_wait_until_ready.assert_not_called()
+
+    @patch.object(LPCIBuilddBaseConfiguration, "wait_until_ready")
+    def test_launched_environment_setup_snapshot_restore_error(
+        self, mock_wait_until_ready
+    ):
+        # If the setup snapshot cannot be restored, then the environment is
+        # set up from scratch.
+        expected_instance_name = "lpci-my-project-12345-focal-amd64"
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.config_get.return_value = "setup-key"
+        mock_lxc._run_lxc.side_effect = subprocess.CalledProcessError(
+            1, ["lxc", "restore"], stderr=b"No such snapshot"
+        )
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            setup_snapshot="setup-key",
+        ) as instance:
+            self.assertIsNotNone(instance)
+
+        mock_lxc.config_set.assert_called_once_with(
+            instance_name=expected_instance_name,
+            key="user.lpci.setup-snapshot",
+            value="",
+            project="test-project",
+            remote="test-remote",
+        )
+        mock_wait_until_ready.assert_not_called()
+
+    @patch.object(LPCIBuilddBaseConfiguration, "wait_until_ready")
+    def test_launched_environment_setup_snapshot_wait_error(
+        self, mock_wait_until_ready
+    ):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.config_get.return_value = "setup-key"
+        mock_wait_until_ready.side_effect = BaseConfigurationError("Timed out")
+        mock_launcher = Mock(spec=launch)
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        with self.assertRaisesRegex(CommandError, r"Timed out"):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+                setup_snapshot="setup-key",
+            ):
+                pass  # pragma: no cover
+
+        mock_launcher.return_value.stop.assert_called_once_with()
+
+    def test_has_setup_snapshot(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.config_get.return_value = "setup-key"
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+
+        self.assertTrue(provider.has_setup_snapshot(instance, "setup-key"))
+        self.assertFalse(provider.has_setup_snapshot(instance, "other-key"))
+        mock_lxc.config_get.assert_called_with(
+            instance_name="test-instance",
+            key="user.lpci.setup-snapshot",
+            project="test-project",
+            remote="test-remote",
+        )
+
+    def test_has_setup_snapshot_error(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.config_get.side_effect = LXDError("Fail")
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Fail$",
+            provider.has_setup_snapshot,
+            instance,
+            "setup-key",
+        )
+
+    def test_save_setup_snapshot(self):
+        mock_lxc = Mock(spec=LXC)
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+
+        provider.save_setup_snapshot(instance, "setup-key")
+
+        self.assertEqual(
+            [
+                call._run_lxc(
+                    ["delete", "test-remote:test-instance/lpci-setup"],
+                    check=False,
+                    capture_output=True,
+                    project="test-project",
+                ),
+                call._run_lxc(
+                    ["snapshot", "test-remote:test-instance", "lpci-setup"],
+                    check=True,
+                    capture_output=True,
+                    project="test-project",
+                ),
+                call.config_set(
+                    instance_name="test-instance",
+                    key="user.lpci.setup-snapshot",
+                    value="setup-key",
+                    project="test-project",
+                    remote="test-remote",
+                ),
+            ],
+            mock_lxc.mock_calls,
+        )
+
+    def test_save_setup_snapshot_snapshot_error(self):
+        # Failing to save a setup snapshot is not fatal, but the key is not
+        # recorded.
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc._run_lxc.side_effect = [
+            subprocess.CompletedProcess([], 1),
+            subprocess.CalledProcessError(
+                1, ["lxc", "snapshot"], stderr=b"Not supported"
+            ),
+        ]
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+
+        provider.save_setup_snapshot(instance, "setup-key")
+
+        mock_lxc.config_set.assert_not_called()
+
+    def test_save_setup_snapshot_config_error(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.config_set.side_effect = LXDError("Fail")
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Fail$",
+            provider.save_setup_snapshot,
+            instance,
+            "setup-key",
+        )
+
+    def test_launched_environment_holds_back_project_for_setup_snapshot(
+        self,
+    ):
+        # Without a setup snapshot to restore, the project and devices are
+        # only added once the setup snapshot has been saved, so that they
+        # aren't restored from it by later runs.
+        expected_instance_name = "lpci-my-project-12345-focal-amd64"
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.config_get.return_value = ""
+        mock_launcher = Mock(spec=launch)
+        mock_instance = mock_launcher.return_value
+        mock_instance.instance_name = expected_instance_name
+        mock_instance.default_command_environment = {}
+
+        def run_lxc(command, **kwargs):
+            if command[0] == "snapshot":
+                mock_instance.unmount_all.assert_called_once_with()
+            return subprocess.CompletedProcess([], 0)
+
+        mock_lxc._run_lxc.side_effect = run_lxc
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+        provider.package_proxy_port = 3142
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            setup_snapshot="setup-key",
+        ) as instance:
+            mock_instance.mount.assert_not_called()
+            self.assertEqual(
+                [
+                    _setup_command(
+                        "mkdir -p /build/lpci/project",
+                        "rm -f /usr/local/sbin/policy-rc.d",
+                    )
+                ],
+                [
+                    c.kwargs["command"]
+                    for c in mock_instance.lxc.exec.mock_calls
+                ],
+            )
+
+            provider.save_setup_snapshot(instance, "setup-key")
+
+            mock_instance.mount.assert_called_once_with(
+                host_source=self.mock_path, target=Path("/root/tmp-project")
+            )
+            mock_lxc.config_set.assert_called_once_with(
+                instance_name=expected_instance_name,
+                key="user.lpci.setup-snapshot",
+                value="setup-key",
+                project="test-project",
+                remote="test-remote",
+            )
+            # The package proxy is left out of the snapshot.
+            self.assertEqual(
+                [
+                    ["config", "device", "remove"],
+                    ["config", "device", "add"],
+                    ["config", "device", "remove"],
+                    ["delete"],
+                    ["snapshot"],
+                    ["config", "device", "remove"],
+                    ["config", "device", "add"],
+                ],
+                [
+                    c.args[0][: 3 if c.args[0][0] == "config" else 1]
+                    for c in mock_lxc._run_lxc.call_args_list
+                ],
+            )
+
+    def test_launched_environment_setup_snapshot_not_saved(self):
+        # If the job fails before the setup snapshot is saved, then the
+        # project was never made available, so there is no overlay to
+        # unmount.
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.config_get.return_value = ""
+        mock_launcher = Mock(spec=launch)
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        with self.assertRaisesRegex(CommandError, r"^Failed$"):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+                setup_snapshot="setup-key",
+                project_sync="overlay",
+            ):
+                raise CommandError("Failed")
+
+        mock_launcher.return_value.mount.assert_not_called()
+        mock_lxc._run_lxc.assert_not_called()
+        self.assertEqual(
+            1, len(mock_launcher.return_value.lxc.exec.mock_calls)
+        )
+        mock_launcher.return_value.unmount_all.assert_called_once_with()
+        mock_launcher.return_value.stop.assert_called_once_with()
+
+    def test_mount_read_only(self):
+        mock_lxc = Mock(spec=LXC)
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+        instance.is_mounted.return_value = False
+
+        provider.mount_read_only(
+            instance,
+            host_source=Path("/output/build/0/files"),
+            target=Path("/build/lpci/project/artifacts/files"),
+        )
+
+        instance.is_mounted.assert_called_once_with(
+            host_source=Path("/output/build/0/files"),
+            target=Path("/build/lpci/project/artifacts/files"),
+        )
+        mock_lxc._run_lxc.assert_called_once_with(
+            [
+                "config",
+                "device",
+                "add",
+                "test-remote:test-instance",
+                "disk-/build/lpci/project/artifacts/files",
+                "disk",
+                "source=/output/build/0/files",
+                "path=/build/lpci/project/artifacts/files",
+                "readonly=true",
+            ],
+            check=True,
+            capture_output=True,
+            project="test-project",
+        )
+
+    def test_mount_read_only_already_mounted(self):
+        mock_lxc = Mock(spec=LXC)
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+        instance.is_mounted.return_value = True
+
+        provider.mount_read_only(
+            instance,
+            host_source=Path("/output/build/0/files"),
+            target=Path("/build/lpci/project/artifacts/files"),
+        )
+
+        mock_lxc._run_lxc.assert_not_called()
+
+    def test_mount_read_only_error(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc._run_lxc.side_effect = subprocess.CalledProcessError(
+            1, ["lxc", "config"], stderr=b"Error: Invalid source path\n"
+        )
+        provider = makeLXDProvider(lxc=mock_lxc)
+        instance = Mock(instance_name="test-instance")
+        instance.is_mounted.return_value = False
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Failed to mount '/output/build/0/files' at "
+            r"'/build/lpci/project/artifacts/files': "
+            r"Error: Invalid source path$",
+            provider.mount_read_only,
+            instance,
+            host_source=Path("/output/build/0/files"),
+            target=Path("/build/lpci/project/artifacts/files"),
+        )
+
+    def test_mount_apt_cache(self):
+        provider = makeLXDProvider()
+        instance = Mock(instance_name="test-instance")
+
+        provider.mount_apt_cache(
+            instance,
+            archives_path=Path("/cache/archives"),
+            lists_path=Path("/cache/lists/focal-amd64"),
+        )
+
+        self.assertEqual(
+            [
+                call.mount(
+                    host_source=Path("/cache/archives"),
+                    target=Path("/var/cache/apt/archives"),
+                ),
+                call.mount(
+                    host_source=Path("/cache/lists/focal-amd64"),
+                    target=Path("/var/lib/apt/lists"),
+                ),
+            ],
+            instance.mock_calls,
+        )
+
+    def test_mount_apt_cache_without_lists(self):
+        provider = makeLXDProvider()
+        instance = Mock(instance_name="test-instance")
+
+        provider.mount_apt_cache(
+            instance, archives_path=Path("/cache/archives")
+        )
+
+        instance.mount.assert_called_once_with(
+            host_source=Path("/cache/archives"),
+            target=Path("/var/cache/apt/archives"),
+        )
+
+    def test_mount_apt_cache_error(self):
+        provider = makeLXDProvider()
+        instance = Mock(instance_name="test-instance")
+        instance.mount.side_effect = LXDError("Fail")
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Fail$",
+            provider.mount_apt_cache,
+            instance,
+            archives_path=Path("/cache/archives"),
+        )
+
+    def makePoolLXC(self, instances):
+        """Make a fake LXC client with some instances in the pool.
+
+        :param instances: A dict mapping instance names to pool states.
+        """
+        self.useFixture(
+            EnvironmentVariable(
+                "XDG_STATE_HOME", self.useFixture(TempDir()).path
+            )
+        )
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.lxc_path = Path("/snap/bin/lxc")
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc.list_names.side_effect = lambda **kwargs: list(instances)
+
+        def config_get(instance_name, key, **kwargs):
+            self.assertEqual("user.lpci.pool-state", key)
+            return instances[instance_name]
+
+        def config_set(instance_name, key, value, **kwargs):
+            self.assertEqual("user.lpci.pool-state", key)
+            instances[instance_name] = value
+
+        mock_lxc.config_get.side_effect = config_get
+        mock_lxc.config_set.side_effect = config_set
+        return mock_lxc
+
+    def test_fill_pool(self):
+        instances = {
+            "lpci-pool-focal-amd64-0": "claimed",
+            "lpci-pool-jammy-amd64-1": "ready",
+        }
+        mock_lxc = self.makePoolLXC(instances)
+        mock_launcher = Mock(spec=launch)
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        launched = provider.fill_pool(
+            series="focal", architecture="amd64", size=2
+        )
+
+        self.assertEqual(["lpci-pool-focal-amd64-1"], launched)
+        mock_launcher.assert_called_once_with(
+            name="lpci-pool-focal-amd64-1",
+            base_configuration=ANY,
+            image_name="focal",
+            image_remote="craft-com.ubuntu.cloud-buildd",
+            auto_clean=True,
+            auto_create_project=True,
+            map_user_uid=True,
+            use_base_instance=True,
+            project="test-project",
+            remote="test-remote",
+            lxc=mock_lxc,
+        )
+        self.assertEqual("ready", instances["lpci-pool-focal-amd64-1"])
+        mock_lxc._run_lxc.assert_called_once_with(
+            [
+                "snapshot",
+                "test-remote:lpci-pool-focal-amd64-1",
+                "lpci-pool-base",
+            ],
+            check=True,
+            capture_output=True,
+            project="test-project",
+        )
+
+    def test_fill_pool_snapshot_error(self):
+        mock_lxc = self.makePoolLXC({})
+        mock_lxc._run_lxc.side_effect = subprocess.CalledProcessError(
+            1, ["lxc", "snapshot"]
+        )
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"returned non-zero exit status 1",
+            provider.fill_pool,
+            series="focal",
+            architecture="amd64",
+            size=1,
+        )
+
+    def test_fill_pool_list_error(self):
+        mock_lxc = self.makePoolLXC({})
+        mock_lxc.list_names.side_effect = LXDError("Fail")
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Fail$",
+            provider.fill_pool,
+            series="focal",
+            architecture="amd64",
+            size=1,
+        )
+
+    def test_claim_pool_instance(self):
+        instances = {
+            "lpci-pool-focal-amd64-0": "claimed",
+            "lpci-pool-focal-amd64-1": "recycling",
+            "lpci-pool-focal-amd64-2": "ready",
+            "lpci-pool-jammy-amd64-0": "ready",
+        }
+        mock_lxc = self.makePoolLXC(instances)
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        self.assertEqual(
+            "lpci-pool-focal-amd64-2",
+            provider.claim_pool_instance(series="focal", architecture="amd64"),
+        )
+        self.assertEqual("claimed", instances["lpci-pool-focal-amd64-2"])
+        self.assertIsNone(
+            provider.claim_pool_instance(series="focal", architecture="amd64")
+        )
+        self.assertEqual("ready", instances["lpci-pool-jammy-amd64-0"])
+
+    def test_claim_pool_instance_config_error(self):
+        mock_lxc = self.makePoolLXC({"lpci-pool-focal-amd64-0": "ready"})
+        mock_lxc.config_set.side_effect = LXDError("Fail")
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Fail$",
+            provider.claim_pool_instance,
+            series="focal",
+            architecture="amd64",
+        )
+
+    def runPoolReset(self, instances, lxc_exit_statuses):
+        """Release a pooled instance, running the reset with a fake `lxc`.
+
+        :param lxc_exit_statuses: A dict mapping `lxc` subcommands to the
+            status with which the fake `lxc` exits for them.
+        :return: The `lxc` commands run by the reset, and its log.
+        """
+        tempdir = Path(self.useFixture(TempDir()).path)
+        calls_path = tempdir / "calls"
+        fake_lxc = tempdir / "lxc"
+        cases = "".join(
+            f"    {command}) exit {status} ;;\n"
+            for command, status in lxc_exit_statuses.items()
+        )
+        fake_lxc.write_text(
+            f'#! /bin/sh\necho "$*" >>{calls_path}\n'
+            f'case "$3" in\n{cases}esac\n'
+        )
+        fake_lxc.chmod(0o755)
+        mock_lxc = self.makePoolLXC(instances)
+        mock_lxc.lxc_path = fake_lxc
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        with patch("subprocess.Popen") as mock_popen:
+            provider.release_pool_instance("lpci-pool-focal-amd64-0")
+
+        [popen_call] = mock_popen.call_args_list
+        self.assertEqual(
+            {
+                "stdin": subprocess.DEVNULL,
+                "stdout": ANY,
+                "stderr": ANY,
+                "start_new_session": True,
+            },
+            popen_call.kwargs,
+        )
+        log_path = Path(popen_call.kwargs["stdout"].name)
+        self.assertEqual(
+            Path(os.environ["XDG_STATE_HOME"])
+            / "lpci"
+            / "pool"
+            / "lpci-pool-focal-amd64-0.log",
+            log_path,
+        )
+        with open(log_path, "wb") as log:
+            subprocess.run(popen_call.args[0], stdout=log, stderr=log)
+        return calls_path.read_text().splitlines(), log_path.read_text()
+
+    def test_release_pool_instance(self):
+        instances = {"lpci-pool-focal-amd64-0": "claimed"}
+
+        calls, log = self.runPoolReset(instances, {})
+
+        self.assertEqual("recycling", instances["lpci-pool-focal-amd64-0"])
+        self.assertEqual(
+            [
+                "--project test-project restore "
+                "test-remote:lpci-pool-focal-amd64-0 lpci-pool-base",
+                "--project test-project start "
+                "test-remote:lpci-pool-focal-amd64-0",
+            ],
+            calls,
+        )
+        self.assertEqual("", log)
+
+    def test_release_pool_instance_restore_error(self):
+        # An instance that can't be reset is deleted, rather than being
+        # left in the "recycling" state.
+        calls, log = self.runPoolReset(
+            {"lpci-pool-focal-amd64-0": "claimed"}, {"restore": 1}
+        )
+
+        self.assertEqual(
+            [
+                "--project test-project restore "
+                "test-remote:lpci-pool-focal-amd64-0 lpci-pool-base",
+                "--project test-project delete --force "
+                "test-remote:lpci-pool-focal-amd64-0",
+            ],
+            calls,
+        )
+        self.assertEqual(
+            "Failed to reset pooled environment "
+            "'lpci-pool-focal-amd64-0'; deleting it.\n",
+            log,
+        )
+
+    def test_release_pool_instance_start_error(self):
+        calls, _ = self.runPoolReset(
+            {"lpci-pool-focal-amd64-0": "claimed"}, {"start": 1}
+        )
+
+        self.assertEqual(
+            "--project test-project delete --force "
+            "test-remote:lpci-pool-focal-amd64-0",
+            calls[-1],
+        )
+
+    def test_release_pool_instance_config_error(self):
+        mock_lxc = self.makePoolLXC({"lpci-pool-focal-amd64-0": "claimed"})
+        mock_lxc.config_set.side_effect = LXDError("Fail")
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        with patch("subprocess.Popen") as mock_popen:
+            self.assertRaisesRegex(
+                CommandError,
+                r"^Fail$",
+                provider.release_pool_instance,
+                "lpci-pool-focal-amd64-0",
+            )
+
+        mock_popen.assert_not_called()
+
+    def test_clean_pool(self):
+        mock_lxc = self.makePoolLXC(
+            {
+                "lpci-my-project-12345-focal-amd64": "",
+                "lpci-pool-focal-amd64-0": "ready",
+                "lpci-pool-jammy-amd64-0": "claimed",
+            }
+        )
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        self.assertEqual(
+            ["lpci-pool-focal-amd64-0", "lpci-pool-jammy-amd64-0"],
+            provider.clean_pool(),
+        )
+        self.assertEqual(
+            [
+                call(
+                    instance_name=instance_name,
+                    force=True,
+                    project="test-project",
+                    remote="test-remote",
+                )
+                for instance_name in (
+                    "lpci-pool-focal-amd64-0",
+                    "lpci-pool-jammy-amd64-0",
+                )
+            ],
+            mock_lxc.delete.call_args_list,
+        )
+
+    def test_clean_pool_delete_error(self):
+        mock_lxc = self.makePoolLXC({"lpci-pool-focal-amd64-0": "ready"})
+        mock_lxc.delete.side_effect = LXDError("Fail")
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        self.assertRaisesRegex(CommandError, r"^Fail$", provider.clean_pool)
+
+    def test_launched_environment_uses_given_instance_name(self):
+        mock_lxc = self.makePoolLXC({})
+        mock_launcher = Mock(spec=launch)
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            instance_name="lpci-pool-focal-amd64-0",
+        ):
+            pass
+
+        self.assertEqual(
+            "lpci-pool-focal-amd64-0", mock_launcher.call_args.kwargs["name"]
+        )
+
+    def makeSyncLauncher(
+        self, find_output=b"", tar_returncode=0, tar_stderr=b"", tar_input=None
+    ):
+        """Make a launcher whose instance fakes the commands used to sync."""
+        if tar_input is None:
+            tar_input = io.BytesIO()
+            tar_input.close = lambda: None
+        self.tar_input = tar_input
+
+        def execute(*, command, runner, **kwargs):
+            if runner is subprocess.Popen:
+                kwargs["stderr"].write(tar_stderr)
+                return Mock(
+                    stdin=self.tar_input,
+                    **{"wait.return_value": tar_returncode},
+                )
+            elif command[0] == "bash":
+                return subprocess.CompletedProcess([], 0, stdout=find_output)
+            else:
+                return subprocess.CompletedProcess([], 0)
+
+        mock_launcher = Mock(spec=launch)
+        mock_launcher.return_value.lxc.exec.side_effect = execute
+        return mock_launcher
+
+    def test_launched_environment_incremental_sync(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        expected_instance_name = (
+            f"lpci-my-project-{project_path.stat().st_ino}-focal-amd64"
+        )
+        (project_path / "unchanged").write_text("unchanged")
+        os.utime(project_path / "unchanged", (1000, 1000))
+        (project_path / "changed").write_text("changed")
+        (project_path / "new").mkdir()
+        (project_path / "new" / "file").write_text("new")
+        os.chmod(project_path / "unchanged", 0o644)
+        find_output = b"".join(
+            b"\0".join(fields) + b"\0"
+            for fields in (
+                (b"unchanged", b"f", b"644", b"9", b"1000.5", b"", b"root"),
+                (b"changed", b"f", b"644", b"3", b"1000.0", b"", b"root"),
+                (b"stale", b"d", b"755", b"4096", b"1000.0", b"", b"root"),
+                (b"stale/file", b"f", b"644", b"1", b"1000.0", b"", b"root"),
+            )
+        )
+        mock_launcher = self.makeSyncLauncher(find_output=find_output)
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        def exec_call(command, **kwargs):
+            return call().lxc.exec(
+                instance_name=expected_instance_name,
+                command=command,
+                project="test-project",
+                remote="test-remote",
+                runner=subprocess.run,
+                **kwargs,
+            )
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_sync="incremental",
+        ):
+            self.assertEqual(
+                [
+                    exec_call(
+                        ["bash", "-c", ANY], check=True, capture_output=True
+                    ),
+                    exec_call(
+                        ["xargs", "-0", "rm", "-rf", "--"],
+                        cwd="/build/lpci/project",
+                        input=b"stale\0",
+                        check=True,
+                    ),
+                    call().lxc.exec(
+                        instance_name=expected_instance_name,
+                        command=[
+                            "tar",
+                            "-x",
+                            "-f",
+                            "-",
+                            "-C",
+                            "/build/lpci/project",
+                        ],
+                        project="test-project",
+                        remote="test-remote",
+                        runner=subprocess.Popen,
+                        stdin=subprocess.PIPE,
+                        stderr=ANY,
+                    ),
+                ],
+                mock_launcher.mock_calls[1:],
+            )
+            self.assertEqual(
+                [
+                    "set -o pipefail",
+                    "mkdir -p /build/lpci/project >&2 || "
+                    '{ echo "lpci-setup-failed:0:$?" >&2; exit 1; }',
+                    "rm -f /usr/local/sbin/policy-rc.d >&2 || "
+                    '{ echo "lpci-setup-failed:1:$?" >&2; exit 1; }',
+                    "find /build/lpci/project -mindepth 1 "
+                    r"-printf '%P\0%y\0%m\0%s\0%T@\0%l\0%u\0' || "
+                    '{ echo "lpci-setup-failed:2:$?" >&2; exit 1; }',
+                ],
+                mock_launcher.mock_calls[1].kwargs["command"][2].splitlines(),
+            )
+            mock_launcher.reset_mock()
+
+        # The project is left in place for the next job.
+        self.assertEqual(
+            [call().unmount_all(), call().stop()], mock_launcher.mock_calls
+        )
+        self.tar_input.seek(0)
+        with tarfile.open(fileobj=self.tar_input) as tar:
+            self.assertEqual(["changed", "new", "new/file"], tar.getnames())
+
+    def test_launched_environment_incremental_sync_no_changes(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        mock_launcher = self.makeSyncLauncher()
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_sync="incremental",
+        ):
+            pass
+
+        self.assertEqual(
+            ["bash"],
+            [
+                c.kwargs["command"][0]
+                for c in mock_launcher.return_value.lxc.exec.call_args_list
+            ],
+        )
+
+    def test_launched_environment_incremental_sync_tar_error(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / "file").write_text("file")
+        mock_launcher = self.makeSyncLauncher(
+            tar_returncode=2, tar_stderr=b"tar: No space left on device\n"
+        )
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with self.assertRaisesRegex(
+            CommandError,
+            r"^Failed to copy the project into "
+            r"'lpci-my-project-\d+-focal-amd64' \(exit status 2\): "
+            r"tar: No space left on device$",
+        ):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=project_path,
+                series="focal",
+                architecture="amd64",
+                project_sync="incremental",
+            ):
+                pass  # pragma: no cover
+
+        mock_launcher.return_value.stop.assert_called_once_with()
+
+    def test_launched_environment_incremental_sync_broken_pipe(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / "file").write_text("file")
+        tar_input = Mock(
+            **{
+                "write.side_effect": BrokenPipeError,
+                "close.side_effect": BrokenPipeError,
+            }
+        )
+        mock_launcher = self.makeSyncLauncher(
+            tar_returncode=2,
+            tar_stderr=b"tar: Cannot open: Permission denied\n",
+            tar_input=tar_input,
+        )
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with self.assertRaisesRegex(
+            CommandError,
+            r"^Failed to copy the project into "
+            r"'lpci-my-project-\d+-focal-amd64' \(exit status 2\): "
+            r"tar: Cannot open: Permission denied$",
+        ):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=project_path,
+                series="focal",
+                architecture="amd64",
+                project_sync="incremental",
+            ):
+                pass  # pragma: no cover
+
+        mock_launcher.return_value.stop.assert_called_once_with()
+
+    def test_launched_environment_overlay(self):
+        expected_instance_name = "lpci-my-project-12345-focal-amd64"
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_launcher = Mock(spec=launch)
+        mock_launcher.return_value.is_mounted.return_value = False
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        def exec_call(command):
+            return call().lxc.exec(
+                instance_name=expected_instance_name,
+                command=command,
+                project="test-project",
+                remote="test-remote",
+                runner=subprocess.run,
+                check=True,
+                capture_output=True,
+            )
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            project_sync="overlay",
+        ):
+            mock_lxc._run_lxc.assert_called_once_with(
+                [
+                    "config",
+                    "device",
+                    "add",
+                    f"test-remote:{expected_instance_name}",
+                    "disk-/root/tmp-project",
+                    "disk",
+                    f"source={self.mock_path}",
+                    "path=/root/tmp-project",
+                    "readonly=true",
+                ],
+                check=True,
+                capture_output=True,
+                project="test-project",
+            )
+            self.assertEqual(
+                [
+                    call().is_mounted(
+                        host_source=self.mock_path,
+                        target=Path("/root/tmp-project"),
+                    ),
+                    exec_call(
+                        _setup_command(
+                            "rm -rf /build/lpci/project /build/lpci/overlay",
+                            "mkdir -p /build/lpci/project "
+                            "/build/lpci/overlay/upper "
+                            "/build/lpci/overlay/work",
+                            "mount -t overlay overlay -o "
+                            "lowerdir=/root/tmp-project,"
+                            "upperdir=/build/lpci/overlay/upper,"
+                            "workdir=/build/lpci/overlay/work "
+                            "/build/lpci/project",
+                            "rm -f /usr/local/sbin/policy-rc.d",
+                        )
+                    ),
+                ],
+                mock_launcher.mock_calls[1:],
+            )
+            mock_launcher.reset_mock()
+
+        self.assertEqual(
+            [
+                exec_call(
+                    _setup_command(
+                        "umount /build/lpci/project",
+                        "rm -rf /build/lpci/overlay",
+                    )
+                ),
+                call().unmount_all(),
+                call().stop(),
+            ],
+            mock_launcher.mock_calls,
+        )
+
+    def test_launched_environment_overlay_already_mounted(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_launcher = Mock(spec=launch)
+        mock_launcher.return_value.is_mounted.return_value = True
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+            project_sync="overlay",
+            root=False,
+        ):
+            pass
+
+        mock_lxc._run_lxc.assert_not_called()
+        # Only the project's directories are given to a non-root user, so
+        # that the contents of files aren't copied up.
+        self.assertIn(
+            "find /build/lpci/project -type d -exec chown _lpci:_lpci '{}' +"
+            " >&2",
+            mock_launcher.return_value.lxc.exec.call_args_list[0].kwargs[
+                "command"
+            ][2],
+        )
+
+    def test_launched_environment_copy_with_ignore_file(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / ".lpciignore").write_text(".tox/\n")
+        (project_path / ".tox").mkdir()
+        (project_path / ".tox" / "file").write_text("ignored")
+        (project_path / "file").write_text("file")
+        mock_launcher = self.makeSyncLauncher()
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_ignore_files=[".lpciignore"],
+        ):
+            mock_launcher.return_value.mount.assert_not_called()
+            self.assertEqual(
+                [
+                    _setup_command(
+                        "rm -rf /build/lpci/project",
+                        "mkdir -p /build/lpci/project",
+                        "rm -f /usr/local/sbin/policy-rc.d",
+                    ),
+                    ["tar", "-x", "-f", "-", "-C", "/build/lpci/project"],
+                ],
+                [
+                    c.kwargs["command"]
+                    for c in mock_launcher.return_value.lxc.exec.call_args_list
+                ],
+            )
+            mock_launcher.reset_mock()
+
+        self.assertEqual(
+            ["rm", "-rf", "/build/lpci/project"],
+            mock_launcher.return_value.lxc.exec.call_args.kwargs["command"],
+        )
+        mock_launcher.return_value.unmount.assert_not_called()
+        self.tar_input.seek(0)
+        with tarfile.open(fileobj=self.tar_input) as tar:
+            self.assertEqual([".lpciignore", "file"], tar.getnames())
+
+    def test_launched_environment_copy_with_empty_ignore_file(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / ".lpciignore").write_text("# Nothing to ignore.\n")
+        mock_launcher = self.makeSyncLauncher()
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_ignore_files=[".lpciignore"],
+        ):
+            pass
+
+        mock_launcher.return_value.mount.assert_called_once_with(
+            host_source=project_path, target=Path("/root/tmp-project")
+        )
+        mock_launcher.return_value.unmount.assert_called_once_with(
+            target=Path("/root/tmp-project")
+        )
+
+    @patch("lpci.providers._lxd.get_host_entries")
+    def test_launched_environment_copy_without_ignore_file(
+        self, mock_get_host_entries
+    ):
+        # Without any ignore files in the project, the project isn't
+        # walked on the host.
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / "subdir").mkdir()
+        (project_path / "subdir" / "file").write_text("file")
+        mock_launcher = self.makeSyncLauncher()
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_ignore_files=[".lpciignore"],
+        ):
+            pass
+
+        mock_get_host_entries.assert_not_called()
+        mock_launcher.return_value.mount.assert_called_once_with(
+            host_source=project_path, target=Path("/root/tmp-project")
+        )
+
+    def test_launched_environment_copy_with_nested_ignore_file(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / "subdir").mkdir()
+        (project_path / "subdir" / ".lpciignore").write_text("ignored\n")
+        (project_path / "subdir" / "ignored").write_text("ignored")
+        (project_path / "subdir" / "file").write_text("file")
+        mock_launcher = self.makeSyncLauncher()
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_ignore_files=[".lpciignore"],
+        ):
+            pass
+
+        mock_launcher.return_value.mount.assert_not_called()
+        self.tar_input.seek(0)
+        with tarfile.open(fileobj=self.tar_input) as tar:
+            self.assertEqual(
+                ["subdir", "subdir/.lpciignore", "subdir/file"],
+                sorted(tar.getnames()),
+            )
+
+    def test_launched_environment_incremental_sync_keeps_ignored_paths(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / ".lpciignore").write_text(".tox/\n")
+        os.chmod(project_path / ".lpciignore", 0o644)
+        os.utime(project_path / ".lpciignore", (1000, 1000))
+        find_output = b"".join(
+            b"\0".join(fields) + b"\0"
+            for fields in (
+                (b".lpciignore", b"f", b"644", b"6", b"1000.0", b"", b"root"),
+                (b".tox", b"d", b"755", b"4096", b"1000.0", b"", b"root"),
+                (b".tox/py3", b"d", b"755", b"4096", b"1000.0", b"", b"root"),
+                (b"stale", b"f", b"644", b"1", b"1000.0", b"", b"root"),
+            )
+        )
+        mock_launcher = self.makeSyncLauncher(find_output=find_output)
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            project_sync="incremental",
+            project_ignore_files=[".lpciignore"],
+        ):
+            pass
+
+        self.assertEqual(
+            ["bash", "xargs"],
+            [
+                c.kwargs["command"][0]
+                for c in mock_launcher.return_value.lxc.exec.call_args_list
+            ],
+        )
+        self.assertEqual(
+            b"stale\0",
+            mock_launcher.return_value.lxc.exec.call_args_list[1].kwargs[
+                "input"
+            ],
+        )
+
+    def test_launched_environment_overlay_mount_error(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.return_value = {"config": {}, "devices": {}}
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        mock_lxc._run_lxc.side_effect = subprocess.CalledProcessError(
+            1, ["lxc", "config", "device", "add"]
+        )
+        mock_launcher = Mock(spec=launch)
+        mock_launcher.return_value.is_mounted.return_value = False
+        provider = makeLXDProvider(lxc=mock_lxc, lxd_launcher=mock_launcher)
+
+        with self.assertRaisesRegex(
+            CommandError, r"returned non-zero exit status 1"
+        ):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+                project_sync="overlay",
+            ):
+                pass  # pragma: no cover
+
+        mock_launcher.return_value.stop.assert_called_once_with()
+
+    def test_launched_environment_incremental_sync_default_user(self):
+        project_path = Path(self.useFixture(TempDir()).path)
+        (project_path / "file").write_text("file")
+        mock_launcher = self.makeSyncLauncher()
+        provider = makeLXDProvider(lxd_launcher=mock_launcher)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=project_path,
+            series="focal",
+            architecture="amd64",
+            root=False,
+            project_sync="incremental",
+        ):
+            pass
+
+        script = mock_launcher.return_value.lxc.exec.call_args_list[0].kwargs[
+            "command"
+        ][2]
+        self.assertEqual(
+            [
+                "set -o pipefail",
+                "sh -c 'getent passwd _lpci >/dev/null"
+                " || useradd -m -U _lpci'",
+                "mkdir -p /build/lpci/project",
+                "chown _lpci:_lpci /build/lpci/project",
+                "rm -f /usr/local/sbin/policy-rc.d",
+            ],
+            [line.split(" >&2 || ")[0] for line in script.splitlines()[:-1]],
+        )
+        self.assertTrue(script.splitlines()[-1].startswith("find "))
+        self.tar_input.seek(0)
+        with tarfile.open(fileobj=self.tar_input) as tar:
+            self.assertEqual("_lpci", tar.getmember("file").uname)
+
+    def test_launched_environment_sets_up_project_once(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            {"config": {}, "devices": {"eth0": {}}}
+        )
+        mock_lxc.project_list.return_value = []
+        mock_lxc.remote_list.return_value = {}
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        for series in ("focal", "focal", "jammy"):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series=series,
+                architecture="amd64",
+            ):
+                pass
+
+        self.assertEqual(1, mock_lxc.remote_add.call_count)
+        mock_lxc.project_list.assert_called_once_with("test-remote")
+        mock_lxc.project_create.assert_called_once_with(
+            project="test-project", remote="test-remote"
+        )
+        self.assertEqual(2, mock_lxc.profile_show.call_count)
+        mock_lxc.profile_edit.assert_called_once()
+
+    def test_launched_environment_reconfigures_profile_for_gpu_nvidia(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            {"config": {}, "devices": {}}
+        )
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        for gpu_nvidia in (False, True, True):
+            with provider.launched_environment(
+                project_name="my-project",
+                project_path=self.mock_path,
+                series="focal",
+                architecture="amd64",
+                gpu_nvidia=gpu_nvidia,
+            ):
+                pass
+
+        self.assertEqual(
+            [
+                call(
+                    profile="default",
+                    config={"config": {}, "devices": {}},
+                    project="test-project",
+                    remote="test-remote",
+                ),
+                call(
+                    profile="default",
+                    config={
+                        "config": {"nvidia.runtime": "true"},
+                        "devices": {"gpu": {"type": "gpu"}},
+                    },
+                    project="test-project",
+                    remote="test-remote",
+                ),
+            ],
+            mock_lxc.profile_edit.call_args_list,
+        )
+
+    def test_launched_environment_skips_matching_profile(self):
+        mock_lxc = Mock(spec=LXC)
+        mock_lxc.profile_show.side_effect = makeProfileShow(
+            {
+                "config": {},
+                "description": "Default LXD profile",
+                "devices": {"eth0": {"type": "nic"}},
+                "name": "default",
+                "used_by": [],
+            },
+            project_profile={
+                "config": {},
+                "description": "Default LXD profile",
+                "devices": {"eth0": {"type": "nic"}},
+                "name": "default",
+                "used_by": ["/1.0/instances/lpci-my-project?project=lpci"],
+            },
+        )
+        mock_lxc.project_list.return_value = ["test-project"]
+        mock_lxc.remote_list.return_value = {}
+        provider = makeLXDProvider(lxc=mock_lxc)
+
+        with provider.launched_environment(
+            project_name="my-project",
+            project_path=self.mock_path,
+            series="focal",
+            architecture="amd64",
+        ):
+            pass
+
+        mock_lxc.project_create.assert_not_called()
+        mock_lxc.profile_edit.assert_not_called()
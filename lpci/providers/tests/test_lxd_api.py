@@ -0,0 +1,784 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import http.client
+import itertools
+import json
+import os
+import re
+import socketserver
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path, PurePath
+from unittest.mock import patch
+from urllib.parse import parse_qsl
+
+from craft_providers.lxd import LXC, LXDError
+from fixtures import EnvironmentVariable, Fixture, TempDir
+from testtools import TestCase
+
+from lpci.providers._lxd_api import LXDAPIClient, find_lxd_socket
+
+
+class FakeLXDRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    lxd: "FakeLXD"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.lxd.connections += 1
+
+    def finish(self):
+        super().finish()
+        self.lxd.closed_connections += 1
+
+    def handle_one_request(self):
+        super().handle_one_request()
+        if self.lxd.drop_connections:
+            self.close_connection = True
+
+    def do_request(self):
+        self.lxd.handle(self)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_request
+
+
+class FakeLXD(Fixture):
+    """A fake LXD daemon listening on a unix socket.
+
+    Commands run in instances are really run on the host, and files in
+    instances are kept in memory.
+    """
+
+    def _setUp(self):
+        self.directory = Path(self.useFixture(TempDir()).path)
+        self.socket_path = self.directory / "unix.socket"
+        self.instances = {}
+        self.files = {}
+        self.logs = {}
+        self.profiles = {}
+        self.projects = ["default"]
+        self.operations = {}
+        self.requests = []
+        self.connections = 0
+        self.closed_connections = 0
+        self.drop_connections = False
+        self.hang_operations = False
+        self._ids = itertools.count()
+        handler_class = type(
+            "Handler", (FakeLXDRequestHandler,), {"lxd": self}
+        )
+        self.server = socketserver.ThreadingUnixStreamServer(
+            str(self.socket_path), handler_class
+        )
+        self.server.daemon_threads = True
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01}
+        )
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def add_instance(self, name, status="Running", config=None, devices=None):
+        self.instances[name] = {
+            "name": name,
+            "status": status,
+            "config": dict(config or {}),
+            "devices": dict(devices or {}),
+        }
+
+    def send(self, handler, status, body, headers=None):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers = {"Content-Type": "application/json"}
+        handler.send_response(status)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def sync(self, handler, metadata=None):
+        self.send(
+            handler,
+            200,
+            {"type": "sync", "status_code": 200, "metadata": metadata},
+        )
+
+    def error(self, handler, status, message):
+        self.send(
+            handler,
+            status,
+            {"type": "error", "error": message, "error_code": status},
+        )
+
+    def operation(self, handler, metadata=None, error=None):
+        operation_id = str(next(self._ids))
+        self.operations[operation_id] = (metadata, error)
+        self.send(
+            handler,
+            202,
+            {
+                "type": "async",
+                "operation": f"/1.0/operations/{operation_id}",
+                "metadata": {},
+            },
+        )
+
+    def handle(self, handler):
+        method = handler.command
+        path, _, query = handler.path.partition("?")
+        params = dict(parse_qsl(query))
+        length = int(handler.headers.get("Content-Length", 0))
+        body = handler.rfile.read(length)
+        self.requests.append((method, path, params))
+
+        match = re.match(r"^/1\.0/operations/(\d+)/wait$", path)
+        if match:
+            metadata, error = self.operations[match.group(1)]
+            if self.hang_operations:
+                return self.sync(
+                    handler, {"status": "Running", "status_code": 103}
+                )
+            elif error is not None:
+                return self.sync(
+                    handler,
+                    {"status": "Failure", "status_code": 400, "err": error},
+                )
+            return self.sync(
+                handler,
+                {
+                    "status": "Success",
+                    "status_code": 200,
+                    "metadata": metadata,
+                },
+            )
+
+        if path == "/1.0/instances":
+            return self.sync(handler, list(self.instances.values()))
+        if path == "/1.0/projects" and method == "GET":
+            return self.sync(
+                handler, [{"name": name} for name in self.projects]
+            )
+        if path == "/1.0/projects" and method == "POST":
+            self.projects.append(json.loads(body)["name"])
+            return self.sync(handler)
+
+        match = re.match(r"^/1\.0/profiles/([^/]+)$", path)
+        if match:
+            if method == "GET":
+                return self.sync(handler, self.profiles[match.group(1)])
+            self.profiles[match.group(1)] = json.loads(body)
+            return self.sync(handler)
+
+        match = re.match(r"^/1\.0/instances/([^/]+)(/.*)?$", path)
+        if not match or match.group(1) not in self.instances:
+            return self.error(handler, 404, "Instance not found")
+        name, subpath = match.groups()
+        instance = self.instances[name]
+        if subpath is None and method == "GET":
+            return self.sync(handler, instance)
+        elif subpath is None and method == "PATCH":
+            instance["config"].update(json.loads(body)["config"])
+            return self.sync(handler)
+        elif subpath is None and method == "DELETE":
+            if instance["status"] == "Running":
+                return self.operation(handler, error="Instance is running")
+            del self.instances[name]
+            return self.operation(handler)
+        elif subpath == "/state":
+            data = json.loads(body)
+            instance["status"] = (
+                "Running" if data["action"] == "start" else "Stopped"
+            )
+            instance["last_state_change"] = data
+            return self.operation(handler)
+        elif subpath == "/exec":
+            data = json.loads(body)
+            proc = subprocess.run(
+                data["command"], cwd=data.get("cwd"), capture_output=True
+            )
+            log_id = next(self._ids)
+            output = {}
+            for fd, log in (("1", proc.stdout), ("2", proc.stderr)):
+                log_name = (
+                    f"exec_{log_id}.{'stdout' if fd == '1' else 'stderr'}"
+                )
+                log_path = f"/1.0/instances/{name}/logs/{log_name}"
+                self.logs[log_path] = log
+                output[fd] = log_path
+            return self.operation(
+                handler, {"return": proc.returncode, "output": output}
+            )
+        elif subpath.startswith("/logs/"):
+            if method == "GET":
+                return self.send(handler, 200, self.logs[path])
+            del self.logs[path]
+            return self.sync(handler)
+        elif subpath == "/files" and method == "GET":
+            if (name, params["path"]) not in self.files:
+                return self.error(handler, 404, "File not found")
+            content, headers = self.files[(name, params["path"])]
+            return self.send(
+                handler, 200, content, {"X-LXD-type": "file", **headers}
+            )
+        elif subpath == "/files" and method == "POST":
+            if not params["path"].startswith("/"):
+                return self.error(handler, 400, "Path must be absolute")
+            self.files[(name, params["path"])] = (
+                body,
+                {
+                    key: handler.headers[key]
+                    for key in ("X-LXD-mode", "X-LXD-uid", "X-LXD-gid")
+                },
+            )
+            return self.sync(handler)
+        return self.error(handler, 404, "Not found")  # pragma: no cover
+
+
+class TestFindLXDSocket(TestCase):
+    def test_lxd_dir(self):
+        fake_lxd = self.useFixture(FakeLXD())
+        self.useFixture(
+            EnvironmentVariable("LXD_DIR", str(fake_lxd.directory))
+        )
+
+        self.assertEqual(fake_lxd.socket_path, find_lxd_socket())
+
+    def test_lxd_dir_without_socket(self):
+        tempdir = self.useFixture(TempDir()).path
+        self.useFixture(EnvironmentVariable("LXD_DIR", tempdir))
+
+        self.assertIsNone(find_lxd_socket())
+
+    def test_default_paths(self):
+        fake_lxd = self.useFixture(FakeLXD())
+        self.useFixture(EnvironmentVariable("LXD_DIR"))
+        missing_path = fake_lxd.directory / "missing.socket"
+
+        with patch(
+            "lpci.providers._lxd_api._LXD_SOCKET_PATHS",
+            (missing_path, fake_lxd.socket_path),
+        ):
+            self.assertEqual(fake_lxd.socket_path, find_lxd_socket())
+
+
+class TestLXDAPIClient(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.fake_lxd = self.useFixture(FakeLXD())
+        self.fake_lxd.projects.append("lpci")
+        self.fake_lxd.add_instance("test-instance")
+        self.client = LXDAPIClient(self.fake_lxd.socket_path)
+
+    def exec(self, command, **kwargs):
+        return self.client.exec(
+            command=command,
+            instance_name="test-instance",
+            project="lpci",
+            **kwargs,
+        )
+
+    def test_exec_capture_output(self):
+        proc = self.exec(
+            ["sh", "-c", "echo out; echo err >&2; exit 3"],
+            capture_output=True,
+        )
+
+        self.assertEqual(3, proc.returncode)
+        self.assertEqual(b"out\n", proc.stdout)
+        self.assertEqual(b"err\n", proc.stderr)
+        # The recorded output is removed from the instance.
+        self.assertEqual({}, self.fake_lxd.logs)
+
+    def test_exec_cwd(self):
+        tempdir = self.useFixture(TempDir()).path
+
+        proc = self.exec(["pwd"], cwd=tempdir, capture_output=True)
+
+        self.assertEqual(f"{tempdir}\n".encode(), proc.stdout)
+
+    def test_exec_text_and_check(self):
+        error = self.assertRaises(
+            subprocess.CalledProcessError,
+            self.exec,
+            ["sh", "-c", "echo out; echo err >&2; exit 1"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+        self.assertEqual(1, error.returncode)
+        self.assertEqual("out\n", error.stdout)
+        self.assertEqual("err\n", error.stderr)
+
+    def test_exec_stderr_to_stdout(self):
+        proc = self.exec(
+            ["sh", "-c", "echo out; echo err >&2"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+        self.assertEqual(b"out\nerr\n", proc.stdout)
+        self.assertIsNone(proc.stderr)
+
+    def test_exec_devnull(self):
+        proc = self.exec(
+            ["sh", "-c", "echo out; echo err >&2"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+
+        self.assertIsNone(proc.stdout)
+        self.assertEqual("err\n", proc.stderr)
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    def test_exec_inherits_output(self, mock_stdout, mock_stderr):
+        proc = self.exec(
+            ["sh", "-c", "echo out; echo err >&2"],
+            text=True,
+        )
+
+        self.assertIsNone(proc.stdout)
+        self.assertIsNone(proc.stderr)
+        mock_stdout.buffer.write.assert_called_once_with(b"out\n")
+        mock_stderr.buffer.write.assert_called_once_with(b"err\n")
+
+    def test_exec_timeout(self):
+        self.fake_lxd.hang_operations = True
+
+        self.assertRaises(
+            subprocess.TimeoutExpired,
+            self.exec,
+            ["true"],
+            capture_output=True,
+            timeout=0.5,
+        )
+        self.assertEqual(
+            ("GET", "/1.0/operations/1/wait", {"timeout": "1"}),
+            self.fake_lxd.requests[-1],
+        )
+
+    def test_exec_missing_instance(self):
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to execute command in instance 'missing'\.\n"
+            r"Instance not found",
+            self.client.exec,
+            command=["true"],
+            instance_name="missing",
+            capture_output=True,
+        )
+
+    @patch.object(LXC, "exec")
+    def test_exec_falls_back_to_cli(self, mock_exec):
+        # Commands whose output is streamed or that need input use the CLI.
+        for kwargs in (
+            {"stdout": 1, "stderr": 1},
+            {"capture_output": True, "stderr": 2},
+            {"input": b"data"},
+            {"mode": "interactive"},
+            {"runner": subprocess.Popen},
+            {"remote": "other"},
+        ):
+            mock_exec.reset_mock()
+
+            self.exec(["true"], **kwargs)
+
+            mock_exec.assert_called_once()
+        self.assertEqual([], self.fake_lxd.requests)
+
+    def test_file_push(self):
+        source = Path(self.useFixture(TempDir()).path) / "source"
+        source.write_bytes(b"contents")
+        source.chmod(0o640)
+
+        self.client.file_push(
+            instance_name="test-instance",
+            source=source,
+            destination=PurePath("/root/file"),
+            project="lpci",
+        )
+        self.client.file_push(
+            instance_name="test-instance",
+            source=source,
+            destination=PurePath("/root/other"),
+            uid=0,
+            gid=0,
+            mode="0755",
+            project="lpci",
+        )
+
+        st = source.stat()
+        self.assertEqual(
+            {
+                ("test-instance", "/root/file"): (
+                    b"contents",
+                    {
+                        "X-LXD-mode": "0640",
+                        "X-LXD-uid": str(st.st_uid),
+                        "X-LXD-gid": str(st.st_gid),
+                    },
+                ),
+                ("test-instance", "/root/other"): (
+                    b"contents",
+                    {"X-LXD-mode": "0755", "X-LXD-uid": "0", "X-LXD-gid": "0"},
+                ),
+            },
+            self.fake_lxd.files,
+        )
+
+    def test_file_push_error(self):
+        source = Path(self.useFixture(TempDir()).path) / "source"
+        source.write_bytes(b"contents")
+
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to push file .* to instance 'test-instance'\.\n"
+            r"Path must be absolute",
+            self.client.file_push,
+            instance_name="test-instance",
+            source=source,
+            destination=PurePath("relative"),
+            project="lpci",
+        )
+
+    def test_file_push_missing_source(self):
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to push file '/nonexistent'",
+            self.client.file_push,
+            instance_name="test-instance",
+            source=Path("/nonexistent"),
+            destination=PurePath("/root/file"),
+            project="lpci",
+        )
+
+    def test_file_pull(self):
+        destination = Path(self.useFixture(TempDir()).path) / "a" / "file"
+        self.fake_lxd.files[("test-instance", "/root/file")] = (
+            b"contents",
+            {},
+        )
+
+        self.client.file_pull(
+            instance_name="test-instance",
+            source=PurePath("/root/file"),
+            destination=destination,
+            create_dirs=True,
+            project="lpci",
+        )
+
+        self.assertEqual(b"contents", destination.read_bytes())
+
+    def test_file_pull_keeps_mode(self):
+        destination = Path(self.useFixture(TempDir()).path) / "file"
+        self.fake_lxd.files[("test-instance", "/root/file")] = (
+            b"#! /bin/sh\n",
+            {"X-LXD-mode": "0755", "X-LXD-uid": "0", "X-LXD-gid": "0"},
+        )
+
+        self.client.file_pull(
+            instance_name="test-instance",
+            source=PurePath("/root/file"),
+            destination=destination,
+            project="lpci",
+        )
+
+        self.assertEqual(0o755, destination.stat().st_mode & 0o7777)
+
+    def test_file_pull_directory(self):
+        tempdir = Path(self.useFixture(TempDir()).path)
+        self.fake_lxd.files[("test-instance", "/root/dir")] = (
+            b'{"type": "sync", "metadata": ["file"]}',
+            {"X-LXD-type": "directory", "X-LXD-mode": "0755"},
+        )
+
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to pull file '/root/dir' from instance "
+            r"'test-instance'\.\n'/root/dir' is not a regular file\.",
+            self.client.file_pull,
+            instance_name="test-instance",
+            source=PurePath("/root/dir"),
+            destination=tempdir / "dir",
+            project="lpci",
+        )
+        self.assertFalse((tempdir / "dir").exists())
+        # The connection is still usable.
+        self.assertEqual(
+            ["test-instance"], self.client.list_names(project="lpci")
+        )
+
+    def test_file_pull_missing_file(self):
+        tempdir = Path(self.useFixture(TempDir()).path)
+
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to pull file '/root/file' from instance "
+            r"'test-instance'\.\nFile not found",
+            self.client.file_pull,
+            instance_name="test-instance",
+            source=PurePath("/root/file"),
+            destination=tempdir / "file",
+            project="lpci",
+        )
+        self.assertFalse((tempdir / "file").exists())
+
+    def test_file_pull_missing_destination_directory(self):
+        tempdir = Path(self.useFixture(TempDir()).path)
+        self.fake_lxd.files[("test-instance", "/root/file")] = (b"", {})
+
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to pull file '/root/file'.*\n.*No such file",
+            self.client.file_pull,
+            instance_name="test-instance",
+            source=PurePath("/root/file"),
+            destination=tempdir / "missing" / "file",
+            project="lpci",
+        )
+
+    def test_list(self):
+        self.assertEqual(
+            ["test-instance"],
+            self.client.list_names(project="lpci"),
+        )
+
+    def test_config(self):
+        self.client.config_set(
+            instance_name="test-instance",
+            key="user.lpci.test",
+            value="value",
+            project="lpci",
+        )
+
+        self.assertEqual(
+            "value",
+            self.client.config_get(
+                instance_name="test-instance",
+                key="user.lpci.test",
+                project="lpci",
+            ),
+        )
+        self.assertEqual(
+            "",
+            self.client.config_get(
+                instance_name="test-instance",
+                key="user.lpci.other",
+                project="lpci",
+            ),
+        )
+
+    def test_config_device_show(self):
+        self.fake_lxd.add_instance(
+            "other-instance",
+            devices={"disk-/root/project": {"type": "disk"}},
+        )
+
+        self.assertEqual(
+            {"disk-/root/project": {"type": "disk"}},
+            self.client.config_device_show(
+                instance_name="other-instance", project="lpci"
+            ),
+        )
+
+    def test_start_and_stop(self):
+        self.client.stop(
+            instance_name="test-instance", force=True, project="lpci"
+        )
+
+        instance = self.fake_lxd.instances["test-instance"]
+        self.assertEqual("Stopped", instance["status"])
+        self.assertEqual(
+            {"action": "stop", "force": True, "timeout": -1},
+            instance["last_state_change"],
+        )
+
+        self.client.start(instance_name="test-instance", project="lpci")
+
+        self.assertEqual("Running", instance["status"])
+
+    def test_delete(self):
+        self.fake_lxd.add_instance("stopped", status="Stopped")
+
+        self.client.delete(instance_name="stopped", force=True, project="lpci")
+        self.client.delete(
+            instance_name="test-instance", force=True, project="lpci"
+        )
+
+        self.assertEqual({}, self.fake_lxd.instances)
+
+    def test_delete_running(self):
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to delete instance 'test-instance'\.\n"
+            r"Instance is running",
+            self.client.delete,
+            instance_name="test-instance",
+            project="lpci",
+        )
+
+    def test_profile(self):
+        self.fake_lxd.profiles["default"] = {
+            "config": {},
+            "description": "Default LXD profile",
+            "devices": {},
+            "name": "default",
+            "used_by": [],
+        }
+
+        profile = self.client.profile_show(profile="default", project="lpci")
+        profile["devices"]["gpu"] = {"type": "gpu"}
+        self.client.profile_edit(
+            profile="default", config=profile, project="lpci"
+        )
+
+        self.assertEqual(
+            {
+                "config": {},
+                "description": "Default LXD profile",
+                "devices": {"gpu": {"type": "gpu"}},
+            },
+            self.fake_lxd.profiles["default"],
+        )
+
+    def test_projects(self):
+        self.client.project_create(project="new")
+
+        self.assertEqual(
+            ["default", "lpci", "new"], self.client.project_list()
+        )
+
+    def test_falls_back_to_cli_for_other_remotes(self):
+        source = PurePath("/source")
+        destination = PurePath("/destination")
+        for name, kwargs in (
+            (
+                "file_pull",
+                {
+                    "instance_name": "i",
+                    "source": source,
+                    "destination": destination,
+                },
+            ),
+            (
+                "file_push",
+                {
+                    "instance_name": "i",
+                    "source": source,
+                    "destination": destination,
+                },
+            ),
+            ("list", {}),
+            ("config_get", {"instance_name": "i", "key": "k"}),
+            ("config_set", {"instance_name": "i", "key": "k", "value": "v"}),
+            ("config_device_show", {"instance_name": "i"}),
+            ("start", {"instance_name": "i"}),
+            ("stop", {"instance_name": "i"}),
+            ("delete", {"instance_name": "i"}),
+            ("profile_show", {"profile": "default"}),
+            ("profile_edit", {"profile": "default", "config": {}}),
+            ("project_create", {"project": "p"}),
+        ):
+            with patch.object(LXC, name) as mock_method:
+                getattr(self.client, name)(remote="other", **kwargs)
+
+            mock_method.assert_called_once()
+            self.assertEqual("other", mock_method.call_args.kwargs["remote"])
+        with patch.object(LXC, "project_list") as mock_project_list:
+            self.client.project_list("other")
+        mock_project_list.assert_called_once_with(remote="other")
+        self.assertEqual([], self.fake_lxd.requests)
+
+    def test_falls_back_to_cli_for_recursive_transfers(self):
+        with patch.object(LXC, "file_pull") as mock_file_pull:
+            self.client.file_pull(
+                instance_name="test-instance",
+                source=PurePath("/root/dir"),
+                destination=Path("dir"),
+                recursive=True,
+            )
+        with patch.object(LXC, "file_push") as mock_file_push:
+            self.client.file_push(
+                instance_name="test-instance",
+                source=Path("file"),
+                destination=PurePath("/root/new/file"),
+                create_dirs=True,
+            )
+
+        mock_file_pull.assert_called_once()
+        mock_file_push.assert_called_once()
+        self.assertEqual([], self.fake_lxd.requests)
+
+    def test_reuses_connection(self):
+        for _ in range(3):
+            self.exec(["true"], capture_output=True)
+
+        self.assertEqual(1, self.fake_lxd.connections)
+
+    def test_connection_per_thread(self):
+        thread = threading.Thread(target=self.client.list)
+        thread.start()
+        thread.join()
+        self.client.list()
+
+        self.assertEqual(2, self.fake_lxd.connections)
+
+    def test_reconnects(self):
+        # If the daemon closes an idle connection, then requests without
+        # side effects are retried on a new one, and other requests are
+        # sent on a new one in the first place.
+        source = Path(self.useFixture(TempDir()).path) / "source"
+        source.write_bytes(b"contents")
+        self.fake_lxd.drop_connections = True
+
+        self.client.list()
+        self.client.list()
+        while self.fake_lxd.closed_connections < 2:
+            time.sleep(0.01)
+        self.client.file_push(
+            instance_name="test-instance",
+            source=source,
+            destination=PurePath("/root/file"),
+            project="lpci",
+        )
+
+        self.assertEqual(3, self.fake_lxd.connections)
+        self.assertEqual(
+            b"contents",
+            self.fake_lxd.files[("test-instance", "/root/file")][0],
+        )
+
+    def test_does_not_retry_requests_with_side_effects(self):
+        with patch.object(
+            http.client.HTTPConnection,
+            "getresponse",
+            side_effect=http.client.RemoteDisconnected("closed"),
+        ) as mock_getresponse:
+            self.assertRaisesRegex(
+                LXDError,
+                r"Failed to execute command in instance",
+                self.exec,
+                ["true"],
+                capture_output=True,
+            )
+
+        mock_getresponse.assert_called_once_with()
+
+    def test_daemon_not_running(self):
+        os.unlink(self.fake_lxd.socket_path)
+
+        self.assertRaisesRegex(
+            LXDError,
+            r"Failed to list instances\.\n.*No such file",
+            self.client.list,
+        )
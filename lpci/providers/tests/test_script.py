@@ -0,0 +1,78 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import subprocess
+
+from testtools import TestCase
+
+from lpci.errors import CommandError
+from lpci.providers._script import SetupScript
+
+
+class TestSetupScript(TestCase):
+    def run_script(self, script):
+        return subprocess.run(script.render(), capture_output=True, text=True)
+
+    def test_render(self):
+        script = SetupScript()
+        script.add("create a directory", ["mkdir", "-p", "/tmp/a b"])
+        script.add("list files", ["ls", "-1"], ["sort"], output=True)
+
+        self.assertEqual(
+            [
+                "bash",
+                "-c",
+                "set -o pipefail\n"
+                "mkdir -p '/tmp/a b' >&2 || "
+                '{ echo "lpci-setup-failed:0:$?" >&2; exit 1; }\n'
+                "ls -1 | sort || "
+                '{ echo "lpci-setup-failed:1:$?" >&2; exit 1; }',
+            ],
+            script.render(),
+        )
+
+    def test_run_succeeds(self):
+        script = SetupScript()
+        script.add("say hello", ["echo", "hello"])
+        script.add("say goodbye", ["echo", "goodbye"], output=True)
+
+        proc = self.run_script(script)
+
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual("goodbye\n", proc.stdout)
+        self.assertEqual("hello\n", proc.stderr)
+
+    def test_run_stops_at_failure(self):
+        script = SetupScript()
+        script.add("succeed", ["true"])
+        script.add("fail", ["sh", "-c", "echo oops; exit 3"])
+        script.add("fail in a pipeline", ["false"], ["cat"])
+
+        proc = self.run_script(script)
+
+        self.assertEqual(1, proc.returncode)
+        self.assertEqual("", proc.stdout)
+        self.assertEqual(
+            CommandError("Failed to fail (exit status 3): oops"),
+            script.get_error(proc.returncode, proc.stderr),
+        )
+
+    def test_run_fails_in_pipeline(self):
+        script = SetupScript()
+        script.add("fail in a pipeline", ["false"], ["cat"])
+
+        proc = self.run_script(script)
+
+        self.assertEqual(
+            CommandError("Failed to fail in a pipeline (exit status 1)"),
+            script.get_error(proc.returncode, proc.stderr),
+        )
+
+    def test_get_error_without_marker(self):
+        script = SetupScript()
+        script.add("succeed", ["true"])
+
+        self.assertEqual(
+            CommandError("Setup failed with exit status 127: bash: not found"),
+            script.get_error(127, "bash: not found\n"),
+        )
@@ -0,0 +1,290 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import io
+import os
+import socket
+import tarfile
+from pathlib import Path
+
+from fixtures import TempDir
+from testtools import TestCase
+
+from lpci.providers._sync import (
+    FileEntry,
+    IgnoreRules,
+    get_changes,
+    get_host_entries,
+    has_ignore_files,
+    parse_instance_entries,
+    write_tar,
+)
+
+
+class TestSync(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+
+    def test_get_host_entries(self):
+        (self.tempdir / "dir").mkdir(mode=0o750)
+        (self.tempdir / "dir" / "file").write_text("contents")
+        os.chmod(self.tempdir / "dir" / "file", 0o640)
+        os.utime(self.tempdir / "dir" / "file", (1000.5, 1000.5))
+        (self.tempdir / "link").symlink_to("dir/file")
+        sock = socket.socket(socket.AF_UNIX)
+        self.addCleanup(sock.close)
+        sock.bind(str(self.tempdir / "socket"))
+
+        self.assertEqual(
+            {
+                "dir": FileEntry("d", 0o750),
+                "dir/file": FileEntry("f", 0o640, size=8, mtime=1000),
+                "link": FileEntry("l", 0o777, target="dir/file"),
+            },
+            get_host_entries(self.tempdir),
+        )
+
+    def test_get_host_entries_owner(self):
+        (self.tempdir / "file").write_text("")
+        os.chmod(self.tempdir / "file", 0o644)
+        os.utime(self.tempdir / "file", (1000, 1000))
+
+        self.assertEqual(
+            {"file": FileEntry("f", 0o644, mtime=1000, owner="_lpci")},
+            get_host_entries(self.tempdir, owner="_lpci"),
+        )
+
+    def test_has_ignore_files(self):
+        (self.tempdir / "web" / "src").mkdir(parents=True)
+        (self.tempdir / "web" / "src" / ".gitignore").write_text("*.o\n")
+
+        self.assertFalse(has_ignore_files(self.tempdir, []))
+        self.assertFalse(has_ignore_files(self.tempdir, [".lpciignore"]))
+        self.assertTrue(
+            has_ignore_files(self.tempdir, [".lpciignore", ".gitignore"])
+        )
+
+    def test_parse_instance_entries(self):
+        entries = [
+            ("dir", "d", "750", "4096", "1000.0000000000", "", "root"),
+            ("dir/file", "f", "640", "8", "1000.5000000000", "", "_lpci"),
+            ("link", "l", "777", "8", "1000.0000000000", "dir/file", "root"),
+            ("fifo", "p", "644", "0", "1000.0000000000", "", "root"),
+        ]
+        output = b"".join(
+            f"{field}\0".encode() for entry in entries for field in entry
+        )
+
+        self.assertEqual(
+            {
+                "dir": FileEntry("d", 0o750),
+                "dir/file": FileEntry(
+                    "f", 0o640, size=8, mtime=1000, owner="_lpci"
+                ),
+                "link": FileEntry("l", 0o777, target="dir/file"),
+            },
+            parse_instance_entries(output),
+        )
+
+    def test_parse_instance_entries_empty(self):
+        self.assertEqual({}, parse_instance_entries(b""))
+
+    def test_get_changes(self):
+        host_entries = {
+            "same": FileEntry("f", 0o644, size=1, mtime=1000),
+            "modified": FileEntry("f", 0o644, size=1, mtime=2000),
+            "chmodded": FileEntry("f", 0o755, size=1, mtime=1000),
+            "new": FileEntry("d", 0o755),
+            "new/file": FileEntry("f", 0o644, size=1, mtime=1000),
+            "retyped": FileEntry("l", 0o777, target="same"),
+        }
+        instance_entries = {
+            "same": FileEntry("f", 0o644, size=1, mtime=1000),
+            "modified": FileEntry("f", 0o644, size=1, mtime=1000),
+            "chmodded": FileEntry("f", 0o644, size=1, mtime=1000),
+            "retyped": FileEntry("d", 0o755),
+            "retyped/file": FileEntry("f", 0o644, size=1, mtime=1000),
+            "stale": FileEntry("f", 0o644, size=1, mtime=1000),
+        }
+
+        self.assertEqual(
+            (
+                ["retyped", "stale"],
+                ["chmodded", "modified", "new", "new/file", "retyped"],
+            ),
+            get_changes(host_entries, instance_entries),
+        )
+
+    def test_write_tar(self):
+        (self.tempdir / "dir").mkdir()
+        (self.tempdir / "dir" / "file").write_text("contents")
+        os.link(self.tempdir / "dir" / "file", self.tempdir / "hardlink")
+        (self.tempdir / "link").symlink_to("dir/file")
+        (self.tempdir / "ignored").write_text("ignored")
+        stream = io.BytesIO()
+
+        write_tar(
+            stream, self.tempdir, ["dir", "dir/file", "hardlink", "link"]
+        )
+
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            members = tar.getmembers()
+            self.assertEqual(
+                [
+                    ("dir", tarfile.DIRTYPE, ""),
+                    ("dir/file", tarfile.REGTYPE, ""),
+                    ("hardlink", tarfile.REGTYPE, ""),
+                    ("link", tarfile.SYMTYPE, "dir/file"),
+                ],
+                [
+                    (member.name, member.type, member.linkname)
+                    for member in members
+                ],
+            )
+            for member in members:
+                self.assertEqual((0, 0), (member.uid, member.gid))
+            for name in ("dir/file", "hardlink"):
+                file = tar.extractfile(name)
+                assert file is not None
+                self.assertEqual(b"contents", file.read())
+
+    def test_write_tar_owner(self):
+        (self.tempdir / "file").write_text("contents")
+        stream = io.BytesIO()
+
+        write_tar(stream, self.tempdir, ["file"], owner="_lpci")
+
+        stream.seek(0)
+        with tarfile.open(fileobj=stream) as tar:
+            member = tar.getmember("file")
+            self.assertEqual(("_lpci", "_lpci"), (member.uname, member.gname))
+
+
+class TestIgnoreRules(TestCase):
+    def assertIgnored(self, rules, path, is_directory=False):
+        self.assertTrue(
+            rules.match(path, is_directory), f"{path!r} is not ignored"
+        )
+
+    def assertNotIgnored(self, rules, path, is_directory=False):
+        self.assertFalse(
+            rules.match(path, is_directory), f"{path!r} is ignored"
+        )
+
+    def test_empty(self):
+        rules = IgnoreRules()
+        rules.add(["", "# comment", "   ", "/"])
+
+        self.assertFalse(rules)
+        self.assertNotIgnored(rules, "file")
+
+    def test_name(self):
+        rules = IgnoreRules()
+        rules.add(["*.pyc\n", "node_modules\n"])
+
+        self.assertTrue(rules)
+        self.assertIgnored(rules, "a.pyc")
+        self.assertIgnored(rules, "dir/a.pyc")
+        self.assertNotIgnored(rules, "a.py")
+        self.assertIgnored(rules, "node_modules", is_directory=True)
+        self.assertIgnored(rules, "web/node_modules", is_directory=True)
+
+    def test_anchored(self):
+        rules = IgnoreRules()
+        rules.add(["/build", "doc/*.txt"])
+
+        self.assertIgnored(rules, "build", is_directory=True)
+        self.assertNotIgnored(rules, "src/build", is_directory=True)
+        self.assertIgnored(rules, "doc/a.txt")
+        self.assertNotIgnored(rules, "doc/api/a.txt")
+        self.assertNotIgnored(rules, "src/doc/a.txt")
+
+    def test_directory_only(self):
+        rules = IgnoreRules()
+        rules.add(["dist/"])
+
+        self.assertIgnored(rules, "dist", is_directory=True)
+        self.assertNotIgnored(rules, "dist")
+
+    def test_double_asterisks(self):
+        rules = IgnoreRules()
+        rules.add(["**/cache", "a/**/b", "logs/**"])
+
+        self.assertIgnored(rules, "cache")
+        self.assertIgnored(rules, "x/y/cache")
+        self.assertIgnored(rules, "a/b")
+        self.assertIgnored(rules, "a/x/y/b")
+        self.assertNotIgnored(rules, "logs", is_directory=True)
+        self.assertIgnored(rules, "logs/today")
+
+    def test_wildcards(self):
+        rules = IgnoreRules()
+        rules.add(["file?.txt", "[!a-c]z", "[[]x", "un[closed"])
+
+        self.assertIgnored(rules, "file1.txt")
+        self.assertNotIgnored(rules, "file10.txt")
+        self.assertIgnored(rules, "dz")
+        self.assertNotIgnored(rules, "az")
+        self.assertIgnored(rules, "[x")
+        self.assertIgnored(rules, "un[closed")
+
+    def test_negation_and_escapes(self):
+        rules = IgnoreRules()
+        rules.add(["*.log", "!keep.log", "\\!important", "\\#hash", "a\\ "])
+
+        self.assertIgnored(rules, "debug.log")
+        self.assertNotIgnored(rules, "keep.log")
+        self.assertIgnored(rules, "!important")
+        self.assertIgnored(rules, "#hash")
+        self.assertIgnored(rules, "a ")
+
+    def test_base(self):
+        rules = IgnoreRules()
+        rules.add(["*.o", "/local"], base="src")
+
+        self.assertIgnored(rules, "src/a.o")
+        self.assertIgnored(rules, "src/lib/a.o")
+        self.assertNotIgnored(rules, "a.o")
+        self.assertIgnored(rules, "src/local")
+        self.assertNotIgnored(rules, "src/lib/local")
+
+    def test_is_excluded(self):
+        rules = IgnoreRules()
+        rules.add([".tox/"])
+
+        self.assertTrue(rules.is_excluded(".tox", True))
+        self.assertTrue(rules.is_excluded(".tox/py3/bin/python", False))
+        self.assertFalse(rules.is_excluded("src/tox.ini", False))
+
+    def test_get_host_entries(self):
+        tempdir = Path(self.useFixture(TempDir()).path)
+        (tempdir / ".lpciignore").write_text(".tox/\n*.log\n!keep.log\n")
+        (tempdir / ".tox").mkdir()
+        (tempdir / ".tox" / "keep.log").write_text("")
+        (tempdir / "debug.log").write_text("")
+        (tempdir / "keep.log").write_text("")
+        (tempdir / "web").mkdir()
+        (tempdir / "web" / ".lpciignore").write_text("/node_modules\n")
+        (tempdir / "web" / "node_modules").mkdir()
+        (tempdir / "web" / "src").mkdir()
+        (tempdir / "web" / "src" / "node_modules").mkdir()
+        (tempdir / ".gitignore").write_text("web/src\n")
+        rules = IgnoreRules()
+
+        entries = get_host_entries(tempdir, rules, [".lpciignore"])
+
+        self.assertEqual(
+            [
+                ".gitignore",
+                ".lpciignore",
+                "keep.log",
+                "web",
+                "web/.lpciignore",
+                "web/src",
+                "web/src/node_modules",
+            ],
+            sorted(entries),
+        )
+        self.assertTrue(rules.is_excluded("web/node_modules/x", False))
@@ -0,0 +1,166 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""Dependency graphs for the jobs in a pipeline."""
+
+__all__ = [
+    "JobGraph",
+    "JobKey",
+    "format_job_key",
+    "get_timings_path",
+    "load_timings",
+    "save_timings",
+]
+
+import json
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Set, Tuple
+
+from platformdirs import user_state_path
+
+from lpci.config import Config
+from lpci.errors import CommandError
+from lpci.providers._base import sanitize_lxd_instance_name
+
+# A single job in a pipeline, identified by its name and its index in the
+# job's (possibly expanded) list of definitions.
+JobKey = Tuple[str, int]
+
+
+def format_job_key(key: JobKey) -> str:
+    """Return a human-readable description of a job."""
+    job_name, job_index = key
+    return f"{job_name!r} #{job_index}"
+
+
+class JobGraph:
+    """A dependency graph of the jobs in a pipeline.
+
+    By default, every job depends on all the jobs in the previous stage of
+    the pipeline, which is how stages are run by `lpci run`.  If
+    `use_inputs` is True, then a job that takes input from another job only
+    depends on that job, so that it can start as soon as its input is
+    available.
+
+    :param config: The pipeline configuration.
+    :param use_inputs: Derive dependencies from `input` where possible.
+    :raises CommandError: if `use_inputs` is True and a job takes input
+        from a job that doesn't run in an earlier stage.
+    """
+
+    def __init__(self, config: Config, use_inputs: bool = False) -> None:
+        # All jobs, in pipeline order; this is also a topological order.
+        self.jobs: List[JobKey] = []
+        self.predecessors: Dict[JobKey, Set[JobKey]] = {}
+        # Names of jobs in the pipeline that have no definition.
+        self.missing: List[str] = []
+
+        previous_stage: List[JobKey] = []
+        for stage in config.pipeline:
+            current_stage: List[JobKey] = []
+            for job_name in stage:
+                jobs = config.jobs.get(job_name, [])
+                if not jobs:
+                    self.missing.append(job_name)
+                for job_index, job in enumerate(jobs):
+                    key = (job_name, job_index)
+                    if use_inputs and job.input is not None:
+                        input_job_name = job.input.job_name
+                        self.predecessors[key] = {
+                            other
+                            for other in self.jobs
+                            if other[0] == input_job_name
+                        }
+                        if not self.predecessors[key]:
+                            raise CommandError(
+                                f"Job {format_job_key(key)} takes input "
+                                f"from {input_job_name!r}, which does not "
+                                f"run in an earlier stage."
+                            )
+                    else:
+                        self.predecessors[key] = set(previous_stage)
+                    current_stage.append(key)
+            self.jobs.extend(current_stage)
+            previous_stage = current_stage
+
+    def get_descendants(self, key: JobKey) -> Set[JobKey]:
+        """Return all the jobs that depend directly or indirectly on `key`."""
+        descendants = {key}
+        for job in self.jobs:
+            if self.predecessors[job] & descendants:
+                descendants.add(job)
+        descendants.remove(key)
+        return descendants
+
+    def get_critical_path(
+        self, durations: Mapping[JobKey, float], default_duration: float = 0.0
+    ) -> Tuple[List[JobKey], float]:
+        """Return the longest chain of dependent jobs.
+
+        With unlimited concurrency, this chain bounds the wall-clock time
+        taken to run the whole pipeline.
+
+        :param durations: The expected duration of each job.
+        :param default_duration: The duration to assume for jobs not in
+            `durations`.
+        :return: A tuple of the jobs on the critical path, in order, and
+            the total expected duration of that path.
+        """
+        finish: Dict[JobKey, float] = {}
+        previous: Dict[JobKey, Optional[JobKey]] = {}
+        for key in self.jobs:
+            start = 0.0
+            previous[key] = None
+            # Prefer earlier jobs in the pipeline when breaking ties.
+            for predecessor in sorted(
+                self.predecessors[key], key=self.jobs.index
+            ):
+                if finish[predecessor] > start or previous[key] is None:
+                    start = finish[predecessor]
+                    previous[key] = predecessor
+            finish[key] = start + durations.get(key, default_duration)
+
+        if not self.jobs:
+            return [], 0.0
+        last: Optional[JobKey] = max(self.jobs, key=lambda key: finish[key])
+        assert last is not None
+        total = finish[last]
+        path = []
+        while last is not None:
+            path.append(last)
+            last = previous[last]
+        return list(reversed(path)), total
+
+
+def get_timings_path(project_name: str, project_path: Path) -> Path:
+    """Return the path used to record job durations for a project."""
+    name = sanitize_lxd_instance_name(
+        f"{project_name}-{project_path.stat().st_ino}"
+    )
+    return user_state_path("lpci") / "timings" / f"{name}.json"
+
+
+def load_timings(path: Path) -> Dict[JobKey, float]:
+    """Load recorded job durations, if any."""
+    try:
+        with open(path) as f:
+            recorded = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {
+        (job_name, int(job_index)): float(duration)
+        for job_name, job_durations in recorded.items()
+        for job_index, duration in job_durations.items()
+    }
+
+
+def save_timings(path: Path, durations: Mapping[JobKey, float]) -> None:
+    """Record job durations, merging them with any previous records."""
+    timings = load_timings(path)
+    timings.update(durations)
+    recorded: Dict[str, Dict[str, float]] = {}
+    for (job_name, job_index), duration in sorted(timings.items()):
+        recorded.setdefault(job_name, {})[str(job_index)] = duration
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(recorded, f, indent=2, sort_keys=True)
@@ -0,0 +1,195 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""A cache of the signing keys of PPAs."""
+
+__all__ = [
+    "SigningKeyCache",
+    "get_fingerprint",
+    "get_signing_key_cache_path",
+]
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from platformdirs import user_cache_path
+
+# The OpenPGP packet tag of a public key.
+_PUBLIC_KEY_TAG = 6
+
+
+def get_signing_key_cache_path() -> Path:
+    """Return the path used to cache the signing keys of PPAs."""
+    return user_cache_path("lpci") / "signing-keys"
+
+
+def get_fingerprint(keyring: bytes) -> Optional[str]:
+    """Return the fingerprint of the primary key in a binary keyring.
+
+    :return: The fingerprint in upper-case hexadecimal, or None if the
+        keyring doesn't start with a version 4 or later public key.
+    """
+    if len(keyring) < 2 or not keyring[0] & 0x80:
+        return None
+    if keyring[0] & 0x40:
+        tag = keyring[0] & 0x3F
+        if keyring[1] < 192:
+            length, offset = keyring[1], 2
+        elif keyring[1] < 224 and len(keyring) >= 3:
+            length, offset = ((keyring[1] - 192) << 8) + keyring[2] + 192, 3
+        elif keyring[1] == 255 and len(keyring) >= 6:
+            length, offset = int.from_bytes(keyring[2:6], "big"), 6
+        else:
+            # Public key packets can't have partial lengths.
+            return None
+    else:
+        tag = (keyring[0] >> 2) & 0x0F
+        length_size = {0: 1, 1: 2, 2: 4}.get(keyring[0] & 0x03)
+        if length_size is None:
+            return None
+        offset = 1 + length_size
+        length = int.from_bytes(keyring[1:offset], "big")
+    body = keyring[offset:][:length]
+    if tag != _PUBLIC_KEY_TAG or len(body) != length or not body:
+        return None
+    if body[0] == 4:
+        digest = hashlib.sha1(b"\x99" + length.to_bytes(2, "big") + body)
+    elif body[0] in (5, 6):
+        digest = hashlib.sha256(
+            bytes([0x95 + body[0]]) + length.to_bytes(4, "big") + body
+        )
+    else:
+        return None
+    return digest.hexdigest().upper()
+
+
+class SigningKeyCache:
+    """Dearmored signing keys of PPAs, kept on the host for reuse by jobs.
+
+    Each keyring is stored with the fingerprint that Launchpad reported
+    for the PPA's signing key when it was fetched, and the time at which
+    Launchpad last reported it.  A keyring is only used while Launchpad
+    still reports that fingerprint and the keyring still has it; otherwise
+    it is fetched again, which also picks up keys that a PPA has rotated.
+    Keyrings whose fingerprints were checked recently can be used without
+    asking Launchpad again.
+
+    :param path: The directory holding the cache.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def get_keyring_path(
+        self, owner: str, distribution: str, archive: str
+    ) -> Path:
+        """Return the path of the cached keyring for a PPA."""
+        return self.path / owner / distribution / f"{archive}.gpg"
+
+    def _load(
+        self, keyring_path: Path
+    ) -> Optional[Tuple[Dict[str, Any], bytes]]:
+        """Return the metadata and contents of a cached keyring, if valid."""
+        try:
+            with open(keyring_path.with_suffix(".json")) as f:
+                metadata = json.load(f)
+            keyring = keyring_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+        if not isinstance(metadata, dict):
+            return None
+        return metadata, keyring
+
+    def get(
+        self, owner: str, distribution: str, archive: str, fingerprint: str
+    ) -> Optional[Path]:
+        """Return the path of a valid cached keyring for a PPA, if any.
+
+        :param fingerprint: The fingerprint of the PPA's signing key, as
+            reported by Launchpad.
+        """
+        keyring_path = self.get_keyring_path(owner, distribution, archive)
+        loaded = self._load(keyring_path)
+        if loaded is None:
+            return None
+        metadata, keyring = loaded
+        if (
+            metadata.get("fingerprint") != fingerprint.upper()
+            or get_fingerprint(keyring) != fingerprint.upper()
+        ):
+            return None
+        return keyring_path
+
+    def get_recent(
+        self, owner: str, distribution: str, archive: str, max_age: float
+    ) -> Optional[Path]:
+        """Return the path of a recently-checked cached keyring for a PPA.
+
+        :param max_age: The number of seconds for which a fingerprint
+            reported by Launchpad is trusted.
+        :return: The path of the cached keyring, if Launchpad reported its
+            fingerprint less than `max_age` seconds ago; otherwise None.
+        """
+        keyring_path = self.get_keyring_path(owner, distribution, archive)
+        loaded = self._load(keyring_path)
+        if loaded is None:
+            return None
+        metadata, keyring = loaded
+        if (
+            not isinstance(metadata.get("fingerprint"), str)
+            or not isinstance(metadata.get("checked"), (int, float))
+            or not 0 <= time.time() - metadata["checked"] < max_age
+            or get_fingerprint(keyring) != metadata["fingerprint"]
+        ):
+            return None
+        return keyring_path
+
+    def mark_checked(
+        self, owner: str, distribution: str, archive: str, fingerprint: str
+    ) -> None:
+        """Record that Launchpad has just reported a PPA's fingerprint.
+
+        :param fingerprint: The fingerprint of the PPA's signing key, as
+            reported by Launchpad.
+        """
+        keyring_path = self.get_keyring_path(owner, distribution, archive)
+        fd, temporary_name = tempfile.mkstemp(
+            prefix=".tmp-", dir=keyring_path.parent
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(
+                {"fingerprint": fingerprint.upper(), "checked": time.time()},
+                f,
+            )
+        os.replace(temporary_name, keyring_path.with_suffix(".json"))
+
+    def put(
+        self,
+        owner: str,
+        distribution: str,
+        archive: str,
+        keyring: bytes,
+        fingerprint: str,
+    ) -> Path:
+        """Store the keyring for a PPA.
+
+        :param fingerprint: The fingerprint of the PPA's signing key, as
+            reported by Launchpad.
+        :return: The path of the stored keyring.
+        """
+        keyring_path = self.get_keyring_path(owner, distribution, archive)
+        keyring_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temporary_name = tempfile.mkstemp(
+            prefix=".tmp-", dir=keyring_path.parent
+        )
+        with os.fdopen(fd, "wb") as f:
+            f.write(keyring)
+        os.chmod(temporary_name, 0o644)
+        os.replace(temporary_name, keyring_path)
+        self.mark_checked(owner, distribution, archive, fingerprint)
+        return keyring_path
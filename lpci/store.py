@@ -0,0 +1,113 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+"""A content-addressed store for job artifacts."""
+
+__all__ = [
+    "ArtifactStore",
+    "get_file_digest",
+]
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Dict, Optional
+
+# The name of the store's directory within an output directory.  Keeping
+# the store on the same file system as the output lets artifacts be hard
+# links to its blobs.
+STORE_DIRECTORY_NAME = ".lpci-store"
+MANIFEST_NAME = "manifest.json"
+
+
+def get_file_digest(path: Path) -> str:
+    """Return the SHA-256 digest of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """Blobs of artifact contents in an output directory, keyed by digest.
+
+    The files produced by each job are still laid out as plain files under
+    `<output>/<job>/<index>/files`, but each of them is a hard link to a
+    blob in the store, so identical artifacts produced by several jobs (or
+    several runs of one job) only take up space once.  A manifest next to
+    each job's files records the digest of each file, so that jobs taking
+    input from it can skip copying contents that they already hold.
+
+    :param output_path: The output directory.
+    """
+
+    def __init__(self, output_path: Path) -> None:
+        self.path = output_path / STORE_DIRECTORY_NAME
+
+    def get_blob_path(self, digest: str) -> Path:
+        """Return the path of the blob with a given digest."""
+        return self.path / "blobs" / digest[:2] / digest
+
+    def _link_to_blob(self, path: Path, digest: str) -> None:
+        """Make `path` a hard link to the blob with its contents.
+
+        If the store has no blob with this digest yet, then `path` becomes
+        that blob.  Files are left alone if they can't be linked, for
+        example because the file system doesn't support hard links, or if
+        the blob has a different mode.
+        """
+        blob_path = self.get_blob_path(digest)
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(path, blob_path)
+            return
+        except FileExistsError:
+            pass
+        except OSError:
+            return
+        path_stat = path.stat()
+        blob_stat = blob_path.stat()
+        if blob_stat.st_ino == path_stat.st_ino:
+            return
+        if blob_stat.st_mode != path_stat.st_mode:
+            return
+        # Replace the file atomically, so that it never goes missing.
+        temporary_path = path.with_name(f".{path.name}.lpci-link")
+        try:
+            os.link(blob_path, temporary_path)
+        except OSError:
+            return
+        os.replace(temporary_path, path)
+
+    def add_tree(self, files_path: Path) -> Dict[str, str]:
+        """Add all the files in a tree to the store.
+
+        :return: A mapping from each file's path relative to `files_path`
+            to the digest of its contents.
+        """
+        manifest = {}
+        for dirpath, _, filenames in os.walk(files_path):
+            for filename in filenames:
+                path = Path(dirpath) / filename
+                if path.is_symlink() or not path.is_file():
+                    continue
+                digest = get_file_digest(path)
+                self._link_to_blob(path, digest)
+                manifest[path.relative_to(files_path).as_posix()] = digest
+        return dict(sorted(manifest.items()))
+
+    def save_manifest(self, job_path: Path, manifest: Dict[str, str]) -> None:
+        """Save the manifest of the files in `<job_path>/files`."""
+        with open(job_path / MANIFEST_NAME, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def load_manifest(self, job_path: Path) -> Optional[Dict[str, str]]:
+        """Load the manifest of the files in `<job_path>/files`, if any."""
+        try:
+            with open(job_path / MANIFEST_NAME) as f:
+                manifest: Dict[str, str] = json.load(f)
+        except FileNotFoundError:
+            return None
+        return manifest
@@ -0,0 +1,91 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import os
+import threading
+from pathlib import Path
+
+from fixtures import EnvironmentVariable, TempDir
+from testtools import TestCase
+
+from lpci.apt_cache import AptCache, get_apt_cache_path
+
+
+class TestAptCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+
+    def makePackage(self, cache, name, size, used):
+        path = cache.get_archives_path() / name
+        path.write_bytes(b"x" * size)
+        os.utime(path, (used, used))
+        return path
+
+    def test_get_apt_cache_path(self):
+        self.useFixture(EnvironmentVariable("XDG_CACHE_HOME", "/cache"))
+        self.assertEqual(Path("/cache/lpci/apt"), get_apt_cache_path())
+
+    def test_get_archives_path(self):
+        cache = AptCache(self.tempdir / "apt")
+
+        archives_path = cache.get_archives_path()
+
+        self.assertEqual(self.tempdir / "apt" / "archives", archives_path)
+        self.assertTrue((archives_path / "partial").is_dir())
+
+    def test_get_lists_path(self):
+        cache = AptCache(self.tempdir / "apt", lists=True)
+
+        lists_path = cache.get_lists_path("focal", "amd64")
+
+        assert lists_path is not None
+        self.assertEqual(
+            self.tempdir / "apt" / "lists" / "focal-amd64", lists_path
+        )
+        self.assertTrue((lists_path / "partial").is_dir())
+
+    def test_get_lists_path_without_lists(self):
+        cache = AptCache(self.tempdir / "apt")
+
+        self.assertIsNone(cache.get_lists_path("focal", "amd64"))
+        self.assertFalse((self.tempdir / "apt" / "lists").exists())
+
+    def test_lock(self):
+        cache = AptCache(self.tempdir / "apt")
+        acquired = threading.Event()
+
+        def lock():
+            with cache.lock():
+                acquired.set()
+
+        with cache.lock():
+            thread = threading.Thread(target=lock)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
+    def test_prune_least_recently_used(self):
+        cache = AptCache(self.tempdir / "apt", max_size=250)
+        self.makePackage(cache, "old_1.0_amd64.deb", 100, 1000)
+        self.makePackage(cache, "new_1.0_amd64.deb", 100, 3000)
+        self.makePackage(cache, "used_1.0_amd64.deb", 100, 2000)
+        (cache.get_archives_path() / "lock").touch()
+
+        self.assertEqual(["old_1.0_amd64.deb"], cache.prune())
+        self.assertEqual(
+            ["lock", "new_1.0_amd64.deb", "partial", "used_1.0_amd64.deb"],
+            sorted(os.listdir(cache.get_archives_path())),
+        )
+
+    def test_prune_within_size(self):
+        cache = AptCache(self.tempdir / "apt", max_size=250)
+        self.makePackage(cache, "a_1.0_amd64.deb", 100, 1000)
+
+        self.assertEqual([], cache.prune())
+
+    def test_prune_missing_cache(self):
+        cache = AptCache(self.tempdir / "apt")
+
+        self.assertEqual([], cache.prune())
@@ -0,0 +1,435 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import io
+import os
+import subprocess
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict
+
+from fixtures import EnvironmentVariable, MockPatch, TempDir
+from testtools import TestCase
+
+from lpci.cache import (
+    CacheBackendError,
+    DirectoryCacheBackend,
+    HTTPCacheBackend,
+    JobCache,
+    get_cache_backend,
+    get_job_cache_path,
+    get_project_digest,
+    get_tree_digest,
+)
+
+
+class TestDigests(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+
+    def test_get_job_cache_path(self):
+        self.useFixture(EnvironmentVariable("XDG_CACHE_HOME", "/cache"))
+        self.assertEqual(Path("/cache/lpci/jobs"), get_job_cache_path())
+
+    def test_get_tree_digest(self):
+        (self.tempdir / "a").write_bytes(b"a")
+        (self.tempdir / "dir").mkdir()
+        (self.tempdir / "dir" / "b").write_bytes(b"b")
+        digest = get_tree_digest(self.tempdir)
+
+        self.assertEqual(digest, get_tree_digest(self.tempdir))
+        (self.tempdir / "dir" / "b").write_bytes(b"changed")
+        self.assertNotEqual(digest, get_tree_digest(self.tempdir))
+        (self.tempdir / "dir" / "b").write_bytes(b"b")
+        (self.tempdir / "dir" / "b").rename(self.tempdir / "dir" / "c")
+        self.assertNotEqual(digest, get_tree_digest(self.tempdir))
+
+    def test_get_project_digest(self):
+        (self.tempdir / "setup.py").write_text("setup()")
+        digest = get_project_digest(self.tempdir)
+
+        (self.tempdir / "setup.py").write_text("setup(name='x')")
+        self.assertNotEqual(digest, get_project_digest(self.tempdir))
+
+    def test_get_project_digest_ignored_paths(self):
+        (self.tempdir / "setup.py").write_text("setup()")
+        (self.tempdir / ".lpciignore").write_text(".tox/\n")
+        digest = get_project_digest(
+            self.tempdir, ignore_file_names=[".lpciignore"]
+        )
+
+        (self.tempdir / ".tox").mkdir()
+        (self.tempdir / ".tox" / "log").write_text("log")
+        (self.tempdir / "output").mkdir()
+        (self.tempdir / "output" / "file").write_text("output")
+        self.assertEqual(
+            digest,
+            get_project_digest(
+                self.tempdir,
+                ignore_file_names=[".lpciignore"],
+                exclude=[self.tempdir / "output"],
+            ),
+        )
+        self.assertNotEqual(
+            digest,
+            get_project_digest(
+                self.tempdir, ignore_file_names=[".lpciignore"]
+            ),
+        )
+
+    def git(self, *args):
+        subprocess.run(
+            [
+                "git",
+                "-c",
+                "user.name=Test",
+                "-c",
+                "user.email=test@example.com",
+            ]
+            + list(args),
+            cwd=self.tempdir,
+            check=True,
+            capture_output=True,
+        )
+
+    def test_get_project_digest_git(self):
+        self.git("init", "-q")
+        (self.tempdir / "setup.py").write_text("setup()")
+        (self.tempdir / "script").write_text("#! /bin/sh\n")
+        os.symlink("setup.py", self.tempdir / "link")
+        self.git("add", "setup.py", "script", "link")
+        digest = get_project_digest(self.tempdir)
+
+        # Untracked files and Git's own data don't matter.
+        (self.tempdir / "build").mkdir()
+        (self.tempdir / "build" / "output").write_text("output")
+        self.git("commit", "-q", "-m", "Initial commit")
+        self.assertEqual(digest, get_project_digest(self.tempdir))
+
+        # Uncommitted changes to tracked files do, whether or not they
+        # have been added to the index.
+        (self.tempdir / "setup.py").write_text("setup(name='x')")
+        modified_digest = get_project_digest(self.tempdir)
+        self.assertNotEqual(digest, modified_digest)
+        self.git("add", "setup.py")
+        self.assertEqual(modified_digest, get_project_digest(self.tempdir))
+        (self.tempdir / "setup.py").write_text("setup()")
+        self.assertEqual(digest, get_project_digest(self.tempdir))
+        (self.tempdir / "script").chmod(0o755)
+        self.assertNotEqual(digest, get_project_digest(self.tempdir))
+        (self.tempdir / "script").chmod(0o644)
+        (self.tempdir / "link").unlink()
+        os.symlink("script", self.tempdir / "link")
+        self.assertNotEqual(digest, get_project_digest(self.tempdir))
+        (self.tempdir / "link").unlink()
+        self.assertNotEqual(digest, get_project_digest(self.tempdir))
+
+    def test_get_project_digest_git_subdirectory(self):
+        self.git("init", "-q")
+        project_path = self.tempdir / "project"
+        project_path.mkdir()
+        (project_path / "setup.py").write_text("setup()")
+        (self.tempdir / "other").write_text("other")
+        self.git("add", ".")
+        digest = get_project_digest(project_path)
+
+        (self.tempdir / "other").write_text("changed")
+        self.assertEqual(digest, get_project_digest(project_path))
+        (project_path / "setup.py").write_text("setup(name='x')")
+        self.assertNotEqual(digest, get_project_digest(project_path))
+
+    def test_get_project_digest_git_excluded_paths(self):
+        self.git("init", "-q")
+        (self.tempdir / "setup.py").write_text("setup()")
+        (self.tempdir / "output").mkdir()
+        (self.tempdir / "output" / "file").write_text("output")
+        self.git("add", ".")
+        digest = get_project_digest(
+            self.tempdir, exclude=[self.tempdir / "output"]
+        )
+
+        (self.tempdir / "output" / "file").write_text("changed")
+        self.assertEqual(
+            digest,
+            get_project_digest(
+                self.tempdir, exclude=[self.tempdir / "output"]
+            ),
+        )
+
+    def test_get_project_digest_git_without_tracked_files(self):
+        # A project in a Git working tree that tracks none of its files is
+        # read in full.
+        self.git("init", "-q")
+        (self.tempdir / "setup.py").write_text("setup()")
+        digest = get_project_digest(self.tempdir)
+
+        (self.tempdir / "setup.py").write_text("setup(name='x')")
+        self.assertNotEqual(digest, get_project_digest(self.tempdir))
+
+
+class TestJobCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_path = Path(self.useFixture(TempDir()).path) / "jobs"
+        self.output_path = Path(self.useFixture(TempDir()).path)
+
+    def make_output(self, name, files):
+        target_path = self.output_path / name / "0"
+        for path, content in files.items():
+            (target_path / "files" / path).parent.mkdir(
+                parents=True, exist_ok=True
+            )
+            (target_path / "files" / path).write_bytes(content)
+        (target_path / "properties").write_text("{}")
+        return target_path
+
+    def test_restore_missing(self):
+        cache = JobCache(self.cache_path)
+        target_path = self.output_path / "build" / "0"
+
+        self.assertFalse(cache.restore("key", target_path))
+        self.assertFalse(target_path.exists())
+
+    def test_save_and_restore(self):
+        cache = JobCache(self.cache_path)
+        cache.save("key", self.make_output("build", {"dist/a.whl": b"a"}))
+        target_path = self.output_path / "other" / "0"
+
+        self.assertTrue(cache.restore("key", target_path))
+        self.assertEqual(
+            b"a", (target_path / "files" / "dist" / "a.whl").read_bytes()
+        )
+        self.assertEqual("{}", (target_path / "properties").read_text())
+
+    def test_save_without_output(self):
+        cache = JobCache(self.cache_path)
+        cache.save("key", None)
+        target_path = self.output_path / "build" / "0"
+
+        self.assertTrue(cache.restore("key", target_path))
+        self.assertFalse(target_path.exists())
+
+    def test_restore_replaces_hard_links(self):
+        cache = JobCache(self.cache_path)
+        cache.save("key", self.make_output("build", {"a": b"new"}))
+        target_path = self.output_path / "other" / "0"
+        (target_path / "files").mkdir(parents=True)
+        linked_path = self.output_path / "linked"
+        linked_path.write_bytes(b"old")
+        os.link(linked_path, target_path / "files" / "a")
+
+        cache.restore("key", target_path)
+
+        self.assertEqual(b"new", (target_path / "files" / "a").read_bytes())
+        self.assertEqual(b"old", linked_path.read_bytes())
+
+    def test_evicts_least_recently_used(self):
+        cache = JobCache(self.cache_path, max_size=25)
+        cache.save("first", self.make_output("first", {"a": b"x" * 10}))
+        cache.save("second", self.make_output("second", {"a": b"y" * 10}))
+        os.utime(self.cache_path / "first", (0, 0))
+        os.utime(self.cache_path / "second", (1, 1))
+        # Using an entry makes it the most recently used.
+        self.assertTrue(cache.restore("first", None))
+
+        cache.save("third", self.make_output("third", {"a": b"z" * 10}))
+
+        self.assertEqual(
+            ["first", "third"],
+            sorted(path.name for path in self.cache_path.iterdir()),
+        )
+
+    def test_does_not_save_oversized_entries(self):
+        cache = JobCache(self.cache_path, max_size=5)
+        cache.save("key", self.make_output("build", {"a": b"x" * 10}))
+
+        self.assertEqual([], list(self.cache_path.iterdir()))
+
+
+class CacheServer(ThreadingHTTPServer):
+    """A minimal HTTP cache server, storing entries in memory."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), CacheRequestHandler)
+        self.entries: Dict[str, bytes] = {}
+        self.fail = False
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    server: CacheServer
+
+    def do_GET(self):
+        entry = self.server.entries.get(self.path)
+        if self.server.fail:
+            self.send_error(500)
+        elif entry is None:
+            self.send_error(404)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(entry)))
+            self.end_headers()
+            self.wfile.write(entry)
+
+    def do_PUT(self):
+        if self.server.fail:
+            self.send_error(500)
+            return
+        length = int(self.headers["Content-Length"])
+        self.server.entries[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_cache_server(test):
+    server = CacheServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    test.addCleanup(thread.join)
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+class TestCacheBackends(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+        self.archive_path = self.tempdir / "entry.tar.gz"
+        self.archive_path.write_bytes(b"archive")
+
+    def test_get_cache_backend(self):
+        backend = get_cache_backend("/mnt/cache")
+        assert isinstance(backend, DirectoryCacheBackend)
+        self.assertEqual(Path("/mnt/cache"), backend.path)
+        backend = get_cache_backend("https://cache.example.com/lpci/")
+        assert isinstance(backend, HTTPCacheBackend)
+        self.assertEqual("https://cache.example.com/lpci", backend.url)
+
+    def test_directory_backend(self):
+        backend = DirectoryCacheBackend(self.tempdir / "shared")
+        destination = self.tempdir / "fetched.tar.gz"
+
+        self.assertFalse(backend.get("abcd", destination))
+        backend.put("abcd", self.archive_path)
+        self.assertEqual(
+            ["abcd.tar.gz"],
+            os.listdir(self.tempdir / "shared" / "ab"),
+        )
+        self.assertTrue(backend.get("abcd", destination))
+        self.assertEqual(b"archive", destination.read_bytes())
+
+    def test_directory_backend_error(self):
+        (self.tempdir / "shared").write_text("not a directory")
+        backend = DirectoryCacheBackend(self.tempdir / "shared")
+
+        self.assertRaises(
+            CacheBackendError, backend.put, "abcd", self.archive_path
+        )
+
+    def test_http_backend(self):
+        server = start_cache_server(self)
+        backend = HTTPCacheBackend(
+            f"http://127.0.0.1:{server.server_port}/lpci/"
+        )
+        destination = self.tempdir / "fetched.tar.gz"
+
+        self.assertFalse(backend.get("abcd", destination))
+        backend.put("abcd", self.archive_path)
+        self.assertEqual({"/lpci/abcd.tar.gz": b"archive"}, server.entries)
+        self.assertTrue(backend.get("abcd", destination))
+        self.assertEqual(b"archive", destination.read_bytes())
+
+    def test_http_backend_error(self):
+        server = start_cache_server(self)
+        server.fail = True
+        backend = HTTPCacheBackend(f"http://127.0.0.1:{server.server_port}")
+
+        self.assertRaises(
+            CacheBackendError,
+            backend.get,
+            "abcd",
+            self.tempdir / "fetched.tar.gz",
+        )
+        self.assertRaises(
+            CacheBackendError, backend.put, "abcd", self.archive_path
+        )
+
+
+class TestSharedJobCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+        self.output_path = self.tempdir / "output"
+        self.mock_emit = self.useFixture(MockPatch("lpci.cache.emit")).mock
+
+    def make_output(self):
+        target_path = self.output_path / "build" / "0"
+        (target_path / "files" / "dist").mkdir(parents=True)
+        (target_path / "files" / "dist" / "a.whl").write_bytes(b"a")
+        (target_path / "properties").write_text("{}")
+        return target_path
+
+    def assertRestores(self, cache, key):
+        target_path = self.output_path / "other" / "0"
+        self.assertTrue(cache.restore(key, target_path))
+        self.assertEqual(
+            b"a", (target_path / "files" / "dist" / "a.whl").read_bytes()
+        )
+        self.assertEqual("{}", (target_path / "properties").read_text())
+
+    def test_shares_entries_between_caches(self):
+        backend = DirectoryCacheBackend(self.tempdir / "shared")
+        first = JobCache(self.tempdir / "first", backend=backend)
+        second = JobCache(self.tempdir / "second", backend=backend)
+
+        self.assertFalse(second.restore("key", self.output_path / "x"))
+        first.save("key", self.make_output())
+
+        self.assertRestores(second, "key")
+        # The entry is now held locally too.
+        self.assertTrue((self.tempdir / "second" / "key").is_dir())
+        self.mock_emit.message.assert_not_called()
+
+    def test_shares_entries_over_http(self):
+        server = start_cache_server(self)
+        backend = HTTPCacheBackend(f"http://127.0.0.1:{server.server_port}")
+        first = JobCache(self.tempdir / "first", backend=backend)
+        second = JobCache(self.tempdir / "second", backend=backend)
+
+        first.save("key", self.make_output())
+
+        self.assertEqual(["/key.tar.gz"], list(server.entries))
+        self.assertRestores(second, "key")
+
+    def test_backend_errors_are_cache_misses(self):
+        server = start_cache_server(self)
+        server.fail = True
+        backend = HTTPCacheBackend(f"http://127.0.0.1:{server.server_port}")
+        cache = JobCache(self.tempdir / "jobs", backend=backend)
+
+        cache.save("key", self.make_output())
+        self.assertRestores(cache, "key")
+        self.assertFalse(cache.restore("other", self.output_path / "x"))
+        self.assertEqual(2, self.mock_emit.message.call_count)
+
+    def test_rejects_unexpected_archive_members(self):
+        backend = DirectoryCacheBackend(self.tempdir / "shared")
+        archive_path = self.tempdir / "entry.tar.gz"
+        with tarfile.open(archive_path, "w:gz") as tar:
+            member = tarfile.TarInfo("files/../../escaped")
+            member.size = 1
+            tar.addfile(member, io.BytesIO(b"x"))
+        backend.put("key", archive_path)
+        cache = JobCache(self.tempdir / "jobs", backend=backend)
+
+        self.assertFalse(cache.restore("key", self.output_path / "x"))
+        self.assertFalse((self.tempdir / "escaped").exists())
+        self.assertFalse((self.tempdir / "jobs" / "key").exists())
+        self.mock_emit.message.assert_called_once()
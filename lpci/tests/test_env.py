@@ -22,3 +22,9 @@ class TestEnvironment(TestCase):
             Path("/build/lpci/project"),
             env.get_managed_environment_project_path(),
         )
+
+    def test_get_managed_environment_artifact_store_path(self):
+        self.assertEqual(
+            Path("/build/lpci/store"),
+            env.get_managed_environment_artifact_store_path(),
+        )
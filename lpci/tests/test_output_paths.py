@@ -0,0 +1,179 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import fnmatch
+import os
+import subprocess
+from pathlib import Path
+from typing import cast
+
+from craft_providers import Executor
+from fixtures import TempDir
+from testtools import TestCase
+
+from lpci.commands.run import _list_files
+from lpci.output_paths import OutputPathMatcher
+
+PATHS = [
+    "binary",
+    "setup.py",
+    "test_1.0.whl",
+    "test_1.0.tar.gz",
+    ".hidden/file",
+    "a/b.c/d",
+    "dist/test_1.0.whl",
+    "dist/nested/test_1.0.whl",
+    "node_modules/pkg/index.js",
+    "../other/test_1.0.whl",
+    "../test_1.0.deb",
+    "../project.txt",
+]
+
+PATTERNS = [
+    "binary",
+    "*.whl",
+    "*.tar.gz",
+    "dist/*",
+    "dist/*.whl",
+    "dist/nested/*.whl",
+    "a/b?c/d",
+    ".hidden/*",
+    "*",
+    "*/test_1.0.whl",
+    "?est_1.0.whl",
+    "../*.deb",
+    "../other/*",
+    "..*",
+    "*.txt",
+    "[bs]*",
+    "missing/*",
+]
+
+
+class LocalExecutor:
+    """Run commands on the host, in place of a managed environment."""
+
+    def execute_popen(self, command, **kwargs):
+        return subprocess.Popen(command, **kwargs)
+
+
+class TestOutputPathMatcher(TestCase):
+    def test_filter(self):
+        matcher = OutputPathMatcher(["*.whl", "dist/*", "missing/*"])
+
+        matched, unmatched = matcher.filter(PATHS)
+
+        self.assertEqual(
+            [
+                "test_1.0.whl",
+                "dist/test_1.0.whl",
+                "dist/nested/test_1.0.whl",
+                "../other/test_1.0.whl",
+            ],
+            matched,
+        )
+        # "dist/*" only matches paths that "*.whl" matches first.
+        self.assertEqual(["missing/*"], unmatched)
+
+    def test_filter_matches_fnmatch(self):
+        for pattern in PATTERNS:
+            matched, unmatched = OutputPathMatcher([pattern]).filter(PATHS)
+            expected = fnmatch.filter(PATHS, pattern)
+            self.assertEqual(expected, matched, pattern)
+            self.assertEqual([] if expected else [pattern], unmatched)
+
+    def test_get_find_predicates(self):
+        build_tree = Path("/build/lpci/project")
+
+        self.assertEqual(
+            (
+                [
+                    "/build/lpci/project",
+                    "/build/lpci/project/dist",
+                    "/build/lpci/project/dist/*",
+                ],
+                ["/build/lpci/project/binary", "/build/lpci/project/dist/*"],
+            ),
+            OutputPathMatcher(["binary", "dist/*"]).get_find_predicates(
+                build_tree
+            ),
+        )
+        self.assertEqual(
+            (None, ["*.whl", "/build/lpci/*.deb"]),
+            OutputPathMatcher(["*.whl", "../*.deb"]).get_find_predicates(
+                build_tree
+            ),
+        )
+        self.assertEqual(
+            (None, None),
+            OutputPathMatcher(["*.whl", "*"]).get_find_predicates(build_tree),
+        )
+
+    def test_get_find_predicates_escapes_build_tree(self):
+        build_tree = Path("/build/[lpci]/project")
+
+        self.assertEqual(
+            (
+                ["/build/\\[lpci]/project"],
+                ["/build/\\[lpci]/project/binary"],
+            ),
+            OutputPathMatcher(["binary"]).get_find_predicates(build_tree),
+        )
+
+    def test_find_selects_all_matching_files(self):
+        # Run `find` with the predicates for each pattern over a real tree,
+        # and check that the matcher then finds the same files as matching
+        # the whole tree with `fnmatch`.
+        root = Path(self.useFixture(TempDir()).path) / "[root]"
+        build_tree = root / "project"
+        for path in PATHS:
+            full_path = Path(os.path.normpath(build_tree / path))
+            full_path.parent.mkdir(parents=True, exist_ok=True)
+            full_path.touch()
+
+        for pattern in PATTERNS:
+            matcher = OutputPathMatcher([pattern])
+            directories, files = matcher.get_find_predicates(build_tree)
+            found = _list_files(
+                cast(Executor, LocalExecutor()),
+                root,
+                directory_patterns=directories,
+                file_patterns=files,
+            )
+
+            matched, _ = matcher.filter(
+                str(path.relative_to("project"))
+                if path.parts[0] == "project"
+                else f"../{path}"
+                for path in found
+            )
+            self.assertEqual(
+                sorted(fnmatch.filter(PATHS, pattern)),
+                sorted(matched),
+                pattern,
+            )
+
+    def test_find_only_returns_candidates(self):
+        root = Path(self.useFixture(TempDir()).path)
+        for path in PATHS:
+            full_path = Path(os.path.normpath(root / "project" / path))
+            full_path.parent.mkdir(parents=True, exist_ok=True)
+            full_path.touch()
+        matcher = OutputPathMatcher(["binary", "dist/*.whl"])
+        directories, files = matcher.get_find_predicates(root / "project")
+
+        self.assertEqual(
+            [
+                Path("project/binary"),
+                Path("project/dist/nested/test_1.0.whl"),
+                Path("project/dist/test_1.0.whl"),
+            ],
+            sorted(
+                _list_files(
+                    cast(Executor, LocalExecutor()),
+                    root,
+                    directory_patterns=directories,
+                    file_patterns=files,
+                )
+            ),
+        )
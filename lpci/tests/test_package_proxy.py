@@ -0,0 +1,243 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+from fixtures import EnvironmentVariable, MockPatch, TempDir
+from testtools import TestCase
+
+from lpci.package_proxy import (
+    PackageProxy,
+    PackageProxyStatistics,
+    get_package_proxy_path,
+)
+
+
+class UpstreamServer(ThreadingHTTPServer):
+    """A stand-in for an archive, serving files from `files`."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), UpstreamRequestHandler)
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[str] = []
+        self.authorizations: List[Optional[str]] = []
+        self.delay: float = 0
+
+
+class UpstreamRequestHandler(BaseHTTPRequestHandler):
+    server: UpstreamServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.authorizations.append(self.headers.get("Authorization"))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        content = self.server.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = f'"{hash(content)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def start_upstream_server(test):
+    server = UpstreamServer()
+    thread = threading.Thread(
+        target=server.serve_forever,
+        kwargs={"poll_interval": 0.1},
+        daemon=True,
+    )
+    thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server
+
+
+class TestPackageProxy(TestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("http_proxy", "HTTP_PROXY", "no_proxy", "NO_PROXY"):
+            self.useFixture(EnvironmentVariable(name))
+        self.upstream = start_upstream_server(self)
+        self.base_url = f"http://127.0.0.1:{self.upstream.server_port}"
+        self.path = Path(self.useFixture(TempDir()).path) / "proxy"
+        self.proxy = PackageProxy(self.path)
+        self.proxy.start()
+        self.addCleanup(self.proxy.stop)
+
+    def get(self, path, **kwargs):
+        proxy_url = f"http://127.0.0.1:{self.proxy.port}"
+        return requests.get(
+            self.base_url + path,
+            proxies={"http": proxy_url},
+            timeout=10,
+            **kwargs,
+        )
+
+    def test_get_package_proxy_path(self):
+        self.useFixture(EnvironmentVariable("XDG_CACHE_HOME", "/cache"))
+        self.assertEqual(Path("/cache/lpci/proxy"), get_package_proxy_path())
+
+    def test_caches_packages(self):
+        path = "/ubuntu/pool/main/h/hello/hello_2.10_amd64.deb"
+        self.upstream.files[path] = b"package"
+
+        self.assertEqual(b"package", self.get(path).content)
+        self.assertEqual(b"package", self.get(path).content)
+
+        self.assertEqual([path], self.upstream.requests)
+        self.assertEqual(
+            PackageProxyStatistics(
+                hits=1, misses=1, bytes_from_cache=7, bytes_from_upstream=7
+            ),
+            self.proxy.statistics,
+        )
+
+    def test_cache_persists(self):
+        path = "/ubuntu/pool/main/h/hello/hello_2.10_amd64.deb"
+        self.upstream.files[path] = b"package"
+        self.get(path)
+        self.proxy.stop()
+
+        self.proxy = PackageProxy(self.path)
+        self.proxy.start()
+        self.assertEqual(b"package", self.get(path).content)
+
+        self.assertEqual([path], self.upstream.requests)
+        self.assertEqual(1, self.proxy.statistics.hits)
+
+    def test_deduplicates_concurrent_fetches(self):
+        path = "/ubuntu/pool/main/h/hello/hello_2.10_amd64.deb"
+        self.upstream.files[path] = b"package"
+        self.upstream.delay = 0.2
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            contents = list(
+                executor.map(lambda _: self.get(path).content, range(4))
+            )
+
+        self.assertEqual([b"package"] * 4, contents)
+        self.assertEqual([path], self.upstream.requests)
+        self.assertEqual(3, self.proxy.statistics.hits)
+        self.assertEqual(1, self.proxy.statistics.misses)
+
+    def test_revalidates_indexes(self):
+        self.useFixture(MockPatch("lpci.package_proxy.INDEX_MAX_AGE", 0))
+        path = "/ubuntu/dists/focal/InRelease"
+        self.upstream.files[path] = b"release"
+
+        self.assertEqual(b"release", self.get(path).content)
+        self.assertEqual(b"release", self.get(path).content)
+        self.upstream.files[path] = b"new release"
+        self.assertEqual(b"new release", self.get(path).content)
+
+        self.assertEqual([path] * 3, self.upstream.requests)
+        self.assertEqual(1, self.proxy.statistics.hits)
+        self.assertEqual(2, self.proxy.statistics.misses)
+
+    def test_recently_validated_indexes_are_served_from_cache(self):
+        path = "/ubuntu/dists/focal/InRelease"
+        self.upstream.files[path] = b"release"
+
+        self.get(path)
+        self.upstream.files[path] = b"new release"
+
+        self.assertEqual(b"release", self.get(path).content)
+        self.assertEqual([path], self.upstream.requests)
+
+    def test_conditional_request_from_client(self):
+        path = "/ubuntu/dists/focal/InRelease"
+        self.upstream.files[path] = b"release"
+        etag = self.get(path).headers["ETag"]
+
+        response = self.get(path, headers={"If-None-Match": etag})
+
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.content)
+
+    def test_serves_stale_index_if_upstream_fails(self):
+        self.useFixture(MockPatch("lpci.package_proxy.INDEX_MAX_AGE", 0))
+        path = "/ubuntu/dists/focal/InRelease"
+        self.upstream.files[path] = b"release"
+        self.get(path)
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+        self.assertEqual(b"release", self.get(path).content)
+
+    def test_missing_upstream_file(self):
+        path = "/ubuntu/pool/main/h/hello/missing_1.0_amd64.deb"
+
+        self.assertEqual(404, self.get(path).status_code)
+        self.assertEqual(404, self.get(path).status_code)
+
+        self.assertEqual([path] * 2, self.upstream.requests)
+        self.assertEqual(2, self.proxy.statistics.passed_through)
+
+    def test_passes_other_requests_through(self):
+        path = "/simple/requests/"
+        self.upstream.files[path] = b"index"
+
+        self.assertEqual(b"index", self.get(path).content)
+        self.assertEqual(b"index", self.get(path).content)
+
+        self.assertEqual([path] * 2, self.upstream.requests)
+        self.assertEqual(
+            PackageProxyStatistics(passed_through=2, bytes_from_upstream=10),
+            self.proxy.statistics,
+        )
+        self.assertEqual([], list((self.path / "entries").iterdir()))
+
+    def test_passes_authenticated_requests_through(self):
+        # Files fetched with credentials may be private, so they are passed
+        # through with the credentials rather than cached.
+        path = "/private/pool/main/h/hello/hello_2.10_amd64.deb"
+        self.upstream.files[path] = b"package"
+
+        for _ in range(2):
+            self.assertEqual(
+                b"package", self.get(path, auth=("user", "secret")).content
+            )
+
+        self.assertEqual([path] * 2, self.upstream.requests)
+        self.assertEqual(
+            [self.upstream.authorizations[0]] * 2,
+            self.upstream.authorizations,
+        )
+        self.assertIsNotNone(self.upstream.authorizations[0])
+        self.assertEqual(2, self.proxy.statistics.passed_through)
+        self.assertEqual([], list((self.path / "entries").iterdir()))
+
+    def test_prune(self):
+        self.proxy.max_size = 10
+        old_path = "/ubuntu/pool/main/o/old/old_1.0_amd64.deb"
+        new_path = "/ubuntu/pool/main/n/new/new_1.0_amd64.deb"
+        self.upstream.files[old_path] = b"x" * 6
+        self.upstream.files[new_path] = b"y" * 6
+        self.get(old_path)
+        self.get(new_path)
+        for entry_path in (self.path / "entries").glob("*/*"):
+            if entry_path.read_bytes() == b"x" * 6:
+                os.utime(entry_path, (0, 0))
+
+        self.assertEqual([self.base_url + old_path], self.proxy.prune())
+        self.assertEqual([], self.proxy.prune())
@@ -0,0 +1,301 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import os
+from pathlib import Path
+from textwrap import dedent
+
+from fixtures import EnvironmentVariable, TempDir
+from testtools import TestCase
+
+from lpci.config import Config
+from lpci.errors import CommandError
+from lpci.scheduler import (
+    JobGraph,
+    format_job_key,
+    get_timings_path,
+    load_timings,
+    save_timings,
+)
+
+
+class TestJobGraph(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+        # `Path.cwd()` is assumed as the project directory.
+        # So switch to the created project directory.
+        os.chdir(self.tempdir)
+
+    def create_config(self, text):
+        path = self.tempdir / ".launchpad.yaml"
+        path.write_text(text)
+        return Config.load(path)
+
+    def create_pipeline_config(self):
+        return self.create_config(
+            dedent(
+                """
+                pipeline:
+                    - [build, lint]
+                    - [test, docs]
+                    - publish
+
+                jobs:
+                    build:
+                        matrix:
+                            - series: focal
+                            - series: jammy
+                        architectures: amd64
+                        run: make
+                    lint:
+                        series: focal
+                        architectures: amd64
+                        run: flake8
+                    test:
+                        series: focal
+                        architectures: amd64
+                        run: make check
+                        input:
+                            job-name: build
+                            target-directory: artifacts
+                    docs:
+                        series: focal
+                        architectures: amd64
+                        run: make docs
+                    publish:
+                        series: focal
+                        architectures: amd64
+                        run: make publish
+                        input:
+                            job-name: test
+                            target-directory: artifacts
+                """
+            )
+        )
+
+    def test_stages(self):
+        graph = JobGraph(self.create_pipeline_config())
+
+        self.assertEqual(
+            [
+                ("build", 0),
+                ("build", 1),
+                ("lint", 0),
+                ("test", 0),
+                ("docs", 0),
+                ("publish", 0),
+            ],
+            graph.jobs,
+        )
+        first_stage = {("build", 0), ("build", 1), ("lint", 0)}
+        self.assertEqual(
+            {
+                ("build", 0): set(),
+                ("build", 1): set(),
+                ("lint", 0): set(),
+                ("test", 0): first_stage,
+                ("docs", 0): first_stage,
+                ("publish", 0): {("test", 0), ("docs", 0)},
+            },
+            graph.predecessors,
+        )
+        self.assertEqual([], graph.missing)
+
+    def test_use_inputs(self):
+        graph = JobGraph(self.create_pipeline_config(), use_inputs=True)
+
+        self.assertEqual(
+            {
+                ("build", 0): set(),
+                ("build", 1): set(),
+                ("lint", 0): set(),
+                ("test", 0): {("build", 0), ("build", 1)},
+                ("docs", 0): {("build", 0), ("build", 1), ("lint", 0)},
+                ("publish", 0): {("test", 0)},
+            },
+            graph.predecessors,
+        )
+
+    def test_use_inputs_from_same_stage(self):
+        # The input of a job in the same stage would not exist yet.
+        config = self.create_config(
+            dedent(
+                """
+                pipeline:
+                    - [build, test]
+
+                jobs:
+                    build:
+                        series: focal
+                        architectures: amd64
+                        run: make
+                    test:
+                        series: focal
+                        architectures: amd64
+                        run: make check
+                        input:
+                            job-name: build
+                            target-directory: artifacts
+                """
+            )
+        )
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Job 'test' #0 takes input from 'build', which does not run "
+            r"in an earlier stage\.$",
+            JobGraph,
+            config,
+            use_inputs=True,
+        )
+        # Without using inputs, the configuration is left for `lpci run`
+        # to deal with as before.
+        self.assertEqual(set(), JobGraph(config).predecessors[("test", 0)])
+
+    def test_use_inputs_from_later_stage(self):
+        config = self.create_config(
+            dedent(
+                """
+                pipeline:
+                    - test
+                    - build
+
+                jobs:
+                    build:
+                        series: focal
+                        architectures: amd64
+                        run: make
+                    test:
+                        series: focal
+                        architectures: amd64
+                        run: make check
+                        input:
+                            job-name: build
+                            target-directory: artifacts
+                """
+            )
+        )
+
+        self.assertRaisesRegex(
+            CommandError,
+            r"^Job 'test' #0 takes input from 'build'",
+            JobGraph,
+            config,
+            use_inputs=True,
+        )
+
+    def test_missing(self):
+        config = self.create_config(
+            dedent(
+                """
+                pipeline:
+                    - [build, missing]
+                    - test
+
+                jobs:
+                    build:
+                        series: focal
+                        architectures: amd64
+                        run: make
+                    test:
+                        series: focal
+                        architectures: amd64
+                        run: make check
+                """
+            )
+        )
+
+        graph = JobGraph(config)
+
+        self.assertEqual(["missing"], graph.missing)
+        self.assertEqual({("build", 0)}, graph.predecessors[("test", 0)])
+
+    def test_get_descendants(self):
+        graph = JobGraph(self.create_pipeline_config(), use_inputs=True)
+
+        self.assertEqual(
+            {("test", 0), ("docs", 0), ("publish", 0)},
+            graph.get_descendants(("build", 1)),
+        )
+        self.assertEqual({("docs", 0)}, graph.get_descendants(("lint", 0)))
+        self.assertEqual(set(), graph.get_descendants(("publish", 0)))
+
+    def test_get_critical_path(self):
+        graph = JobGraph(self.create_pipeline_config(), use_inputs=True)
+        durations = {
+            ("build", 0): 10.0,
+            ("build", 1): 20.0,
+            ("lint", 0): 25.0,
+            ("test", 0): 30.0,
+            ("docs", 0): 40.0,
+            ("publish", 0): 5.0,
+        }
+
+        self.assertEqual(
+            ([("lint", 0), ("docs", 0)], 65.0),
+            graph.get_critical_path(durations),
+        )
+
+        durations[("publish", 0)] = 20.0
+        self.assertEqual(
+            ([("build", 1), ("test", 0), ("publish", 0)], 70.0),
+            graph.get_critical_path(durations),
+        )
+
+    def test_get_critical_path_default_duration(self):
+        graph = JobGraph(self.create_pipeline_config())
+
+        self.assertEqual(
+            ([("build", 0), ("test", 0), ("publish", 0)], 3.0),
+            graph.get_critical_path({}, default_duration=1.0),
+        )
+
+    def test_get_critical_path_empty(self):
+        config = self.create_config("pipeline: []\njobs: {}\n")
+
+        self.assertEqual(([], 0.0), JobGraph(config).get_critical_path({}))
+
+
+class TestTimings(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+
+    def test_format_job_key(self):
+        self.assertEqual("'test' #1", format_job_key(("test", 1)))
+
+    def test_get_timings_path(self):
+        self.useFixture(
+            EnvironmentVariable("XDG_STATE_HOME", str(self.tempdir))
+        )
+        project_path = self.tempdir / "my_project"
+        project_path.mkdir()
+
+        self.assertEqual(
+            self.tempdir
+            / "lpci"
+            / "timings"
+            / f"my-project-{project_path.stat().st_ino}.json",
+            get_timings_path("my_project", project_path),
+        )
+
+    def test_load_missing(self):
+        self.assertEqual({}, load_timings(self.tempdir / "nonexistent"))
+
+    def test_load_invalid(self):
+        path = self.tempdir / "timings.json"
+        path.write_text("nonsense")
+
+        self.assertEqual({}, load_timings(path))
+
+    def test_save_and_load(self):
+        path = self.tempdir / "timings" / "project.json"
+
+        save_timings(path, {("build", 0): 1.5, ("test", 0): 2.0})
+        save_timings(path, {("build", 0): 3.0, ("build", 1): 4.0})
+
+        self.assertEqual(
+            {("build", 0): 3.0, ("build", 1): 4.0, ("test", 0): 2.0},
+            load_timings(path),
+        )
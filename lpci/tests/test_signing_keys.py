@@ -0,0 +1,211 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import base64
+import json
+import time
+from pathlib import Path
+
+from fixtures import EnvironmentVariable, TempDir
+from testtools import TestCase
+from testtools.matchers import GreaterThan, LessThan, MatchesAll
+
+from lpci.signing_keys import (
+    SigningKeyCache,
+    get_fingerprint,
+    get_signing_key_cache_path,
+)
+
+# The primary key packet of the signing key of a PPA.
+TEST_KEYRING = base64.b64decode(
+    "mI0ESUm55wEEALrxow0PCnGeCAebH9g5+wtZBfXZdx2vZts+XsTTHxDRsMNgMC9b"
+    "0klCgbydvkmF9WCphCjQ61Wp/Bh0C7DSXVCpA/xs55QB5VCUceIMZCbMTPq1h7Ht"
+    "cA1f+o6+OCPUntErG6eGize6kGhdjBNPOT+q4BSIL69rPuwfM9ZyAYcBABEBAAE="
+)
+TEST_FINGERPRINT = "2AF499CB24AC5F65461405572D1FFB6C0A5174AF"
+
+
+class TestGetFingerprint(TestCase):
+    def test_old_format_packet(self):
+        self.assertEqual(TEST_FINGERPRINT, get_fingerprint(TEST_KEYRING))
+
+    def test_new_format_packet(self):
+        keyring = bytes([0xC6, len(TEST_KEYRING) - 2]) + TEST_KEYRING[2:]
+
+        self.assertEqual(TEST_FINGERPRINT, get_fingerprint(keyring))
+
+    def test_invalid_keyrings(self):
+        for keyring in (
+            b"",
+            b"-----BEGIN PGP PUBLIC KEY BLOCK-----",
+            # Truncated.
+            TEST_KEYRING[:-1],
+            # Not a public key packet.
+            bytes([0xB4]) + TEST_KEYRING[1:],
+            # A version 3 key.
+            TEST_KEYRING[:2] + b"\x03" + TEST_KEYRING[3:],
+        ):
+            self.assertIsNone(get_fingerprint(keyring), repr(keyring))
+
+
+class TestSigningKeyCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = Path(self.useFixture(TempDir()).path)
+
+    def test_get_signing_key_cache_path(self):
+        self.useFixture(EnvironmentVariable("XDG_CACHE_HOME", "/cache"))
+        self.assertEqual(
+            Path("/cache/lpci/signing-keys"), get_signing_key_cache_path()
+        )
+
+    def test_put_and_get(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        now = time.time()
+
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+
+        self.assertEqual(
+            self.tempdir / "keys" / "owner" / "ubuntu" / "ppa.gpg",
+            keyring_path,
+        )
+        self.assertEqual(TEST_KEYRING, keyring_path.read_bytes())
+        self.assertEqual(0o644, keyring_path.stat().st_mode & 0o777)
+        metadata = json.loads(keyring_path.with_suffix(".json").read_text())
+        self.assertEqual(TEST_FINGERPRINT, metadata["fingerprint"])
+        self.assertThat(
+            metadata["checked"],
+            MatchesAll(GreaterThan(now - 1), LessThan(now + 1)),
+        )
+        self.assertEqual(
+            keyring_path,
+            cache.get("owner", "ubuntu", "ppa", TEST_FINGERPRINT),
+        )
+        self.assertEqual(
+            keyring_path,
+            cache.get("owner", "ubuntu", "ppa", TEST_FINGERPRINT.lower()),
+        )
+
+    def test_get_missing(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        cache.put("owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT)
+
+        self.assertIsNone(
+            cache.get("owner", "ubuntu", "other", TEST_FINGERPRINT)
+        )
+        self.assertIsNone(
+            cache.get("owner", "debian", "ppa", TEST_FINGERPRINT)
+        )
+
+    def test_get_rotated_key(self):
+        # If Launchpad reports a different fingerprint, then the PPA's key
+        # has changed.
+        cache = SigningKeyCache(self.tempdir / "keys")
+        cache.put("owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT)
+
+        self.assertIsNone(cache.get("owner", "ubuntu", "ppa", "0" * 40))
+
+    def test_get_changed_keyring(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        keyring_path.write_bytes(TEST_KEYRING[:-1] + b"\x02")
+
+        self.assertIsNone(
+            cache.get("owner", "ubuntu", "ppa", TEST_FINGERPRINT)
+        )
+
+    def test_get_invalid_metadata(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        keyring_path.with_suffix(".json").write_text("[]")
+
+        self.assertIsNone(
+            cache.get("owner", "ubuntu", "ppa", TEST_FINGERPRINT)
+        )
+
+    def test_get_recent(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+
+        self.assertEqual(
+            keyring_path, cache.get_recent("owner", "ubuntu", "ppa", 60)
+        )
+        self.assertIsNone(cache.get_recent("owner", "ubuntu", "other", 60))
+
+    def test_get_recent_expired(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        keyring_path.with_suffix(".json").write_text(
+            json.dumps(
+                {"fingerprint": TEST_FINGERPRINT, "checked": time.time() - 61}
+            )
+        )
+
+        self.assertIsNone(cache.get_recent("owner", "ubuntu", "ppa", 60))
+        # It can still be used once Launchpad reports its fingerprint again.
+        self.assertEqual(
+            keyring_path,
+            cache.get("owner", "ubuntu", "ppa", TEST_FINGERPRINT),
+        )
+
+    def test_get_recent_from_the_future(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        keyring_path.with_suffix(".json").write_text(
+            json.dumps(
+                {"fingerprint": TEST_FINGERPRINT, "checked": time.time() + 60}
+            )
+        )
+
+        self.assertIsNone(cache.get_recent("owner", "ubuntu", "ppa", 60))
+
+    def test_get_recent_without_check_time(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        keyring_path.with_suffix(".json").write_text(
+            json.dumps({"fingerprint": TEST_FINGERPRINT})
+        )
+
+        self.assertIsNone(cache.get_recent("owner", "ubuntu", "ppa", 60))
+
+    def test_get_recent_changed_keyring(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        keyring_path.write_bytes(TEST_KEYRING[:-1] + b"\x02")
+
+        self.assertIsNone(cache.get_recent("owner", "ubuntu", "ppa", 60))
+
+    def test_mark_checked(self):
+        cache = SigningKeyCache(self.tempdir / "keys")
+        keyring_path = cache.put(
+            "owner", "ubuntu", "ppa", TEST_KEYRING, TEST_FINGERPRINT
+        )
+        metadata_path = keyring_path.with_suffix(".json")
+        metadata_path.write_text(
+            json.dumps({"fingerprint": TEST_FINGERPRINT, "checked": 0})
+        )
+
+        cache.mark_checked("owner", "ubuntu", "ppa", TEST_FINGERPRINT.lower())
+
+        metadata = json.loads(metadata_path.read_text())
+        self.assertEqual(TEST_FINGERPRINT, metadata["fingerprint"])
+        self.assertGreater(metadata["checked"], 0)
+        self.assertEqual(
+            keyring_path, cache.get_recent("owner", "ubuntu", "ppa", 60)
+        )
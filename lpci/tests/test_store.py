@@ -0,0 +1,102 @@
+# Copyright 2024 Canonical Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file LICENSE).
+
+import hashlib
+from pathlib import Path
+
+from fixtures import TempDir
+from testtools import TestCase
+
+from lpci.store import ArtifactStore, get_file_digest
+
+
+class TestArtifactStore(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.output_path = Path(self.useFixture(TempDir()).path)
+        self.store = ArtifactStore(self.output_path)
+
+    def make_files(self, job_path, files):
+        files_path = job_path / "files"
+        for name, content in files.items():
+            path = files_path / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+        return files_path
+
+    def test_get_file_digest(self):
+        path = self.output_path / "file"
+        path.write_bytes(b"content")
+        self.assertEqual(
+            hashlib.sha256(b"content").hexdigest(), get_file_digest(path)
+        )
+
+    def test_add_tree(self):
+        files_path = self.make_files(
+            self.output_path / "build" / "0",
+            {"a.whl": b"wheel", "dist/b.whl": b"wheel", "c.tar.gz": b"sdist"},
+        )
+
+        manifest = self.store.add_tree(files_path)
+
+        wheel_digest = hashlib.sha256(b"wheel").hexdigest()
+        sdist_digest = hashlib.sha256(b"sdist").hexdigest()
+        self.assertEqual(
+            {
+                "a.whl": wheel_digest,
+                "c.tar.gz": sdist_digest,
+                "dist/b.whl": wheel_digest,
+            },
+            manifest,
+        )
+        blob_path = self.store.get_blob_path(wheel_digest)
+        self.assertEqual(
+            self.output_path / ".lpci-store" / "blobs" / wheel_digest[:2],
+            blob_path.parent,
+        )
+        # Identical files share the blob's storage.
+        self.assertEqual(3, blob_path.stat().st_nlink)
+        self.assertTrue(blob_path.samefile(files_path / "a.whl"))
+        self.assertTrue(blob_path.samefile(files_path / "dist" / "b.whl"))
+        self.assertEqual(b"wheel", (files_path / "a.whl").read_bytes())
+
+    def test_add_tree_shares_blobs_between_jobs(self):
+        first = self.make_files(self.output_path / "build" / "0", {"a": b"x"})
+        second = self.make_files(self.output_path / "build" / "1", {"b": b"x"})
+
+        self.store.add_tree(first)
+        self.store.add_tree(second)
+
+        self.assertTrue((first / "a").samefile(second / "b"))
+
+    def test_add_tree_again(self):
+        files_path = self.make_files(
+            self.output_path / "build" / "0", {"a": b"x"}
+        )
+
+        self.assertEqual(
+            self.store.add_tree(files_path), self.store.add_tree(files_path)
+        )
+        blob_path = self.store.get_blob_path(hashlib.sha256(b"x").hexdigest())
+        self.assertEqual(2, blob_path.stat().st_nlink)
+
+    def test_add_tree_keeps_modes(self):
+        files_path = self.make_files(
+            self.output_path / "build" / "0", {"a": b"x", "b": b"x"}
+        )
+        (files_path / "a").chmod(0o644)
+        (files_path / "b").chmod(0o755)
+
+        self.store.add_tree(files_path)
+
+        self.assertFalse((files_path / "a").samefile(files_path / "b"))
+        self.assertEqual(0o755, (files_path / "b").stat().st_mode & 0o777)
+
+    def test_manifest(self):
+        job_path = self.output_path / "build" / "0"
+        job_path.mkdir(parents=True)
+        self.assertIsNone(self.store.load_manifest(job_path))
+
+        self.store.save_manifest(job_path, {"a": "digest"})
+
+        self.assertEqual({"a": "digest"}, self.store.load_manifest(job_path))